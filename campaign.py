@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+import concurrent.futures
+import config
+import multiprocessing
+import helper
+import tracer
+from fuzzbase import split_range
+from http2dumb import DumbHttp2ServerTest, DumbHttp2ClientTest
+from http2smart import Http1UpgradeTest
+
+
+# applies global options which are not passed to tests
+def configure(current):
+    tracer.set_level(tracer.VERBOSE if current.verbose else tracer.INFO)
+    tracer.flush_on_signals()
+    if current.numpy:
+        helper.use_numpy()
+    if current.scheduler:
+        helper.use_scheduler()
+
+
+# a counter of tests which is shared between worker processes
+shared_counter = None
+
+
+# creates all available tests, if a range is not specified,
+# it's taken from the config, the last test of the range is included
+def create_tests(current, start_test = None, end_test = None, reuse_port = False):
+    if start_test is None:
+        start_test = current.start_test
+    if end_test is None:
+        end_test = current.end_test
+
+    http1_test = Http1UpgradeTest(current, current.strength, current.pipeline,
+                                  current.size_sweep, current.word_list)
+    http1_end = http1_test.fuzzer.total() if end_test is None \
+                    else min(end_test + 1, http1_test.fuzzer.total())
+    http1_test.set_range(min(start_test, http1_end), http1_end)
+
+    # by default, dumb tests run only the first test
+    if end_test is None:
+        end_test = start_test
+
+    return [
+        DumbHttp2ServerTest(current.host, current.port, current.tls,
+                            seed=current.seed, start_test=start_test, end_test=end_test,
+                            hpack_structure_fuzzer=current.hpack_structure,
+                            frames_per_send=current.frames_per_send,
+                            data_file=current.data_file,
+                            connections=current.connections,
+                            window=current.window),
+        DumbHttp2ClientTest(current.port, current.tls,
+                            seed=current.seed, start_test=start_test, end_test=end_test,
+                            hpack_structure_fuzzer=current.hpack_structure,
+                            reuse_port=reuse_port, counter=shared_counter),
+        http1_test
+    ]
+
+
+# returns the first and the last tests which a test is going to run
+def test_range(test):
+    if isinstance(test, Http1UpgradeTest):
+        return test.fuzzer.position(), test.end - 1
+    return test.start_test, test.end_test
+
+
+# sums up counters and joins sets from several runs
+def merge_stats(all_stats):
+    merged = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if isinstance(value, set):
+                merged.setdefault(key, set()).update(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+# runs in each worker process when it starts
+def init_worker(counter):
+    global shared_counter
+    shared_counter = counter
+
+
+# runs a range of tests in a worker process, tests are created again
+# from the parsed arguments, and since a test depends only on a seed
+# and its number, the worker generates the same tests as a single process would do
+def run_worker(args, name, start_test, end_test):
+    config.current = config.Config(args = args)
+    configure(config.current)
+    try:
+        for test in create_tests(config.current, start_test, end_test, reuse_port = True):
+            if test.name() == name:
+                return test.run() or {}
+        raise Exception('Unknown test: {}'.format(name))
+    finally:
+        tracer.flush()
+
+
+# splits tests of a test between several processes,
+# and returns merged stats of the processes
+#
+# Workers of DumbHttp2ClientTest listen on the same port, and which of them
+# gets a connection from a client depends on the kernel, so instead of
+# splitting the range, they take tests from one shared counter
+def run(current, test, workers):
+    start_test, end_test = test_range(test)
+    counter = None
+    if isinstance(test, DumbHttp2ClientTest):
+        counter = multiprocessing.Value('q', start_test)
+        ranges = [range(0, end_test - start_test + 1)] * workers
+    else:
+        ranges = [r for r in split_range(end_test - start_test + 1, workers) if len(r) > 0]
+    info('run {0} in {1:d} workers, test range {2}:{3}'.format(
+            test.name(), len(ranges), start_test, end_test))
+
+    # the parent doesn't write anything while workers are running
+    tracer.flush()
+    with concurrent.futures.ProcessPoolExecutor(len(ranges), initializer = init_worker,
+                                                initargs = (counter, )) as executor:
+        futures = [executor.submit(run_worker, current.args, test.name(),
+                                   start_test + r.start, start_test + r.stop - 1)
+                   for r in ranges]
+        stats = merge_stats(future.result() for future in futures)
+
+    summary = ['{0}: {1}'.format(key, len(value) if isinstance(value, set) else value)
+               for key, value in sorted(stats.items())]
+    info('finished {0}'.format(test.name()), *summary)
+    return stats
+
+
+def info(*messages):
+    tracer.info('Campaign', *messages)
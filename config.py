@@ -3,9 +3,10 @@
 # contains configuration, parameters can be accessed as attributes
 class Config:
 
-    # init from argparse.ArgumentParser
-    def __init__(self, parser):
-        self.args = vars(parser.parse_args())
+    # init from argparse.ArgumentParser, or from a dict with parsed arguments,
+    # for example, in a worker process
+    def __init__(self, parser = None, args = None):
+        self.args = dict(args) if args is not None else vars(parser.parse_args())
 
     def __getattr__(self, name):
         return self.args[name]
@@ -1,152 +1,350 @@
 #!/usr/bin/python
 
+import asyncio
+import collections
+import os
+import selectors
 import socket
 import ssl
 import time
-import helper
+import tracer
+
+# max number of buffers which can be passed to one sendmsg() call
+try:
+    max_iov = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    max_iov = 1024
+
+# sends all buffers with sendmsg(), it takes care about partial writes
+# and a limit for number of buffers in one call,
+# if the socket is non-blocking, wait() is called when it's not ready for writing
+def sendmsg_all(sock, parts, wait = None):
+    views = [memoryview(part).cast('B') for part in parts if len(part) > 0]
+    start = 0
+    while start < len(views):
+        try:
+            sent = sock.sendmsg(views[start:start + max_iov])
+        except BlockingIOError:
+            wait()
+            continue
+
+        # skip buffers which have been sent completely
+        while start < len(views) and sent >= len(views[start]):
+            sent -= len(views[start])
+            start += 1
+
+        # a buffer was sent partially
+        if sent > 0:
+            views[start] = views[start][sent:]
+
+# returns a point in time when an operation should be given up, or None
+def deadline(timeout):
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+# LatencyTracker keeps recent response latencies (in seconds),
+# and returns a receive timeout which is a high percentile of them times a factor,
+# so that waiting for a response which doesn't come takes as little as possible.
+# Until there are enough samples, the max timeout is used, so that one fast
+# response doesn't make the timeout too short, and a response which came too late
+# is still counted.
+class LatencyTracker:
+
+    def __init__(self, percentile = 0.99, factor = 4.0, samples = 256, min_samples = 8,
+                 min_timeout = 0.005, max_timeout = 5.0):
+        self.percentile = percentile
+        self.factor = factor
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.samples = collections.deque(maxlen = samples)
+        self.cached_timeout = None
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.cached_timeout = None
+
+    def timeout(self):
+        if len(self.samples) < self.min_samples:
+            return self.max_timeout
+        if self.cached_timeout is None:
+            latencies = sorted(self.samples)
+            index = min(int(len(latencies) * self.percentile), len(latencies) - 1)
+            self.cached_timeout = min(self.max_timeout,
+                                      max(self.min_timeout, latencies[index] * self.factor))
+        return self.cached_timeout
+
+    def __repr__(self):
+        return 'samples: {0:d}, receive timeout: {1:.3f}s'.format(
+            len(self.samples), self.timeout())
+
+# ResponseTimer measures latencies of responses on one connection.
+# A latency is counted from the first send which has not been answered yet,
+# so that a response which comes after several sends is not measured
+# from the last of them. Sends which were given up because nothing came in time
+# are not waited for any more, so that a response to a next send
+# is not measured from them.
+class ResponseTimer:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent_at = None
+
+    def reset(self):
+        self.sent_at = None
+
+    def sent(self):
+        if self.sent_at is None:
+            self.sent_at = time.monotonic()
+
+    def received(self):
+        if self.sent_at is not None:
+            self.latency.add(time.monotonic() - self.sent_at)
+            self.sent_at = None
+
+    def give_up(self):
+        self.sent_at = None
+
+    def timeout(self):
+        return self.latency.timeout()
 
 # This is a simple TCP/TLS client which just wraps socket's methods
-# It assumes that a connection is closed if any I/O error occured
+# It assumes that a connection is closed if any I/O error occured,
+# and it never re-connects by itself, since the caller has to start
+# a new connection (for example, send a connection preface)
+#
+# Each operation has a deadline. A connect or send which doesn't complete in time
+# raises socket.timeout. A receive which gets nothing in time returns None,
+# and the connection can still be used. The receive timeout is fixed if specified,
+# otherwise it adapts to latencies of responses which have been received recently.
+# If a caller can match responses to requests better (for example, by PING ACKs),
+# then it can turn off timing, and add latencies to the tracker itself.
+# The socket is non-blocking after connecting, and the client waits for it with selectors.
 class Client:
 
-    def __init__(self, host, port, is_tls = False):
+    def __init__(self, host, port, is_tls = False, timeout = None,
+                 connect_timeout = 5.0, send_timeout = 5.0, latency = None, timed = True):
         self.__host = host
         self.__port = port
         self.__is_tls = is_tls
+        self.__timeout = timeout
+        self.__connect_timeout = connect_timeout
+        self.__send_timeout = send_timeout
         self.__connected = False
+        self.__socket = None
+        self.__readable = None
+        self.__writable = None
+        self.latency = latency if latency is not None else LatencyTracker()
+        self.__timer = ResponseTimer(self.latency) if timed else None
 
     def connect(self):
         self.__connected = False
         self.__verbose('connect to {0}:{1:d}'.format(self.__host, self.__port))
+        self.__close_selectors()
         if self.__is_tls:
             self.__context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
             self.__context.set_alpn_protocols(['h2'])
             self.__socket = self.__context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
         else:
             self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.settimeout(self.__connect_timeout)
         self.__socket.connect((self.__host, self.__port))
+        self.__socket.setblocking(False)
+
+        # a sender and a receiver may run in different threads,
+        # so they don't share a selector
+        self.__readable = selectors.DefaultSelector()
+        self.__readable.register(self.__socket, selectors.EVENT_READ)
+        self.__writable = selectors.DefaultSelector()
+        self.__writable.register(self.__socket, selectors.EVENT_WRITE)
+        if self.__timer is not None:
+            self.__timer.reset()
         self.__connected = True
 
     def send(self, data):
         try:
-            if self.__connected is False:
-                self.connect()
-            self.__socket.sendall(data)
+            self.__check_connected()
+            self.__send_all(data, deadline(self.__send_timeout))
+            if self.__timer is not None:
+                self.__timer.sent()
         except socket.error as msg:
             self.__connected = False
             self.__verbose('could not send data: {0}'.format(msg))
             raise
 
-    def receive(self, length = 1024):
+    # sends a sequence of buffers (for example, a frame header and a payload)
+    # without joining them, TLS sockets don't support scatter-gather I/O,
+    # so the buffers are sent one by one
+    def send_parts(self, parts):
         try:
-            if self.__connected is False:
-                self.connect()
-            return self.__socket.recv(length)
+            self.__check_connected()
+            send_deadline = deadline(self.__send_timeout)
+            if self.__is_tls:
+                for part in parts:
+                    self.__send_all(part, send_deadline)
+            else:
+                sendmsg_all(self.__socket, parts,
+                            lambda: self.__wait_for_sending(selectors.EVENT_WRITE, send_deadline))
+            if self.__timer is not None:
+                self.__timer.sent()
         except socket.error as msg:
             self.__connected = False
-            self.__verbose('could not receive data: {0}'.format(msg))
+            self.__verbose('could not send data: {0}'.format(msg))
             raise
 
-    def isconnected(self):
-        return self.__connected
-
-    def close(self):
-        self.__connected = False
-        self.__socket.close()
+    # returns received data, or None if nothing was received in time
+    def receive(self, length = 1024):
+        return self.__receive(lambda: self.__socket.recv(length))
 
-    def __verbose(self, message):
-        helper.verbose('[{0}] {1}'.format(Client.__name__, message))
+    # reads data to a buffer, and returns a number of received bytes,
+    # or None if nothing was received in time
+    def receive_into(self, buffer):
+        return self.__receive(lambda: self.__socket.recv_into(buffer))
 
-# StubbornTCPClient makes multiple attempts to connect and send data
-# if an I/O error occured
-class StubbornTCPClient:
+    def receive_timeout(self):
+        if self.__timeout is not None:
+            return self.__timeout
+        return self.latency.timeout()
 
-    def __init__(self, host, port, max_attempts = 5, delay = 3):
-        self.__host = host
-        self.__port = port
-        self.__max_attempts = max_attempts
-        self.__delay = delay    # in seconds
-        self.__connected = False
+    def isconnected(self):
+        return self.__connected
 
-    def connect(self):
-        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__socket.connect((self.__host, self.__port))
-        self.__connected = True;
+    # shuts down the connection but doesn't close the socket,
+    # so that a thread which waits for data wakes up and sees the end of the stream
+    def shutdown(self):
+        try:
+            self.__socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-    def __reconnect(self):
+    def close(self):
         self.__connected = False
-        self.close()
-        self.connect()
+        self.__close_selectors()
+        self.__socket.close()
 
-    def send(self, data):
-        attempt = 0
-        error = False
-        while (attempt < self.__max_attempts):
-            attempt += 1
-
-            if self.__connected is False or error is True:
-                self.__verbose('connect to {0}:{1:d}, attempt #{2:d}'
-                           .format(self.__host, self.__port, attempt))
-                try:
-                    self.connect()
-                except socket.error as msg:
-                    self.__verbose('could not connect: {0}'.format(msg))
-                    time.sleep(self.__delay)
-                    continue
+    def __close_selectors(self):
+        if self.__readable is not None:
+            self.__readable.close()
+            self.__writable.close()
+            self.__readable = None
+            self.__writable = None
 
+    def __send_all(self, data, send_deadline):
+        view = memoryview(data).cast('B')
+        while len(view) > 0:
             try:
-                self.__socket.sendall(data)
-                break
-            except socket.error as msg:
-                self.__verbose('could not send data: {0}'.format(msg))
-                error = True
+                sent = self.__socket.send(view)
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                self.__wait_for_sending(selectors.EVENT_WRITE, send_deadline)
                 continue
+            except ssl.SSLWantReadError:
+                self.__wait_for_sending(selectors.EVENT_READ, send_deadline)
+                continue
+            view = view[sent:]
 
-        if attempt == self.__max_attempts:
-            raise Exception('Could not connect to remote host {0}:{1:d}'
-                            .format(self.__host, self.__port))
+    def __wait_for_sending(self, event, send_deadline):
+        if not self.__wait(event, send_deadline):
+            raise socket.timeout('could not send data in time')
 
-    def receive(self, length = 1024):
+    # a TLS socket may have decrypted data which is not seen by a selector,
+    # so data is read first, and the client waits only if there is nothing to read
+    def __receive(self, receive):
         try:
-            return self.__socket.recv(length)
+            self.__check_connected()
+            receive_deadline = deadline(self.receive_timeout())
+            while True:
+                try:
+                    received = receive()
+                    break
+                except (BlockingIOError, ssl.SSLWantReadError):
+                    event = selectors.EVENT_READ
+                except ssl.SSLWantWriteError:
+                    event = selectors.EVENT_WRITE
+                if not self.__wait(event, receive_deadline):
+                    if self.__timer is not None:
+                        self.__timer.give_up()
+                    return None
         except socket.error as msg:
+            self.__connected = False
             self.__verbose('could not receive data: {0}'.format(msg))
-            return None
+            raise
 
-    def isconnected(self):
-        return self.__connected
+        if received and self.__timer is not None:
+            self.__timer.received()
+        return received
 
-    def close(self):
-        self.__connected = False
-        self.__socket.close()
+    def __check_connected(self):
+        if self.__connected is False:
+            raise ConnectionError('not connected to {0}:{1:d}'.format(self.__host, self.__port))
+
+    # waits until the socket is ready, returns False if the deadline has passed
+    def __wait(self, event, wait_deadline):
+        selector = self.__readable if event == selectors.EVENT_READ else self.__writable
+        if wait_deadline is None:
+            return len(selector.select()) > 0
+        timeout = wait_deadline - time.monotonic()
+        if timeout <= 0:
+            return False
+        return len(selector.select(timeout)) > 0
 
     def __verbose(self, message):
-        helper.verbose('[{0}] {1}'.format(StubbornTCPClient.__name__, message))
+        tracer.verbose(Client.__name__, message)
+
+# AsyncServer serves several connections at once with asyncio,
+# the handler gets a reader and a writer for each connection.
+#
+# Several processes may listen on the same port if reuse_port is set,
+# so the handler may become done because of connections to other processes,
+# that's why it's checked periodically, and not only when a connection is closed.
+class AsyncServer:
 
-# This is a simple TCP/TLS server which just wraps socket's methods
-class Server:
+    check_interval = 0.5    # in seconds
 
-    def __init__(self, port, handler, is_tls = False):
+    def __init__(self, port, handler, is_tls = False, reuse_port = False):
         self.__port = port
         self.__handler = handler
         self.__is_tls = is_tls
+        self.__reuse_port = reuse_port
+        self.__connections = set()
+        self.__closed = False
 
+    # accepts connections until the handler is done,
+    # and waits for connections which are still served
     def start(self):
         if self.__is_tls:
             raise Exception('TLS is not supported')
-        else:
-            self.__server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__server_socket.bind(('localhost', self.__port))
-        self.__server_socket.listen()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.__done = asyncio.Event()
+        server = await asyncio.start_server(self.__accept, 'localhost', self.__port,
+                                            reuse_port = self.__reuse_port or None)
         self.__verbose('started server on {0:d} port'.format(self.__port))
-        while True:
-            # accept connections from outside
-            (clientsocket, address) = self.__server_socket.accept()
-            self.__verbose('accepted connection')
-            self.__handler.handle(clientsocket)
+        async with server:
+            while not self.__closed and not self.__handler.done():
+                try:
+                    await asyncio.wait_for(self.__done.wait(), AsyncServer.check_interval)
+                except asyncio.TimeoutError:
+                    pass
+        await asyncio.gather(*self.__connections, return_exceptions = True)
+
+    async def __accept(self, reader, writer):
+        self.__verbose('accepted connection')
+        task = asyncio.current_task()
+        self.__connections.add(task)
+        try:
+            await self.__handler.handle(reader, writer)
+        except OSError as msg:
+            self.__verbose('connection error: {0}'.format(msg))
+        finally:
+            self.__connections.discard(task)
+            writer.close()
+            if self.__handler.done():
+                self.__done.set()
 
     def close(self):
-        self.__server_socket.close()
+        self.__closed = True
 
     def __verbose(self, message):
-        helper.verbose('[{0}] {1}'.format(Server.__name__, message))
+        tracer.verbose(AsyncServer.__name__, message)
@@ -1,36 +1,35 @@
 #!/usr/bin/python
 
+import array
+import bisect
+import functools
+import mmap
+import os
 
-def get_substates(state):
-    if state[0] != '(':
-        raise Exception('What the hell? state should start with )')
 
-    substates = []
-    start = 0
-    opened = 0
-    i = 0
-    for c in state:
-        if c == '(':
-            if opened == 0:
-                start = i
-            opened += 1
-        elif c == ')':
-            if opened == 0:
-                raise Exception('What the hell? Wrong state: ' + state);
-            if opened == 1:
-                substates.append(state[start+1:i])
-            opened -= 1
+# returns n sub-ranges of [0, total) which have nearly the same size,
+# they can be used to split fuzzing between several processes or hosts
+def split_range(total, n):
+    if n <= 0:
+        raise Exception('What the hell? Number of ranges should be positive')
+    return [range(total * i // n, total * (i + 1) // n) for i in range(n)]
 
-    if opened > 0:
-        raise Exception('What the hell? Wrong state: ' + state);
 
-    return substates
+# a state is a prefix and a position, for example, "linear:42"
+def parse_state(prefix, state):
+    if not state.startswith(prefix + ':'):
+        raise Exception('What the hell? State does not start with "{}:"'.format(prefix))
+    return int(state[len(prefix) + 1:])
 
 
+# LinearFuzzer runs fuzzers one by one, its position is a number of tests
+# which have been already run by previous fuzzers plus a position
+# of the current fuzzer
 class LinearFuzzer:
 
     def __init__(self):
         self.fuzzers = []
+        self.ends = []      # a position where each fuzzer ends
         self.index = 0
         self.prefix = 'linear'
 
@@ -40,30 +39,42 @@ class LinearFuzzer:
     def set_prefix(self, prefix):
         self.prefix = prefix
 
+    # a fuzzer should have all its values when it's added
     def add(self, fuzzer):
+        self.ends.append(self.total() + fuzzer.total())
         self.fuzzers.append(fuzzer)
 
     def total(self):
-        n = 0
+        return self.ends[-1] if self.ends else 0
+
+    def start(self, index):
+        return self.ends[index - 1] if index > 0 else 0
+
+    def position(self):
+        if self.index >= len(self.fuzzers):
+            return self.total()
+        return self.start(self.index) + self.current().position()
+
+    def seek(self, position):
+        if position < 0 or position > self.total():
+            raise Exception('What the hell? Position {} is out of range'.format(position))
+
         for fuzzer in self.fuzzers:
-            n = n + fuzzer.total()
-        return n
+            fuzzer.reset()
+
+        # fuzzers without values are skipped
+        self.index = bisect.bisect_right(self.ends, position)
+        if self.index < len(self.fuzzers):
+            self.current().seek(position - self.start(self.index))
+
+    def split(self, n):
+        return split_range(self.total(), n)
 
     def get_state(self):
-        state = self.prefix + ':' + str(self.index)
-        for fuzzer in self.fuzzers:
-            state = state + '(' + fuzzer.get_state() + ')'
-        return state
+        return '{}:{}'.format(self.prefix, self.position())
 
     def set_state(self, state):
-        substates = get_substates(state)
-        if len(substates) != len(self.fuzzers):
-            raise Exception('Number of substates does not match to number of fuzzers')
-
-        index = 0
-        for fuzzer in self.fuzzers:
-            fuzzer.set_state(substates[index])
-            index += 1
+        self.seek(parse_state(self.prefix, state))
 
     def ready(self):
         return self.index < len(self.fuzzers) and self.current().ready()
@@ -93,6 +104,123 @@ class LinearFuzzer:
         return self.current().fuzz(subject)
 
 
+# returns the smallest prime number which is not less than n
+def next_prime(n):
+    n = max(n, 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+# ProductFuzzer fuzzes with all its fuzzers at once, each test is a combination
+# of values of the fuzzers, combinations are not stored but computed
+# from a position of a test
+#
+# By default, all combinations are used: a position is a mixed-radix number
+# whose digits are positions of the fuzzers.
+#
+# If a strength t is specified, then tests make up a covering array
+# which contains every t-tuple of values of any t fuzzers at least once.
+# It's built from an orthogonal array over a prime field GF(q), where q is
+# not less than the biggest total and the number of fuzzers: a test r defines a polynomial of degree
+# less than t whose coefficients are the base-q digits of r, and a value
+# for the fuzzer i is the polynomial evaluated at i, modulo the fuzzer's total.
+# Any t distinct points define exactly one such polynomial, so the array
+# has q^t tests. For example, every pair of values of four request fuzzers
+# with up to 265 values each is covered in 269^2 = 72361 tests
+# instead of about 10^9 tests.
+class ProductFuzzer:
+
+    def __init__(self, strength = None):
+        self.fuzzers = []
+        self.strength = strength
+        self.index = 0
+        self.prefix = 'product'
+
+    def set_prefix(self, prefix):
+        self.prefix = prefix
+
+    # a fuzzer should have all its values when it's added
+    def add(self, fuzzer):
+        self.fuzzers.append(fuzzer)
+
+    # a covering array is used only if it's smaller than the full product
+    def covering(self):
+        return self.strength is not None and self.strength < len(self.fuzzers)
+
+    # points of different fuzzers must be distinct modulo q,
+    # so q can't be less than the number of fuzzers
+    def order(self):
+        totals = [fuzzer.total() for fuzzer in self.fuzzers]
+        return next_prime(max(max(totals), len(self.fuzzers)))
+
+    def total(self):
+        if not self.fuzzers or any(fuzzer.total() == 0 for fuzzer in self.fuzzers):
+            return 0
+        if self.covering():
+            return self.order() ** self.strength
+        n = 1
+        for fuzzer in self.fuzzers:
+            n *= fuzzer.total()
+        return n
+
+    # returns positions of the fuzzers for a test
+    def digits(self, position):
+        if self.covering():
+            q = self.order()
+            coefficients = []
+            for j in range(self.strength):
+                coefficients.append(position % q)
+                position //= q
+            digits = []
+            for x, fuzzer in enumerate(self.fuzzers):
+                value = 0
+                for coefficient in reversed(coefficients):
+                    value = (value * x + coefficient) % q
+                digits.append(value % fuzzer.total())
+            return digits
+
+        digits = []
+        for fuzzer in reversed(self.fuzzers):
+            position, digit = divmod(position, fuzzer.total())
+            digits.append(digit)
+        digits.reverse()
+        return digits
+
+    def position(self):
+        return self.index
+
+    def seek(self, position):
+        if position < 0 or position > self.total():
+            raise Exception('What the hell? Position {} is out of range'.format(position))
+        self.index = position
+
+    def split(self, n):
+        return split_range(self.total(), n)
+
+    def get_state(self):
+        return '{}:{}'.format(self.prefix, self.position())
+
+    def set_state(self, state):
+        self.seek(parse_state(self.prefix, state))
+
+    def ready(self):
+        return self.index < self.total()
+
+    def reset(self):
+        self.index = 0
+
+    def next(self):
+        self.index += 1
+        return self.ready()
+
+    def fuzz(self, subject):
+        for fuzzer, digit in zip(self.fuzzers, self.digits(self.index)):
+            fuzzer.seek(digit)
+            subject = fuzzer.fuzz(subject)
+        return subject
+
+
 class AbstractFuzzer:
 
     def __init__(self):
@@ -105,11 +233,20 @@ class AbstractFuzzer:
     def total(self):
         raise Exception('No totals for you!')
 
+    def position(self):
+        raise Exception('No positions for you!')
+
+    def seek(self, position):
+        raise Exception('No positions for you!')
+
+    def split(self, n):
+        return split_range(self.total(), n)
+
     def get_state(self):
-        raise Exception('No states for you!')
+        return '{}:{}'.format(self.prefix, self.position())
 
     def set_state(self, state):
-        raise Exception('No states for you!')
+        self.seek(parse_state(self.prefix, state))
 
     def ready(self):
         raise Exception('No fuzzing for you!')
@@ -124,7 +261,131 @@ class AbstractFuzzer:
         raise Exception('No fuzzing for you!')
 
 
-# BoringFuzzer has a specified set of values which it uses for fuzzing
+# Value sources provide values for BoringFuzzer on demand,
+# a source has a length and returns a value by an index,
+# a list is a source as well
+
+# large strings are built once, and then shared by all sources
+@functools.lru_cache(maxsize = 64)
+def repeat(unit, count, prefix = '', suffix = ''):
+    return prefix + unit * count + suffix
+
+
+# CharRange returns single characters with codes from start to end (exclusive)
+class CharRange:
+
+    def __init__(self, start = 0, end = 256):
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return max(0, self.end - self.start)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError('CharRange index out of range')
+        return chr(self.start + index)
+
+
+# Repeat returns one string which is a unit repeated a number of times
+class Repeat:
+
+    def __init__(self, unit, count, prefix = '', suffix = ''):
+        self.unit = unit
+        self.count = count
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def __len__(self):
+        return 1
+
+    def __getitem__(self, index):
+        if index != 0:
+            raise IndexError('Repeat index out of range')
+        return repeat(self.unit, self.count, self.prefix, self.suffix)
+
+
+# SizeSweep returns strings which are a unit repeated 0, 1, and then 2^k - 1, 2^k
+# and 2^k + 1 times up to a max count, so that boundaries of buffers are tested
+class SizeSweep:
+
+    def __init__(self, unit, max_count, prefix = '', suffix = ''):
+        self.unit = unit
+        self.prefix = prefix
+        self.suffix = suffix
+        counts = {0, 1}
+        size = 2
+        while size <= max_count:
+            counts.update((size - 1, size, size + 1))
+            size *= 2
+        self.counts = sorted(count for count in counts if count <= max_count)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, index):
+        return repeat(self.unit, self.counts[index], self.prefix, self.suffix)
+
+
+# WordList returns lines of a file, only offsets of the lines are kept in memory,
+# they're found when the list is used for the first time
+#
+# The file is memory-mapped until the list is closed, it can be used
+# as a context manager, and it's opened again if it's used after closing
+class WordList:
+
+    def __init__(self, path, encoding = 'utf-8'):
+        self.path = path
+        self.encoding = encoding
+        self.file = None
+        self.data = None
+        self.offsets = None
+
+    def index(self):
+        if self.offsets is not None:
+            return
+
+        self.file = open(self.path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if size > 0 else b''
+        self.offsets = array.array('Q', [0])
+        position = self.data.find(b'\n')
+        while position >= 0:
+            self.offsets.append(position + 1)
+            position = self.data.find(b'\n', position + 1)
+        if self.offsets[-1] < size:
+            self.offsets.append(size)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.data = None
+        self.offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        self.index()
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        self.index()
+        if index < 0 or index >= len(self.offsets) - 1:
+            raise IndexError('WordList index out of range')
+        line = self.data[self.offsets[index]:self.offsets[index + 1]]
+        return line.rstrip(b'\r\n').decode(self.encoding, 'replace')
+
+
+# BoringFuzzer has a specified set of values which it uses for fuzzing,
+# values are taken from sources, a position where each source ends is kept,
+# so that a value can be found without building a list of all values
 class BoringFuzzer(AbstractFuzzer):
 
     def __init__(self):
@@ -132,50 +393,54 @@ class BoringFuzzer(AbstractFuzzer):
         self.action = None
         self.prefix = 'boring_fuzzer'
         self.index = 0
-        self.values = []
+        self.sources = []
+        self.ends = []
 
     def add_values(self, values):
         if isinstance(values, list):
-            for value in values:
-                self.values.append(value)
+            # a copy is kept, so that a caller can't change values later
+            self.add_source(list(values))
         else:
             raise Exception('You are supposed to give me a list!')
 
         return self
 
+    def add_source(self, source):
+        self.ends.append(self.total() + len(source))
+        self.sources.append(source)
+        return self
+
     def set_action(self, action):
         self.action = action
 
     def total(self):
-        return len(self.values)
+        return self.ends[-1] if self.ends else 0
 
-    def get_state(self):
-        return '{}:{}'.format(self.prefix, self.index)
+    def position(self):
+        return self.index
 
-    def set_state(self, state):
-        if not state.startswith(self.prefix):
-            raise Exception('What the hell? State does not start with "{}"'.format(self.prefix))
-
-        if ':' not in state:
-            raise Exception('What the hell? State does not have ":"')
-
-        self.index = int(state[state.index(':'):])
+    def seek(self, position):
+        if position < 0 or position > self.total():
+            raise Exception('What the hell? Position {} is out of range'.format(position))
+        self.index = position
 
     def ready(self):
-        return self.index < len(self.values)
+        return self.index < self.total()
 
     def reset(self):
         self.index = 0
 
     def next(self):
-        if self.index == len(self.values) - 1:
+        if self.index == self.total() - 1:
             return False
 
         self.index += 1
         return True
 
     def get_fuzzed_data(self):
-        return self.values[self.index]
+        source = bisect.bisect_right(self.ends, self.index)
+        start = self.ends[source - 1] if source > 0 else 0
+        return self.sources[source][self.index - start]
 
     def fuzz(self, subject):
         if self.action:
@@ -185,41 +450,49 @@ class BoringFuzzer(AbstractFuzzer):
         raise Exception('You should have told me how I can fuzz')
 
 
+# optional sources are added after the default values,
+# so that positions of the default values don't change
+
 class RequestMethodFuzzer(BoringFuzzer):
 
-    def __init__(self):
+    def __init__(self, size_sweep = False):
         super().__init__()
         self.set_prefix('request_method')
         self.set_action(lambda request, fuzzed: request.set_method(fuzzed))
-        self.add_values([
-            '',
-            'X' * 100000,
-            'GET\x00'
-        ])
-        self.add_values([chr(code) for code in range(0, 256)])
+        self.add_values([''])
+        self.add_source(Repeat('X', 100000))
+        self.add_values(['GET\x00'])
+        self.add_source(CharRange(0, 256))
+        if size_sweep:
+            self.add_source(SizeSweep('X', 100000))
 
 
+# a word list (WordList) adds paths from a file
 class RequestPathFuzzer(BoringFuzzer):
 
-    def __init__(self):
+    def __init__(self, size_sweep = False, word_list = None):
         super().__init__()
         self.set_prefix('request_path')
         self.set_action(lambda request, fuzzed: request.set_path(fuzzed))
+        self.add_values([''])
+        self.add_source(Repeat('/x', 100000))
         self.add_values([
-            '',
-            '/x' * 100000,
             '/xxx\x00',
             '/etc/passwd',
             '{}etc/passwd'.format('../' * 20),
             '.',
             '..'
         ])
-        self.add_values([chr(code) for code in range(0, 256)])
+        self.add_source(CharRange(0, 256))
+        if size_sweep:
+            self.add_source(SizeSweep('/x', 100000))
+        if word_list is not None:
+            self.add_source(word_list)
 
 
 class RequestVersionFuzzer(BoringFuzzer):
 
-    def __init__(self):
+    def __init__(self, size_sweep = False):
         super().__init__()
         self.set_prefix('request_version')
         self.set_action(lambda request, fuzzed: request.set_version(fuzzed))
@@ -231,23 +504,25 @@ class RequestVersionFuzzer(BoringFuzzer):
             'HTTP/1.'
             'HTTP/1.1\x00',
             'HTTP/100000.1',
-            'HTTP/1.100000',
-            'H{}P/1.1'.format('T' * 100000)
+            'HTTP/1.100000'
         ])
-        self.add_values([chr(code) for code in range(0, 256)])
+        self.add_source(Repeat('T', 100000, 'H', 'P/1.1'))
+        self.add_source(CharRange(0, 256))
+        if size_sweep:
+            self.add_source(SizeSweep('T', 100000, 'H', 'P/1.1'))
 
 
 class HostnameFuzzer(BoringFuzzer):
 
-    def __init__(self):
+    def __init__(self, size_sweep = False):
         super().__init__()
         self.set_prefix('request_host')
         self.set_action(lambda request, fuzzed: request.set_host(fuzzed))
-        self.add_values([
-            '',
-            '{}.com'.format('x' * 1200),
-            '{}com'.format('x.' * 100),
-            'жопа.ком'
-        ])
-        self.add_values([chr(code) for code in range(0, 256)])
+        self.add_values([''])
+        self.add_source(Repeat('x', 1200, suffix = '.com'))
+        self.add_source(Repeat('x.', 100, suffix = 'com'))
+        self.add_values(['жопа.ком'])
+        self.add_source(CharRange(0, 256))
+        if size_sweep:
+            self.add_source(SizeSweep('x', 1200, suffix = '.com'))
 
@@ -1,8 +1,18 @@
 #!/usr/bin/python
 
-import textwrap
-import config
+import bisect
+import collections
+import hashlib
+import itertools
 import random
+import struct
+import tracer
+
+# NumPy is optional, it's used only by NumpyByteArrayFuzzer
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class AbstractTest:
@@ -12,10 +22,11 @@ class AbstractTest:
     def description(self): return 'Here should be a description but someone was too lazy!'
 
     def info(self, *messages):
-        print_with_indent(self.__class__.__name__, messages[0], messages[1:])
+        tracer.info(self.__class__.__name__, *messages)
 
     def achtung(self, *messages):
-        print_with_indent(self.__class__.__name__, 'Achtung!!! {}'.format(messages[0]), messages[1:])
+        tracer.achtung(self.__class__.__name__,
+                       tracer.Message('Achtung!!! {}', messages[0]), *messages[1:])
 
 
 def truncate(data):
@@ -25,60 +36,354 @@ def truncate(data):
     return data
 
 def verbose(*args):
-    if config.current.verbose:
-        if len(args) == 0:
-            return
-        elif len(args) == 1:
-            print(args[0])
-        elif len(args) == 2:
-            verbose_with_prefix(args[0], args[1])
-        else:
-            verbose_with_indent(args[0], args[1], args[2:])
+    if not tracer.enabled(tracer.VERBOSE):
+        return
+    if len(args) == 0:
+        return
+    elif len(args) == 1:
+        tracer.writer.write(str(args[0]))
+    elif len(args) == 2:
+        verbose_with_prefix(args[0], args[1])
+    else:
+        verbose_with_indent(args[0], args[1], args[2:])
 
 
 def print_with_prefix(prefix, message):
-    print('[{0:s}] {1}'.format(prefix, message))
+    tracer.info(prefix, message)
 
 
 def verbose_with_prefix(prefix, message):
-    if config.current.verbose:
-        print_with_prefix(prefix, message)
+    tracer.verbose(prefix, message)
 
 
 def print_with_indent(prefix, first_message, other_messages):
-    formatted_prefix = '[{0:s}] '.format(prefix)
-    print('{0:s}{1}'.format(formatted_prefix, first_message))
-    if len(other_messages) > 0:
-        indent = ' ' * len(formatted_prefix)
-        wrapper = textwrap.TextWrapper(
-            initial_indent=indent, subsequent_indent=indent, width=70)
-        for message in other_messages:
-            print(wrapper.fill(message))
+    tracer.info(prefix, first_message, *other_messages)
 
 
 def verbose_with_indent(prefix, first_message, other_messages):
-    if config.current.verbose:
-        print_with_indent(prefix, first_message, other_messages)
+    tracer.verbose(prefix, first_message, *other_messages)
 
 
 def bytes2hex(data):
     return ' '.join('{:02x}'.format(b) for b in data)
 
 
+# returns a hex dump which is built only if it's actually written out
+def hexdump(data):
+    return tracer.Lazy(bytes2hex, data)
+
+
+# returns a seed which depends only on a seed of a run, a fuzzer id and a test number,
+# so that any test can be generated without generating previous tests,
+# and tests can be generated in any order or in parallel
+def test_seed(seed, fuzzer_id, test):
+    digest = hashlib.blake2b('{0}:{1}:{2:d}'.format(seed, fuzzer_id, test).encode(),
+                             digest_size = 16).digest()
+    return int.from_bytes(digest, byteorder='big')
+
+
+# returns a new pseudo-random generator for a test, see test_seed()
+def test_random(seed, fuzzer_id, test):
+    return random.Random(test_seed(seed, fuzzer_id, test))
+
+
+# AFL-style mutation operators, each of them changes data in place,
+# a fuzzer provides a number of bytes to change and ignored bytes
+
+# values which often trigger edge cases, 16-bit and 32-bit values include
+# limits of HTTP/2 frame lengths, stream ids, window sizes and settings
+interesting_8 = (-128, -1, 0, 1, 16, 32, 64, 100, 127)
+interesting_16 = (-32768, -129, 128, 255, 256, 512, 1000, 1024, 4096,
+                  16384, 32767, 65535)
+interesting_32 = (-2147483648, -100663046, -32769, 32768, 65536, 100663045,
+                  2147483647, 0xFFFFFF, 0x1000000, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF)
+
+max_arith = 35
+
+
+# returns a random position of a field of specified width which doesn't start
+# with an ignored byte, or None if such a position was not found
+def random_position(data, random_generator, fuzzer, width = 1, attempts = 16):
+    if len(data) < width:
+        return None
+    for attempt in range(attempts):
+        pos = random_generator.randint(0, len(data) - width)
+        if not fuzzer.isignored(data[pos]):
+            return pos
+    return None
+
+
+def overwrite_bytes(data, random_generator, fuzzer):
+    for i in range(fuzzer.mutation_count(random_generator)):
+        pos = random_position(data, random_generator, fuzzer)
+        if pos is not None:
+            data[pos] = random_generator.randint(0, 255)
+
+
+def flip_bits(data, random_generator, fuzzer):
+    for i in range(max(1, fuzzer.mutation_count(random_generator))):
+        pos = random_position(data, random_generator, fuzzer)
+        if pos is not None:
+            data[pos] ^= 1 << random_generator.randrange(8)
+
+
+# adds or subtracts a small number to a big-endian field
+def arith(width):
+    def mutate(data, random_generator, fuzzer):
+        pos = random_position(data, random_generator, fuzzer, width)
+        if pos is None:
+            return
+        delta = random_generator.randint(1, max_arith)
+        if random_generator.random() < 0.5:
+            delta = -delta
+        value = int.from_bytes(data[pos:pos + width], 'big') + delta
+        data[pos:pos + width] = (value % (1 << (8 * width))).to_bytes(width, 'big')
+    return mutate
+
+
+# replaces a big-endian field with an interesting value
+def interesting(width, values):
+    def mutate(data, random_generator, fuzzer):
+        pos = random_position(data, random_generator, fuzzer, width)
+        if pos is None:
+            return
+        value = random_generator.choice(values)
+        data[pos:pos + width] = (value % (1 << (8 * width))).to_bytes(width, 'big')
+    return mutate
+
+
+# returns a random length of a block, blocks are usually short
+def block_length(data, random_generator):
+    return random_generator.randint(1, max(1, len(data) // 16))
+
+
+def insert_block(data, random_generator, fuzzer):
+    pos = random_generator.randint(0, len(data))
+    length = block_length(data, random_generator)
+    if len(data) > 0 and random_generator.random() < 0.5:
+        start = random_generator.randint(0, len(data) - 1)
+        block = data[start:start + length]
+    else:
+        block = random_generator.randbytes(length)
+    data[pos:pos] = block
+
+
+def delete_block(data, random_generator, fuzzer):
+    if len(data) < 2:
+        return
+    pos = random_generator.randint(0, len(data) - 1)
+    del data[pos:pos + block_length(data, random_generator)]
+
+
+def duplicate_block(data, random_generator, fuzzer):
+    if len(data) == 0:
+        return
+    pos = random_generator.randint(0, len(data) - 1)
+    block = data[pos:pos + block_length(data, random_generator)]
+    data[pos:pos] = block
+
+
+# replaces a tail of data with a tail of another input,
+# inputs which caused new reactions are preferred
+def splice(data, random_generator, fuzzer):
+    inputs = fuzzer.scheduler.corpus if fuzzer.scheduler.corpus else (fuzzer.data,)
+    other = random_generator.choice(inputs)
+    if len(data) == 0 or len(other) == 0:
+        return
+    pos = random_generator.randint(0, len(data) - 1)
+    start = random_generator.randint(0, len(other) - 1)
+    data[pos:] = other[start:]
+
+
+default_operators = collections.OrderedDict((
+    ('overwrite', overwrite_bytes),
+    ('bitflip', flip_bits),
+    ('arith8', arith(1)),
+    ('arith16', arith(2)),
+    ('arith32', arith(4)),
+    ('interesting8', interesting(1, interesting_8)),
+    ('interesting16', interesting(2, interesting_16)),
+    ('interesting32', interesting(4, interesting_32)),
+    ('insert', insert_block),
+    ('delete', delete_block),
+    ('duplicate', duplicate_block),
+    ('splice', splice),
+))
+
+
+# MutationScheduler applies a stack of mutation operators to a test,
+# and gives more energy to operators which produced new reactions
+#
+# An operator is chosen with a probability which is proportional to its weight,
+# a weight is a smoothed ratio of rewards to uses plus a minimal weight,
+# so that unlucky operators are still used sometimes.
+# Since weights depend on feedback, tests depend not only on a seed,
+# a fuzzer id and a test number, but also on reactions to previous tests.
+class MutationScheduler:
+
+    def __init__(self, operators = None, max_stack = 4, min_weight = 0.1,
+                 max_history = 1024, max_corpus = 64):
+        self.operators = operators if operators else default_operators
+        self.names = list(self.operators.keys())
+        self.max_stack = max_stack
+        self.min_weight = min_weight
+        self.max_history = max_history
+        self.max_corpus = max_corpus
+        self.uses = dict.fromkeys(self.names, 0)
+        self.rewards = dict.fromkeys(self.names, 0)
+        self.weights = [self.weight(name) for name in self.names]
+
+        # operators and results of recent tests, they're used for feedback
+        self.history = collections.OrderedDict()
+
+        # tests which caused new reactions, they're used for splicing
+        self.corpus = []
+
+    def weight(self, name):
+        return (self.rewards[name] + 1.0) / (self.uses[name] + 1.0) + self.min_weight
+
+    def mutate(self, data, random_generator, fuzzer, test):
+        stack = random_generator.randint(1, self.max_stack)
+        names = random_generator.choices(self.names, self.weights, k = stack)
+        for name in names:
+            self.operators[name](data, random_generator, fuzzer)
+            self.uses[name] += 1
+
+        self.history[test] = (names, bytes(data))
+        if len(self.history) > self.max_history:
+            self.history.popitem(last = False)
+        self.weights = [self.weight(name) for name in self.names]
+
+    # tells the scheduler if a test caused a new reaction
+    def feedback(self, test, interesting):
+        entry = self.history.pop(test, None)
+        if entry is None or not interesting:
+            return
+
+        names, data = entry
+        for name in names:
+            self.rewards[name] += 1
+        self.weights = [self.weight(name) for name in self.names]
+
+        self.corpus.append(data)
+        if len(self.corpus) > self.max_corpus:
+            self.corpus.pop(0)
+
+    def __repr__(self):
+        return ', '.join('{0}: {1:d}/{2:d}'.format(name, self.rewards[name], self.uses[name])
+                         for name in self.names)
+
+
+# PatchedBytes is a test which is kept as a list of (offset, byte) patches
+# over an immutable template, so that memory and copy cost depend only on
+# a number of changed bytes. Patches are sorted by offset, and
+# if there are several patches for the same offset, the last one wins
+class PatchedBytes:
+
+    # a number of patches, and then an offset and a value for each patch
+    count = struct.Struct('>I')
+    patch = struct.Struct('>IB')
+
+    def __init__(self, template, patches):
+        self.template = template
+        self.patches = sorted(dict(patches).items())
+
+    def __len__(self):
+        return len(self.template)
+
+    def __iter__(self):
+        return iter(self.tobytes())
+
+    # returns a list of buffers which make up the test: slices of the template
+    # which are not changed, and runs of adjacent patched bytes
+    def segments(self):
+        template = memoryview(self.template)
+        segments = []
+        position = 0
+        run = bytearray()
+        run_start = 0
+        for offset, value in self.patches:
+            if run and offset == run_start + len(run):
+                run.append(value)
+                continue
+            if run:
+                if run_start > position:
+                    segments.append(template[position:run_start])
+                segments.append(bytes(run))
+                position = run_start + len(run)
+            run = bytearray((value,))
+            run_start = offset
+        if run:
+            if run_start > position:
+                segments.append(template[position:run_start])
+            segments.append(bytes(run))
+            position = run_start + len(run)
+        if position < len(template):
+            segments.append(template[position:])
+        return segments
+
+    # writes the test to a buffer starting from specified offset,
+    # and returns an offset right after the test
+    def write_into(self, buffer, offset = 0):
+        end = offset + len(self.template)
+        buffer[offset:end] = self.template
+        for position, value in self.patches:
+            buffer[offset + position] = value
+        return end
+
+    def tobytes(self):
+        fuzzed = bytearray(len(self.template))
+        self.write_into(fuzzed)
+        return fuzzed
+
+    # sends the test with scatter-gather I/O, the template is not copied
+    def send(self, client):
+        client.send_parts(self.segments())
+
+    # stores only patches, the template should be kept separately
+    def serialize(self):
+        data = bytearray(PatchedBytes.count.size
+                         + PatchedBytes.patch.size * len(self.patches))
+        PatchedBytes.count.pack_into(data, 0, len(self.patches))
+        offset = PatchedBytes.count.size
+        for patch in self.patches:
+            PatchedBytes.patch.pack_into(data, offset, *patch)
+            offset += PatchedBytes.patch.size
+        return bytes(data)
+
+    @staticmethod
+    def deserialize(template, data):
+        (n,) = PatchedBytes.count.unpack_from(data, 0)
+        start = PatchedBytes.count.size
+        end = start + PatchedBytes.patch.size * n
+        if end > len(data):
+            raise Exception('Truncated patch list')
+        patches = list(PatchedBytes.patch.iter_unpack(memoryview(data)[start:end]))
+        for offset, value in patches:
+            if offset >= len(template):
+                raise Exception('Patch offset {0:d} is out of template'.format(offset))
+        return PatchedBytes(template, patches)
+
+
+# DumbByteArrayFuzzer overwrites random bytes, or applies mutation operators
+# chosen by a scheduler if it's specified
 class DumbByteArrayFuzzer:
 
     def __init__(self, data, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
-                 start_test = 0, ignored_bytes = ()):
+                 start_test = 0, ignored_bytes = (), fuzzer_id = None, scheduler = None):
         # TODO: check if parameters are valid
         self.start_test = start_test
         self.test = start_test
         self.data = data
         self.seed = seed
+        self.fuzzer_id = fuzzer_id if fuzzer_id else DumbByteArrayFuzzer.__name__
         self.min_bytes = int(float(min_ratio) * int(len(data)));
         self.max_bytes = int(float(max_ratio) * int(len(data)));
-        self.verbose('min bytes to change: {0:d}'.format(self.min_bytes))
-        self.verbose('max bytes to change: {0:d}'.format(self.max_bytes))
+        self.verbose(tracer.Message('min bytes to change: {0:d}', self.min_bytes))
+        self.verbose(tracer.Message('max bytes to change: {0:d}', self.max_bytes))
         self.ignored_bytes = ignored_bytes
+        self.template = bytes(data)
+        self.scheduler = scheduler
         self.reset()
 
     def set_test(self, test):
@@ -86,48 +391,185 @@ class DumbByteArrayFuzzer:
 
     def reset(self):
         self.test = self.start_test
-        self.random = random.Random()
-        self.random.seed(self.seed)
-        self.random_n = random.Random()
-        self.random_position = random.Random()
-        self.random_byte = random.Random()
 
     def next(self):
-        fuzzed = self.data[:]
-        seed = self.random.random() + self.test
-        if self.min_bytes == self.max_bytes:
-            n = self.min_bytes
-        else:
-            self.random_n.seed(seed)
-            n = self.random_n.randrange(self.min_bytes, self.max_bytes)
-        self.random_position.seed(seed)
-        self.random_byte.seed(seed)
+        if self.scheduler is not None:
+            random_generator = test_random(self.seed, self.fuzzer_id, self.test)
+            fuzzed = bytearray(self.data)
+            self.scheduler.mutate(fuzzed, random_generator, self, self.test)
+            self.test += 1
+            return fuzzed
+
+        return self.next_patch().tobytes()
+
+    # returns a patch list over the original data for the next test,
+    # the data itself is not copied,
+    # mutation operators may change a length of data, so with a scheduler,
+    # a whole test is returned as a template without patches
+    def next_patch(self):
+        if self.scheduler is not None:
+            return PatchedBytes(self.next(), ())
+        return PatchedBytes(self.template, self.mutations().items())
+
+    # tells the scheduler if a test caused a new reaction
+    def feedback(self, test, interesting):
+        if self.scheduler is not None:
+            self.scheduler.feedback(test, interesting)
+
+    # returns a dict which maps positions to new values of bytes for the current test
+    def mutations(self):
+        random_generator = test_random(self.seed, self.fuzzer_id, self.test)
+        n = self.mutation_count(random_generator)
+        last = len(self.data) - 1
+        patches = {}
         i = 0
         while (i < n):
-            pos = self.random_position.randint(0, len(fuzzed) - 1)
-            if self.isignored(fuzzed[pos]):
+            pos = random_generator.randint(0, last)
+            if self.isignored(patches.get(pos, self.data[pos])):
                 continue
-            b = self.random_byte.randint(0, 255)
-            fuzzed[pos] = b
+            b = random_generator.randint(0, 255)
+            patches[pos] = b
             i += 1
         self.test += 1
-        return fuzzed
+        return patches
+
+    # returns a number of bytes to change
+    def mutation_count(self, random_generator):
+        if self.min_bytes == self.max_bytes:
+            return self.min_bytes
+        return random_generator.randrange(self.min_bytes, self.max_bytes)
 
     def isignored(self, symbol):
         return symbol in self.ignored_bytes
 
     def verbose(self, message):
-        verbose(DumbByteArrayFuzzer.__name__, message)
+        tracer.verbose(DumbByteArrayFuzzer.__name__, message)
+
+
+# NumpyByteArrayFuzzer does the same as DumbByteArrayFuzzer but with NumPy
+#
+# All positions and values for a test are drawn in one batch,
+# ignored bytes are masked out once with a precomputed table,
+# and mutations are applied with fancy indexing.
+# Output depends only on a seed, a fuzzer id and a test number,
+# but it's not the same as output of DumbByteArrayFuzzer
+class NumpyByteArrayFuzzer:
+
+    def __init__(self, data, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
+                 start_test = 0, ignored_bytes = (), fuzzer_id = None):
+        if numpy is None:
+            raise Exception('NumPy is not available')
+
+        self.start_test = start_test
+        self.test = start_test
+        self.data = data
+        self.seed = seed
+        self.fuzzer_id = fuzzer_id if fuzzer_id else NumpyByteArrayFuzzer.__name__
+        self.min_bytes = int(float(min_ratio) * int(len(data)));
+        self.max_bytes = int(float(max_ratio) * int(len(data)));
+        self.verbose(tracer.Message('min bytes to change: {0:d}', self.min_bytes))
+        self.verbose(tracer.Message('max bytes to change: {0:d}', self.max_bytes))
+        self.ignored_bytes = ignored_bytes
+
+        self.template = bytes(data)
+        self.data_array = numpy.frombuffer(self.template, dtype = numpy.uint8)
+        ignored = numpy.zeros(256, dtype = bool)
+        for symbol in ignored_bytes:
+            ignored[ord(symbol) if isinstance(symbol, str) else symbol] = True
+
+        # positions of bytes which can be changed
+        self.positions = numpy.flatnonzero(~ignored[self.data_array])
+
+        self.reset()
+
+    def set_test(self, test):
+        self.test = test
+
+    def reset(self):
+        self.test = self.start_test
+
+    def next(self):
+        fuzzed = self.data_array.copy()
+        positions, values = self.mutations()
+        fuzzed[positions] = values
+        return bytearray(fuzzed)
+
+    # returns a patch list over the original data for the next test,
+    # if a position was drawn twice, the last value wins like in next()
+    def next_patch(self):
+        positions, values = self.mutations()
+        return PatchedBytes(self.template, zip(positions.tolist(), values.tolist()))
+
+    # returns positions and new values of bytes for the current test
+    def mutations(self):
+        random_generator = numpy.random.default_rng(
+            test_seed(self.seed, self.fuzzer_id, self.test))
+        if self.min_bytes == self.max_bytes:
+            n = self.min_bytes
+        else:
+            n = int(random_generator.integers(self.min_bytes, self.max_bytes))
+
+        self.test += 1
+        if n <= 0 or len(self.positions) == 0:
+            return self.positions[:0], self.data_array[:0]
+
+        positions = self.positions[random_generator.integers(0, len(self.positions), n)]
+        values = random_generator.integers(0, 256, n, dtype = numpy.uint8)
+        return positions, values
+
+    # the NumPy backend only overwrites bytes, so feedback is ignored
+    def feedback(self, test, interesting):
+        pass
+
+    def verbose(self, message):
+        tracer.verbose(NumpyByteArrayFuzzer.__name__, message)
+
+
+# backend for byte array fuzzers which are created by create_byte_array_fuzzer()
+byte_array_backend = 'python'
+
+# if set, byte array fuzzers apply mutation operators chosen by a scheduler
+mutation_scheduler = False
+
+
+def use_numpy():
+    global byte_array_backend
+    if numpy is None:
+        raise Exception('NumPy is not available')
+    byte_array_backend = 'numpy'
+
+
+def use_scheduler():
+    global mutation_scheduler
+    mutation_scheduler = True
+
+
+# creates a byte array fuzzer with the current backend,
+# the NumPy backend doesn't support mutation operators,
+# so a scheduler takes precedence over it
+def create_byte_array_fuzzer(data, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
+                             start_test = 0, ignored_bytes = (), fuzzer_id = None):
+    if mutation_scheduler:
+        return DumbByteArrayFuzzer(data, seed, min_ratio, max_ratio,
+                                   start_test, ignored_bytes, fuzzer_id,
+                                   MutationScheduler())
+    if byte_array_backend == 'numpy':
+        return NumpyByteArrayFuzzer(data, seed, min_ratio, max_ratio,
+                                    start_test, ignored_bytes, fuzzer_id)
+    return DumbByteArrayFuzzer(data, seed, min_ratio, max_ratio,
+                               start_test, ignored_bytes, fuzzer_id)
 
 
 class DumbAsciiStringFuzzer:
 
     def __init__(self, string, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
-                 start_test = 0, ignored_symbols = ()):
+                 start_test = 0, ignored_symbols = (), fuzzer_id = None,
+                 scheduler = None):
         self.data = bytearray(string, 'ascii', 'ignore')
         self.ignored_bytes = ignored_symbols
         self.byte_array_fuzzer = DumbByteArrayFuzzer(
-                self.data, seed, min_ratio, max_ratio, start_test, self.ignored_bytes)
+                self.data, seed, min_ratio, max_ratio, start_test, self.ignored_bytes,
+                fuzzer_id if fuzzer_id else DumbAsciiStringFuzzer.__name__, scheduler)
 
     def set_test(self, test):
         self.byte_array_fuzzer.set_test(test)
@@ -138,21 +580,63 @@ class DumbAsciiStringFuzzer:
     def next(self):
         return self.byte_array_fuzzer.next()
 
+    def next_patch(self):
+        return self.byte_array_fuzzer.next_patch()
+
+    def feedback(self, test, interesting):
+        self.byte_array_fuzzer.feedback(test, interesting)
+
+
+# HeaderList keeps header fields as a list of (name, value) pairs,
+# so that names may repeat. It also keeps lengths of fields,
+# so that a field can be found by a position in all names and values
+# which are put one after another
+class HeaderList:
+
+    def __init__(self, headers):
+        if isinstance(headers, HeaderList):
+            headers = headers.fields
+        elif isinstance(headers, dict):
+            headers = headers.items()
+
+        self.fields = [(name, value) for name, value in headers]
+        self.lengths = [len(name) + len(value) for name, value in self.fields]
+
+    # returns ends of fields with specified indices if they're put one after another,
+    # a field which contains a position can be then found with a binary search
+    def ends(self, indices):
+        return list(itertools.accumulate(self.lengths[index] for index in indices))
 
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, index):
+        return self.fields[index]
+
+
+# DumbDictionaryFuzzer mutates names and values of headers,
+# headers can be a dictionary, or a list of (name, value) pairs if names repeat
+#
+# Fuzzed headers are returned as a list of (name, value) pairs. Only mutated fields
+# are copied, a position of a byte to mutate is found with a binary search
 class DumbDictionaryFuzzer:
 
     def __init__(self, dictionary, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0, ignored_symbols = (), ignored_keys = (),
-                 use_all = False):
+                 use_all = False, fuzzer_id = None):
         self.start_test = start_test
         self.test = start_test
         self.seed = seed
+        self.fuzzer_id = fuzzer_id if fuzzer_id else DumbDictionaryFuzzer.__name__
         self.dictionary = dictionary
+        self.headers = HeaderList(dictionary)
         self.ignored_keys = ignored_keys
         self.ignored_symbols = ignored_symbols
         self.min_ratio = min_ratio
         self.max_ratio = max_ratio
         self.use_all = use_all
+        self.all_indices = list(range(len(self.headers)))
+        self.all_ends = self.headers.ends(self.all_indices)
         self.reset()
 
     def set_test(self, test):
@@ -160,79 +644,51 @@ class DumbDictionaryFuzzer:
 
     def reset(self):
         self.test = self.start_test
-        self.random = random.Random()
-        self.random_n = random.Random()
-        self.random_position = random.Random()
-        self.random_byte = random.Random()
-        self.random_item = random.Random()
+
+    # strings are mutated only by overwriting symbols, so feedback is ignored
+    def feedback(self, test, interesting):
+        pass
 
     def next(self):
-        # generate seed for other pseudo-random generators
-        self.random.seed(self.seed * self.test)
-        seed = self.random.random()
+        self.random = test_random(self.seed, self.fuzzer_id, self.test)
 
+        # select headers
         if self.use_all:
-            fuzzed = self.dictionary.copy()
+            indices = self.all_indices
+            ends = self.all_ends
         else:
-            self.random_item.seed(seed)
-            fuzzed = {}
-            for key in self.dictionary:
-                if self.random_item.random() >= 0.5:
-                    fuzzed[key] = self.dictionary[key]
-
-        total_length = 0
-        for key in fuzzed:
-            total_length = total_length + len(key) + len(fuzzed[key])
+            indices = [index for index in self.all_indices if self.random.random() >= 0.5]
+            ends = self.headers.ends(indices)
 
+        total_length = ends[-1] if ends else 0
         min_bytes = int(float(self.min_ratio) * int(total_length));
         max_bytes = int(float(self.max_ratio) * int(total_length));
 
         if min_bytes == max_bytes:
             n = min_bytes
         else:
-            self.random_n.seed(seed)
-            n = self.random_n.randrange(min_bytes, max_bytes)
-
-        self.random_position.seed(seed)
-        self.random_byte.seed(seed)
-        i = 0
-        while (i < n):
-            pos = self.random_position.randint(0, total_length - 1)
-
-            for key in fuzzed:
-                try:
-                    if pos < len(key):
-                        if self.is_ignored_key(key):
-                            continue
-                        if self.is_ignored_symbol(key[pos]):
-                            continue
-                        fuzzed_key = self.fuzz_string(key, pos)
-                        value = fuzzed[key]
-                        del fuzzed[key]
-                        fuzzed[fuzzed_key] = value
-                        break
-                finally:
-                    pos = pos - len(key)
-                    if pos < 0:
-                        break
-
-                value = fuzzed[key]
-                try:
-                    if pos < len(value):
-                        if self.is_ignored_symbol(value[pos]):
-                            continue
-                        fuzzed_value = self.fuzz_string(value, pos)
-                        fuzzed[key] = fuzzed_value
-                        break
-                finally:
-                    pos = pos - len(value)
-                    if pos < 0:
-                        break
-
-            i += 1
+            n = self.random.randrange(min_bytes, max_bytes)
+
+        # mutated fields, the keys are positions in the selected headers
+        mutated = {}
+        for i in range(n):
+            pos = self.random.randint(0, total_length - 1)
+            selected = bisect.bisect_right(ends, pos)
+            pos = pos - (ends[selected] - self.headers.lengths[indices[selected]])
+
+            original_name = self.headers[indices[selected]][0]
+            name, value = mutated.get(selected, self.headers[indices[selected]])
+            if pos < len(original_name):
+                if self.is_ignored_key(original_name):
+                    continue
+                name = self.fuzz_string(name, pos)
+            else:
+                value = self.fuzz_string(value, pos - len(original_name))
+            mutated[selected] = (name, value)
 
         self.test += 1
-        return fuzzed
+        return [mutated.get(selected, self.headers[index])
+                for selected, index in enumerate(indices)]
 
     def is_ignored_key(self, key):
         return key in self.ignored_keys
@@ -240,13 +696,13 @@ class DumbDictionaryFuzzer:
     def is_ignored_symbol(self, symbol):
         return symbol in self.ignored_symbols
 
+    # replaces a symbol in a string with a random byte,
+    # non-ASCII bytes remove the symbol
     def fuzz_string(self, string, pos):
-        if self.is_ignored_symbol(string[pos]):
+        if pos >= len(string) or self.is_ignored_symbol(string[pos]):
             return string
-        fuzzed = bytearray(string, 'ascii', 'ignore')
-        b = self.random_byte.randint(0, 255)
-        fuzzed[pos] = b
-        return str(fuzzed, 'ascii', 'ignore')
+        b = self.random.randint(0, 255)
+        return string[:pos] + (chr(b) if b < 128 else '') + string[pos + 1:]
 
     def verbose(self, message):
-        verbose(DumbDictionaryFuzzer.__name__, message)
+        tracer.verbose(DumbDictionaryFuzzer.__name__, message)
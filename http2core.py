@@ -1,8 +1,14 @@
 #!/usr/bin/python
 
 import base64
+import collections
 import config
+import functools
+import mmap
+import os
+import struct
 import helper
+import tracer
 from hpack import Encoder
 
 # returns a client connection preface sequence
@@ -12,6 +18,524 @@ def getclientpreface():
 def encode_unsigned_integer(number, length):
     return number.to_bytes(length, byteorder='big', signed=False)
 
+# a frame header is a 24-bit length, an 8-bit type, 8-bit flags
+# and a 32-bit stream id, the length is packed as an 8-bit high part
+# and a 16-bit low part since struct doesn't have 24-bit integers
+frame_header = struct.Struct('>BHBBI')
+frame_header_length = frame_header.size    # 9 octets
+
+def encode_frame_header(length, frame_type, flags, stream_id):
+    return frame_header.pack(length >> 16, length & 0xFFFF, frame_type, flags, stream_id)
+
+def encode_frame_header_into(buffer, offset, length, frame_type, flags, stream_id):
+    frame_header.pack_into(buffer, offset,
+                           length >> 16, length & 0xFFFF, frame_type, flags, stream_id)
+
+# FrameBatch serializes a sequence of frames into one buffer which is re-used,
+# so that many frames can be sent with one call
+class FrameBatch:
+
+    def __init__(self, capacity = 65536):
+        self.buffer = bytearray(capacity)
+        self.length = 0
+
+    def clear(self):
+        self.length = 0
+
+    # makes sure that specified number of bytes can be added to the buffer
+    def reserve(self, length):
+        if self.length + length <= len(self.buffer):
+            return
+
+        # views returned by view() may still refer to the buffer,
+        # so a new buffer is created instead of resizing the current one
+        buffer = bytearray(max(2 * len(self.buffer), self.length + length))
+        buffer[:self.length] = self.buffer[:self.length]
+        self.buffer = buffer
+
+    # adds a frame, the payload is taken from the frame if not specified
+    def add(self, frame, payload = None):
+        if payload is None:
+            payload = frame.payload()
+        self.reserve(frame_header_length + len(payload))
+        self.length = frame.encode_into(self.buffer, self.length, payload)
+        return self
+
+    # adds a new frame which is made from a template (see FrameTemplate.new())
+    def add_template(self, template, trailer = None, **values):
+        self.reserve(template.length(trailer))
+        self.length = template.new_into(self.buffer, self.length, trailer, **values)
+        return self
+
+    # adds a test which is kept as patches over a template (helper.PatchedBytes),
+    # the template is copied right into the batch, if a frame is specified,
+    # then the test is a payload of the frame
+    def add_patched(self, patched, frame = None):
+        length = len(patched)
+        if frame is None:
+            self.reserve(length)
+        else:
+            self.reserve(frame_header_length + length)
+            encode_frame_header_into(self.buffer, self.length,
+                                     length, frame.frame_type, frame.flags, frame.stream_id)
+            self.length += frame_header_length
+        self.length = patched.write_into(self.buffer, self.length)
+        return self
+
+    # adds data as is, for example, a client connection preface
+    # or a frame which has been already encoded
+    def add_bytes(self, data):
+        length = len(data)
+        self.reserve(length)
+        self.buffer[self.length:self.length + length] = data
+        self.length += length
+        return self
+
+    # returns a view of all added frames, it's valid until the batch is changed
+    def view(self):
+        return memoryview(self.buffer)[:self.length]
+
+    def __len__(self):
+        return self.length
+
+# HeaderBlockCache keeps HPACK representations of header fields,
+# so that a header block can be put together from cached fields
+# instead of encoding all headers again
+#
+# A field is encoded with a new encoder which has an empty dynamic table.
+# This gives the same bytes as encoding the whole block with one encoder
+# as long as header names don't repeat in the block. If they do, then
+# the encoder would refer to the dynamic table, so such blocks are not cached.
+class HeaderBlockCache:
+
+    def __init__(self, max_size = 4096):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, headers):
+        if isinstance(headers, dict):
+            headers = headers.items()
+
+        names = set()
+        block = bytearray()
+        for name, value in headers:
+            if name in names:
+                return Encoder().encode(headers)
+            names.add(name)
+            block.extend(self.encode_field(name, value))
+
+        return bytes(block)
+
+    def encode_field(self, name, value):
+        key = (name, value)
+        encoded = self.entries.get(key)
+        if encoded is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return encoded
+
+        self.misses += 1
+        encoded = Encoder().encode([key])
+        self.entries[key] = encoded
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+        return encoded
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'hits: {0:d}, misses: {1:d}, cached fields: {2:d}'.format(
+            self.hits, self.misses, len(self.entries))
+
+# all frames share one cache
+header_block_cache = HeaderBlockCache()
+
+# HPACK static table (RFC 7541, Appendix A),
+# an index of an entry is its position in the table plus one
+hpack_static_table = (
+    (b':authority', b''),
+    (b':method', b'GET'),
+    (b':method', b'POST'),
+    (b':path', b'/'),
+    (b':path', b'/index.html'),
+    (b':scheme', b'http'),
+    (b':scheme', b'https'),
+    (b':status', b'200'),
+    (b':status', b'204'),
+    (b':status', b'206'),
+    (b':status', b'304'),
+    (b':status', b'400'),
+    (b':status', b'404'),
+    (b':status', b'500'),
+    (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'accept-language', b''),
+    (b'accept-ranges', b''),
+    (b'accept', b''),
+    (b'access-control-allow-origin', b''),
+    (b'age', b''),
+    (b'allow', b''),
+    (b'authorization', b''),
+    (b'cache-control', b''),
+    (b'content-disposition', b''),
+    (b'content-encoding', b''),
+    (b'content-language', b''),
+    (b'content-length', b''),
+    (b'content-location', b''),
+    (b'content-range', b''),
+    (b'content-type', b''),
+    (b'cookie', b''),
+    (b'date', b''),
+    (b'etag', b''),
+    (b'expect', b''),
+    (b'expires', b''),
+    (b'from', b''),
+    (b'host', b''),
+    (b'if-match', b''),
+    (b'if-modified-since', b''),
+    (b'if-none-match', b''),
+    (b'if-range', b''),
+    (b'if-unmodified-since', b''),
+    (b'last-modified', b''),
+    (b'link', b''),
+    (b'location', b''),
+    (b'max-forwards', b''),
+    (b'proxy-authenticate', b''),
+    (b'proxy-authorization', b''),
+    (b'range', b''),
+    (b'referer', b''),
+    (b'refresh', b''),
+    (b'retry-after', b''),
+    (b'server', b''),
+    (b'set-cookie', b''),
+    (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''),
+    (b'user-agent', b''),
+    (b'vary', b''),
+    (b'via', b''),
+    (b'www-authenticate', b''),
+)
+hpack_huffman_code_lengths = (
+    13, 23, 28, 28, 28, 28, 28, 28, 28, 24, 30, 28, 28, 30, 28, 28,
+    28, 28, 28, 28, 28, 28, 30, 28, 28, 28, 28, 28, 28, 28, 28, 28,
+    6, 10, 10, 12, 13, 6, 8, 11, 10, 10, 8, 11, 8, 6, 6, 6,
+    5, 5, 5, 6, 6, 6, 6, 6, 6, 6, 7, 8, 15, 6, 12, 10,
+    13, 6, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7, 7,
+    7, 7, 7, 7, 7, 7, 7, 7, 8, 7, 8, 13, 19, 13, 14, 6,
+    15, 5, 6, 5, 6, 5, 6, 6, 6, 5, 7, 7, 6, 6, 6, 5,
+    6, 7, 6, 5, 5, 6, 7, 7, 7, 7, 7, 15, 11, 14, 13, 28,
+    20, 22, 20, 20, 22, 22, 22, 23, 22, 23, 23, 23, 23, 23, 24, 23,
+    24, 24, 22, 23, 24, 23, 23, 23, 23, 21, 22, 23, 22, 23, 23, 24,
+    22, 21, 20, 22, 22, 23, 23, 21, 23, 22, 22, 24, 21, 22, 23, 23,
+    21, 21, 22, 21, 23, 22, 23, 23, 20, 22, 22, 22, 23, 22, 22, 23,
+    26, 26, 20, 19, 22, 23, 22, 25, 26, 26, 26, 27, 27, 26, 24, 25,
+    19, 21, 26, 27, 27, 26, 27, 24, 21, 21, 26, 26, 28, 27, 27, 27,
+    20, 24, 20, 21, 22, 21, 21, 23, 22, 22, 25, 25, 24, 24, 26, 23,
+    26, 27, 26, 26, 27, 27, 27, 27, 27, 28, 27, 27, 27, 27, 27, 26,
+    30,
+)
+
+hpack_static_table_size = len(hpack_static_table)
+hpack_static_fields = {}
+hpack_static_names = {}
+for index, field in enumerate(hpack_static_table, 1):
+    hpack_static_fields.setdefault(field, index)
+    hpack_static_names.setdefault(field[0], index)
+
+hpack_huffman_eos = 256
+
+# the HPACK Huffman code is canonical, so codes are restored from their lengths:
+# symbols are sorted by a code length, and each next code is the previous one
+# plus one, shifted left if the next code is longer
+def canonical_huffman_codes(lengths):
+    codes = [0] * len(lengths)
+    code = 0
+    previous_length = 0
+    for symbol in sorted(range(len(lengths)), key = lambda s: (lengths[s], s)):
+        code <<= lengths[symbol] - previous_length
+        codes[symbol] = code
+        previous_length = lengths[symbol]
+        code += 1
+    return tuple(codes)
+
+hpack_huffman_codes = canonical_huffman_codes(hpack_huffman_code_lengths)
+
+# encodes data with the HPACK Huffman code, the last octet is padded
+# with the most significant bits of EOS (all ones),
+# an EOS symbol, zero padding or extra padding octets make the string invalid
+def huffman_encode(data, eos = False, zero_padding = False, extra_padding = 0):
+    bits = 0
+    length = 0
+    for symbol in data:
+        bits = (bits << hpack_huffman_code_lengths[symbol]) | hpack_huffman_codes[symbol]
+        length += hpack_huffman_code_lengths[symbol]
+    if eos:
+        bits = (bits << hpack_huffman_code_lengths[hpack_huffman_eos]) \
+                | hpack_huffman_codes[hpack_huffman_eos]
+        length += hpack_huffman_code_lengths[hpack_huffman_eos]
+    padding = -length % 8 + 8 * extra_padding
+    bits <<= padding
+    if not zero_padding:
+        bits |= (1 << padding) - 1
+    return bits.to_bytes((length + padding) // 8, 'big')
+
+# writes an integer with an N-bit prefix (RFC 7541, section 5.1),
+# extra octets with zero bits make an overlong encoding of the same value
+# which is possible only if the value doesn't fit to the prefix
+def hpack_integer(block, value, prefix, pattern, extra = 0):
+    limit = (1 << prefix) - 1
+    if value < limit:
+        block.append(pattern | value)
+        return
+
+    block.append(pattern | limit)
+    value -= limit
+    while value >= 0x80:
+        block.append(0x80 | (value & 0x7F))
+        value >>= 7
+    if extra > 0:
+        block.append(0x80 | value)
+        block.extend(b'\x80' * (extra - 1))
+        block.append(0x00)
+    else:
+        block.append(value)
+
+# writes a string literal (RFC 7541, section 5.2),
+# a wrong length may be specified
+def hpack_string(block, data, huffman = False, length = None, extra = 0):
+    if length is None:
+        length = len(data)
+    hpack_integer(block, length, 7, 0x80 if huffman else 0x00, extra)
+    block.extend(data)
+
+def hpack_bytes(data):
+    if isinstance(data, str):
+        return data.encode('ascii', 'ignore')
+    return bytes(data)
+
+# HPackField keeps a header field and its representations which are used
+# by HPackGenerator, they are computed once
+class HPackField:
+
+    def __init__(self, name, value):
+        self.name = hpack_bytes(name)
+        self.value = hpack_bytes(value)
+        self.huffman_name = huffman_encode(self.name)
+        self.huffman_value = huffman_encode(self.value)
+        self.index = hpack_static_fields.get((self.name, self.value), 0)
+        self.name_index = hpack_static_names.get(self.name, 0)
+
+        # see RFC 7541, section 4.1
+        self.size = 32 + len(self.name) + len(self.value)
+
+# HPackGenerator writes header blocks directly at the representation level
+# instead of encoding headers with an HPACK encoder
+#
+# Each field is written with a randomly chosen representation: indexed
+# (from the static or the dynamic table), or a literal with incremental indexing,
+# without indexing or never indexed, a name may be indexed, and strings
+# may be Huffman-encoded. The generator follows the dynamic table,
+# so that indexed fields refer to existing entries.
+#
+# Some fields are written with a structural mutation, for example,
+# an overlong or huge integer, a wrong index or string length,
+# an invalid Huffman string, a misplaced dynamic table size update
+# or a truncated representation.
+class HPackGenerator:
+
+    indexed_field = 0
+    literal_with_indexing = 1
+    literal_without_indexing = 2
+    literal_never_indexed = 3
+
+    literals = (literal_with_indexing, literal_without_indexing, literal_never_indexed)
+
+    # first octet patterns and prefix lengths (RFC 7541, section 6)
+    representations = {
+        indexed_field:              (0x80, 7),
+        literal_with_indexing:      (0x40, 6),
+        literal_without_indexing:   (0x00, 4),
+        literal_never_indexed:      (0x10, 4),
+    }
+    size_update = (0x20, 5)
+
+    mutations = ('overlong integer', 'huge integer', 'bad index', 'bad length',
+                 'bad huffman', 'size update', 'truncated')
+
+    huge_integers = (2**31 - 1, 2**31, 2**32 - 1, 2**32, 2**63 - 1, 2**64 - 1, 2**64)
+
+    def __init__(self, headers, mutation_ratio = 0.05, max_table_size = 4096):
+        if isinstance(headers, dict):
+            headers = headers.items()
+        self.fields = [HPackField(name, value) for name, value in headers]
+        self.mutation_ratio = mutation_ratio
+        self.max_table_size = max_table_size
+
+    # returns a header block, it depends only on the random generator
+    def generate(self, random_generator):
+        block = bytearray()
+        self.dynamic_table = []     # newest entries first
+        self.table_size = 0
+        self.table_size_limit = self.max_table_size
+
+        # a dynamic table size update is allowed only at the beginning of a block
+        if random_generator.random() < self.mutation_ratio:
+            self.write_size_update(block, random_generator)
+
+        for field in self.fields:
+            mutation = None
+            if random_generator.random() < self.mutation_ratio:
+                mutation = random_generator.choice(HPackGenerator.mutations)
+            self.write_field(block, field, random_generator, mutation)
+
+        return block
+
+    def write_size_update(self, block, random_generator, valid = True):
+        pattern, prefix = HPackGenerator.size_update
+        if valid:
+            size = random_generator.choice((0, self.max_table_size // 2, self.max_table_size))
+            self.table_size_limit = size
+            self.evict()
+        else:
+            size = random_generator.choice(
+                (self.max_table_size + 1, random_generator.choice(HPackGenerator.huge_integers)))
+        hpack_integer(block, size, prefix, pattern)
+
+    def write_field(self, block, field, random_generator, mutation = None):
+        start = len(block)
+        extra = random_generator.randint(1, 8) if mutation == 'overlong integer' else 0
+
+        if mutation == 'bad index':
+            representation = random_generator.choice(
+                (HPackGenerator.indexed_field, ) + HPackGenerator.literals)
+            pattern, prefix = HPackGenerator.representations[representation]
+            last_index = hpack_static_table_size + len(self.dynamic_table)
+            index = random_generator.choice((0, last_index + 1 + random_generator.randrange(64)))
+            if representation == HPackGenerator.indexed_field or index > 0:
+                hpack_integer(block, index, prefix, pattern)
+            else:
+                # a literal with a zero index is followed by a name,
+                # so use an indexed field instead
+                hpack_integer(block, index, 7, 0x80)
+                return
+            if representation != HPackGenerator.indexed_field:
+                hpack_string(block, field.value)
+            return
+
+        # an indexed field is used only if there is no mutation of strings
+        index = 0
+        if mutation not in ('bad length', 'bad huffman'):
+            if field in self.dynamic_table and random_generator.random() < 0.5:
+                index = hpack_static_table_size + 1 + self.dynamic_table.index(field)
+            elif field.index > 0 and random_generator.random() < 0.5:
+                index = field.index
+
+        if index > 0:
+            if mutation == 'huge integer':
+                index = random_generator.choice(HPackGenerator.huge_integers)
+            pattern, prefix = HPackGenerator.representations[HPackGenerator.indexed_field]
+            hpack_integer(block, index, prefix, pattern, extra)
+        else:
+            representation = random_generator.choice(HPackGenerator.literals)
+            pattern, prefix = HPackGenerator.representations[representation]
+            if field.name_index > 0 and random_generator.random() < 0.5:
+                hpack_integer(block, field.name_index, prefix, pattern, extra)
+            else:
+                block.append(pattern)
+                self.write_string(block, field.name, field.huffman_name,
+                                  random_generator, None, extra)
+            self.write_string(block, field.value, field.huffman_value,
+                              random_generator, mutation, extra)
+            if representation == HPackGenerator.literal_with_indexing:
+                self.add_to_dynamic_table(field)
+
+        if mutation == 'size update':
+            self.write_size_update(block, random_generator, valid = False)
+        elif mutation == 'truncated' and len(block) - start > 1:
+            del block[random_generator.randrange(start + 1, len(block)):]
+
+    def write_string(self, block, data, huffman_data, random_generator,
+                     mutation = None, extra = 0):
+        huffman = random_generator.random() < 0.5
+        length = None
+        if mutation == 'bad huffman':
+            huffman = True
+            kind = random_generator.randrange(3)
+            huffman_data = huffman_encode(data, eos = kind == 0, zero_padding = kind == 1,
+                                          extra_padding = 1 if kind == 2 else 0)
+        elif mutation == 'bad length':
+            actual = len(huffman_data if huffman else data)
+            length = max(0, actual + random_generator.choice(
+                (-actual, -1, 1, random_generator.randrange(2, 2**16))))
+        elif mutation == 'huge integer':
+            length = random_generator.choice(HPackGenerator.huge_integers)
+        hpack_string(block, huffman_data if huffman else data, huffman, length, extra)
+
+    def add_to_dynamic_table(self, field):
+        self.dynamic_table.insert(0, field)
+        self.table_size += field.size
+        self.evict()
+
+    def evict(self):
+        while self.table_size > self.table_size_limit and self.dynamic_table:
+            self.table_size -= self.dynamic_table.pop().size
+
+# FrameTemplate keeps bytes of a frame which has a fixed layout,
+# new frames are made by copying the bytes and writing variable fields
+# at their offsets, so that the frame doesn't have to be encoded again
+class FrameTemplate:
+
+    # fields of a frame header, offsets are from the beginning of a frame
+    header_fields = {
+        'flags'     : (4, struct.Struct('>B')),
+        'stream_id' : (5, struct.Struct('>I'))
+    }
+
+    # offsets of payload fields are from the beginning of a payload
+    def __init__(self, frame, payload_fields):
+        self.data = bytes(frame.encode())
+        self.frame_type = frame.frame_type
+        self.flags = frame.flags
+        self.stream_id = frame.stream_id
+        self.fields = dict(FrameTemplate.header_fields)
+        for name, (offset, field) in payload_fields.items():
+            self.fields[name] = (frame_header_length + offset, field)
+
+    # returns a length of a new frame with a trailer
+    def length(self, trailer = None):
+        return len(self.data) + (len(trailer) if trailer else 0)
+
+    # writes a new frame with specified values of fields to a buffer
+    # starting from specified offset, and returns an offset right after the frame,
+    # a trailer is appended to the payload if specified
+    # (for example, debug data of a GOAWAY frame)
+    def new_into(self, buffer, offset, trailer = None, **values):
+        end = offset + len(self.data)
+        buffer[offset:end] = self.data
+        if trailer:
+            buffer[end:end + len(trailer)] = trailer
+            end += len(trailer)
+            encode_frame_header_into(buffer, offset, end - offset - frame_header_length,
+                                     self.frame_type, self.flags, self.stream_id)
+
+        for name, value in values.items():
+            field_offset, field = self.fields[name]
+            field.pack_into(buffer, offset + field_offset, value)
+
+        return end
+
+    # returns a new frame with specified values of fields
+    def new(self, trailer = None, **values):
+        data = bytearray(self.length(trailer))
+        self.new_into(data, 0, trailer, **values)
+        return data
+
 # Common HTTP/2 frame
 # See https://tools.ietf.org/html/rfc7540#section-4.1 for details
 class Frame:
@@ -29,35 +553,37 @@ class Frame:
         self.flags = flags
         self.stream_id = stream_id
 
-    def encode(self, payload):
-        data = bytearray()
-
-        # write 24 bits of payload length
+    # returns a 9-octet frame header for a payload of specified length
+    #
+    # the spec defines a stream id field at an unsigned 31-bit integer,
+    # and 1 bit is reserved and must be set to 0, but the header is written
+    # as an unsigned 32-bit integer, so the reserved bit can be fuzzed
+    def header(self, length):
+        return encode_frame_header(length, self.frame_type, self.flags, self.stream_id)
+
+    # writes a frame to a caller-provided buffer starting from specified offset,
+    # and returns an offset right after the frame
+    def encode_into(self, buffer, offset = 0, payload = None):
+        if payload is None:
+            payload = self.payload()
         length = len(payload)
-        encoded_length = encode_unsigned_integer(length, self.length_length)
-        self.verbose('create a frame: write a length ({0:d}): {1:s}'
-                       .format(length, helper.bytes2hex(encoded_length)))
-        data.extend(encoded_length)
-
-        # write a frame type (8 bits)
-        data.extend(encode_unsigned_integer(self.frame_type, self.type_length))
-
-        # write flags (8 bits)
-        data.extend(encode_unsigned_integer(self.flags, self.flags_length))
-
-        # write a stream id expressed as an unsigned 32-bit integer
-        # the spec defines a stream id field at an unsigned 31-bit integer,
-        # and 1 bit is reserved and must be set to 0
-        data.extend(encode_unsigned_integer(self.stream_id, self.stream_id_length))
-
-        # write payload
-        data.extend(payload)
+        encode_frame_header_into(buffer, offset,
+                                 length, self.frame_type, self.flags, self.stream_id)
+        start = offset + frame_header_length
+        end = start + length
+        buffer[start:end] = payload
+        return end
 
+    def encode(self, payload):
+        length = len(payload)
+        tracer.verbose(Frame.__name__,
+                       tracer.Message('create a frame: write a length ({0:d})', length))
+        data = bytearray(frame_header_length + length)
+        self.encode_into(data, 0, payload)
         return data
 
     def verbose(self, *messages):
-        helper.verbose_with_prefix(
-            Frame.__name__, messages[0])
+        tracer.verbose(Frame.__name__, messages[0])
 
 # HTTP/2 CONTINUATION frame
 # See https://tools.ietf.org/html/rfc7540#section-6.10 for details
@@ -84,7 +610,7 @@ class ContinuationFrame(Frame):
         self.headers = headers
 
     def encoded_headers(self):
-        return Encoder().encode(self.headers)
+        return header_block_cache.encode(self.headers)
 
     def payload(self):
         payload = bytearray()
@@ -95,7 +621,7 @@ class ContinuationFrame(Frame):
 
         self.verbose('write a continuation frame:',
                        'header block:          ',
-                       helper.bytes2hex(header_block))
+                       helper.hexdump(header_block))
 
         return payload
 
@@ -106,8 +632,7 @@ class ContinuationFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            ContinuationFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(ContinuationFrame.__name__, *messages)
 
 # HTTP/2 Data frame
 # See https://tools.ietf.org/html/rfc7540#section-6.1 for details
@@ -156,11 +681,11 @@ class DataFrame(Frame):
             padding = bytearray()
 
         self.verbose('write a data frame:',
-                       'padding length:    {0}'.format(helper.bytes2hex(padding_length)),
+                       tracer.Message('padding length:    {0}', helper.hexdump(padding_length)),
                        'data:              ',
-                       helper.bytes2hex(self.data),
+                       helper.hexdump(self.data),
                        'padding:           ',
-                       helper.bytes2hex(padding))
+                       helper.hexdump(padding))
 
         return payload
 
@@ -171,8 +696,7 @@ class DataFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DataFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(DataFrame.__name__, *messages)
 
 # HTTP/2 GoAway frame
 # See https://tools.ietf.org/html/rfc7540#section-6.8 for details
@@ -214,12 +738,20 @@ class GoAwayFrame(Frame):
             payload.extend(self.debug_data)
 
         self.verbose('write a goaway frame:',
-                       'last stream id: {0}'.format(self.last_stream_id),
-                       'error code:     {0}'.format(self.error_code),
-                       'debug data:     {0}'.format(helper.bytes2hex(self.debug_data)))
+                       tracer.Message('last stream id: {0}', self.last_stream_id),
+                       tracer.Message('error code:     {0}', self.error_code),
+                       tracer.Message('debug data:     {0}', helper.hexdump(self.debug_data)))
 
         return payload
 
+    # returns a template for GOAWAY frames, debug data can be added as a trailer
+    @staticmethod
+    def template():
+        return FrameTemplate(GoAwayFrame(0, 0), {
+            'last_stream_id' : (0, struct.Struct('>I')),
+            'error_code'     : (GoAwayFrame.__last_stream_id_length, struct.Struct('>I'))
+        })
+
     def get_default_flags(self):
         return 0x0
 
@@ -227,8 +759,7 @@ class GoAwayFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            GoAwayFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(GoAwayFrame.__name__, *messages)
 
 
 # HTTP/2 Headers frame
@@ -266,7 +797,7 @@ class HeadersFrame(Frame):
         self.headers = headers
 
     def encoded_headers(self):
-        return Encoder().encode(self.headers)
+        return header_block_cache.encode(self.headers)
 
     def payload(self):
         payload = bytearray()
@@ -305,13 +836,13 @@ class HeadersFrame(Frame):
             padding = bytearray()
 
         self.verbose('write a header frame:',
-                       'padding length:    {0}'.format(helper.bytes2hex(padding_length)),
-                       'stream dependency: {0}'.format(helper.bytes2hex(stream_dependency)),
-                       'weight:            {0}'.format(helper.bytes2hex(weight)),
+                       tracer.Message('padding length:    {0}', helper.hexdump(padding_length)),
+                       tracer.Message('stream dependency: {0}', helper.hexdump(stream_dependency)),
+                       tracer.Message('weight:            {0}', helper.hexdump(weight)),
                        'header block:      ',
-                       helper.bytes2hex(header_block),
+                       helper.hexdump(header_block),
                        'padding:           ',
-                       helper.bytes2hex(padding))
+                       helper.hexdump(padding))
 
         return payload
 
@@ -323,8 +854,7 @@ class HeadersFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            HeadersFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(HeadersFrame.__name__, *messages)
 
 # HTTP/2 Ping frame
 # See https://tools.ietf.org/html/rfc7540#section-6.7 for details
@@ -353,10 +883,16 @@ class PingFrame(Frame):
         payload = bytearray()
         payload.extend(self.data)
         self.verbose('write a ping frame:',
-                       'data:           {0}'.format(helper.bytes2hex(self.data)))
+                       tracer.Message('data:           {0}', helper.hexdump(self.data)))
 
         return payload
 
+    @staticmethod
+    def template():
+        return FrameTemplate(PingFrame(bytes(PingFrame.opaque_data_length)), {
+            'opaque_data' : (0, struct.Struct('>{0:d}s'.format(PingFrame.opaque_data_length)))
+        })
+
     def get_default_flags(self):
         return 0x0
 
@@ -364,8 +900,7 @@ class PingFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            PingFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(PingFrame.__name__, *messages)
 
 # HTTP/2 Priority frame
 # See https://tools.ietf.org/html/rfc7540#section-6.3 for details
@@ -406,8 +941,8 @@ class PriorityFrame(Frame):
         payload.extend(weight)
 
         self.verbose('write a priority frame:',
-                       'stream dependency: {0}'.format(helper.bytes2hex(stream_dependency)),
-                       'weight:            {0}'.format(helper.bytes2hex(weight)))
+                       tracer.Message('stream dependency: {0}', helper.hexdump(stream_dependency)),
+                       tracer.Message('weight:            {0}', helper.hexdump(weight)))
 
         return payload
 
@@ -419,8 +954,7 @@ class PriorityFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            PriorityFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(PriorityFrame.__name__, *messages)
 
 # HTTP/2 PUSH_PROMISE frame
 # See https://tools.ietf.org/html/rfc7540#section-6.6 for details
@@ -458,7 +992,7 @@ class PushPromiseFrame(Frame):
         self.headers = headers
 
     def encoded_headers(self):
-        return Encoder().encode(self.headers)
+        return header_block_cache.encode(self.headers)
 
     def payload(self):
         payload = bytearray()
@@ -486,12 +1020,12 @@ class PushPromiseFrame(Frame):
             padding = bytearray()
 
         self.verbose('write a push promise frame:',
-                       'padding length:     {0}'.format(helper.bytes2hex(padding_length)),
-                       'promised stream id: {0}'.format(helper.bytes2hex(promised_stream_id)),
+                       tracer.Message('padding length:     {0}', helper.hexdump(padding_length)),
+                       tracer.Message('promised stream id: {0}', helper.hexdump(promised_stream_id)),
                        'header block:          ',
-                       helper.bytes2hex(header_block),
+                       helper.hexdump(header_block),
                        'padding:               ',
-                       helper.bytes2hex(padding))
+                       helper.hexdump(padding))
 
         return payload
 
@@ -502,8 +1036,7 @@ class PushPromiseFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            PushPromiseFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(PushPromiseFrame.__name__, *messages)
 
 # HTTP/2 RST_STREAM frame
 # See https://tools.ietf.org/html/rfc7540#section-6.4 for details
@@ -532,6 +1065,12 @@ class RstStreamFrame(Frame):
     def encode(self):
         return Frame.encode(self, self.payload())
 
+    @staticmethod
+    def template(stream_id = 0x1):
+        return FrameTemplate(RstStreamFrame(stream_id, 0), {
+            'error_code' : (0, struct.Struct('>I'))
+        })
+
     def get_default_flags(self):
         # RST_STREAM frame doesn't define any flags
         return 0x0
@@ -624,10 +1163,16 @@ class WindowUpdateFrame(Frame):
         payload.extend(window_size_increment)
 
         self.verbose('write a window update frame:',
-                       'window size increment: {0}'.format(self.window_size_increment))
+                       tracer.Message('window size increment: {0}', self.window_size_increment))
 
         return payload
 
+    @staticmethod
+    def template(stream_id = 0x0):
+        return FrameTemplate(WindowUpdateFrame(stream_id), {
+            'window_size_increment' : (0, struct.Struct('>I'))
+        })
+
     def get_default_flags(self):
         return 0x0
 
@@ -635,10 +1180,481 @@ class WindowUpdateFrame(Frame):
         return Frame.encode(self, self.payload())
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            WindowUpdateFrame.__name__, messages[0], messages[1:])
+        tracer.verbose(WindowUpdateFrame.__name__, *messages)
+
+
+# flags which are used by received frames
+ack_flag = 0x1
+end_stream_flag = 0x1
+end_headers_flag = 0x4
+padded_flag = 0x8
+priority_flag = 0x20
+
+uint32 = struct.Struct('>I')
+settings_parameter = struct.Struct('>HI')
+
+# returns an unsigned 32-bit integer from a payload,
+# or None if the payload is too short
+def unpack_uint32(payload, offset = 0):
+    if len(payload) < offset + uint32.size:
+        return None
+    return uint32.unpack_from(payload, offset)[0]
+
+# removes a pad length field and padding from a payload if the frame is padded,
+# a payload is returned as is if the padding is not valid
+def strip_padding(payload, flags):
+    if flags & padded_flag == 0:
+        return payload
+    if len(payload) == 0 or payload[0] >= len(payload):
+        return payload
+    return payload[1:len(payload) - payload[0]]
+
+# FrameView gives access to fields of a received frame without copying them,
+# the payload is a memoryview over a receive buffer of a decoder,
+# so it's valid only until the decoder gets new data
+class FrameView:
+
+    name = 'UNKNOWN'
+
+    def __init__(self, length, frame_type, flags, stream_id, payload):
+        self.length = length
+        self.frame_type = frame_type
+        self.flags = flags
+        self.stream_id = stream_id
+        self.payload = payload
+
+    def has_flag(self, flag):
+        return self.flags & flag != 0
+
+    def __repr__(self):
+        return '{0} frame (0x{1:x}), stream id = {2:d}, flags = 0x{3:02x}, length = {4:d}'.format(
+            self.name, self.frame_type, self.stream_id, self.flags, self.length)
+
+class DataFrameView(FrameView):
+
+    name = 'DATA'
+
+    def data(self):
+        return strip_padding(self.payload, self.flags)
+
+class HeadersFrameView(FrameView):
+
+    name = 'HEADERS'
+
+    def header_block(self):
+        fragment = strip_padding(self.payload, self.flags)
+        if self.has_flag(priority_flag):
+            # skip a stream dependency and a weight
+            fragment = fragment[5:]
+        return fragment
+
+class PriorityFrameView(FrameView):
+
+    name = 'PRIORITY'
+
+    def dependency(self):
+        dependency = unpack_uint32(self.payload)
+        return None if dependency is None else dependency & 0x7FFFFFFF
+
+    def weight(self):
+        return self.payload[4] if len(self.payload) > 4 else None
+
+class RstStreamFrameView(FrameView):
+
+    name = 'RST_STREAM'
+
+    def error_code(self):
+        return unpack_uint32(self.payload)
+
+class SettingsFrameView(FrameView):
+
+    name = 'SETTINGS'
+
+    def is_ack(self):
+        return self.has_flag(ack_flag)
+
+    # returns a list of (identifier, value) pairs
+    def settings(self):
+        parameters = []
+        for offset in range(0, len(self.payload) - settings_parameter.size + 1,
+                            settings_parameter.size):
+            parameters.append(settings_parameter.unpack_from(self.payload, offset))
+        return parameters
+
+class PushPromiseFrameView(FrameView):
+
+    name = 'PUSH_PROMISE'
+
+    def promised_stream_id(self):
+        promised_stream_id = unpack_uint32(strip_padding(self.payload, self.flags))
+        return None if promised_stream_id is None else promised_stream_id & 0x7FFFFFFF
+
+    def header_block(self):
+        return strip_padding(self.payload, self.flags)[4:]
+
+class PingFrameView(FrameView):
+
+    name = 'PING'
 
+    def is_ack(self):
+        return self.has_flag(ack_flag)
 
+    def opaque_data(self):
+        return self.payload
+
+class GoAwayFrameView(FrameView):
+
+    name = 'GOAWAY'
+
+    def last_stream_id(self):
+        last_stream_id = unpack_uint32(self.payload)
+        return None if last_stream_id is None else last_stream_id & 0x7FFFFFFF
+
+    def error_code(self):
+        return unpack_uint32(self.payload, 4)
+
+    def debug_data(self):
+        return self.payload[8:]
+
+    def __repr__(self):
+        return '{0}, last stream id = {1}, error code = {2}'.format(
+            FrameView.__repr__(self), self.last_stream_id(), self.error_code())
+
+class WindowUpdateFrameView(FrameView):
+
+    name = 'WINDOW_UPDATE'
+
+    def window_size_increment(self):
+        increment = unpack_uint32(self.payload)
+        return None if increment is None else increment & 0x7FFFFFFF
+
+class ContinuationFrameView(FrameView):
+
+    name = 'CONTINUATION'
+
+    def header_block(self):
+        return self.payload
+
+frame_views = {
+    DataFrame.frame_type            : DataFrameView,
+    HeadersFrame.frame_type         : HeadersFrameView,
+    PriorityFrame.frame_type        : PriorityFrameView,
+    RstStreamFrame.frame_type       : RstStreamFrameView,
+    SettingsFrame.frame_type        : SettingsFrameView,
+    PushPromiseFrame.frame_type     : PushPromiseFrameView,
+    PingFrame.frame_type            : PingFrameView,
+    GoAwayFrame.frame_type          : GoAwayFrameView,
+    WindowUpdateFrame.frame_type    : WindowUpdateFrameView,
+    ContinuationFrame.frame_type    : ContinuationFrameView
+}
+
+# FrameDecoder splits received data into frames,
+# data can be fed in chunks of any size, a frame which is cut across chunks
+# is returned when the rest of it has been received
+#
+# Data is kept in one receive buffer which is re-used,
+# returned frames refer to this buffer, so they're valid
+# only until the next call to feed() or receive()
+class FrameDecoder:
+
+    def __init__(self, capacity = 65536):
+        self.buffer = bytearray(capacity)
+        self.start = 0      # beginning of data which has not been decoded yet
+        self.end = 0        # end of received data
+        self.incomplete = 0 # length of a frame which has been received partially
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.incomplete = 0
+
+    # returns a number of bytes which have been received but not decoded yet
+    def pending(self):
+        return self.end - self.start
+
+    # decodes a chunk of data, and returns a list of complete frames
+    def feed(self, data):
+        length = len(data)
+        self.make_room(length)
+        self.buffer[self.end:self.end + length] = data
+        self.end += length
+        return self.decode()
+
+    # reads data to the receive buffer with specified function
+    # which has the same signature as socket.recv_into(),
+    # and returns a list of complete frames, or None if the connection was closed,
+    # the function may return None if nothing was received in time
+    def receive(self, recv_into):
+        # make sure that the rest of an incomplete frame fits to the buffer
+        self.make_room(max(len(self.buffer) // 4, self.incomplete - self.pending()))
+        with memoryview(self.buffer) as view:
+            received = recv_into(view[self.end:])
+        if received is None:
+            return []
+        if received == 0:
+            return None
+        self.end += received
+        return self.decode()
+
+    def make_room(self, length):
+        if self.start == self.end:
+            self.reset()
+
+        if self.end + length <= len(self.buffer):
+            return
+
+        pending = self.pending()
+        if pending + length > len(self.buffer):
+            # frames which have been returned may still refer to the old buffer,
+            # so a new buffer is created instead of resizing the current one
+            buffer = bytearray(max(2 * len(self.buffer), pending + length))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+
+        self.start = 0
+        self.end = pending
+
+    def decode(self):
+        frames = []
+        self.incomplete = 0
+        view = memoryview(self.buffer)
+        while self.end - self.start >= frame_header_length:
+            length_high, length_low, frame_type, flags, stream_id = frame_header.unpack_from(
+                self.buffer, self.start)
+            length = (length_high << 16) | length_low
+            payload_start = self.start + frame_header_length
+            if self.end - payload_start < length:
+                # the buffer is not compacted here since returned frames refer to it
+                self.incomplete = frame_header_length + length
+                break
+            payload = view[payload_start:payload_start + length]
+            view_class = frame_views.get(frame_type, FrameView)
+            frames.append(view_class(length, frame_type, flags, stream_id & 0x7FFFFFFF, payload))
+            self.start = payload_start + length
+
+        return frames
+
+
+# StreamIdAllocator gives out new stream ids on one connection
+#
+# A client uses odd ids, and a server uses even ids (RFC 7540, section 5.1.1).
+# Ids can't be re-used, and they only increase, so a new connection is needed
+# when they run out. Streams which are opened count against
+# SETTINGS_MAX_CONCURRENT_STREAMS of the peer until the peer closes them.
+class StreamIdAllocator:
+
+    max_stream_id = 2**31 - 1
+    max_concurrent_streams_parameter = 0x3
+
+    def __init__(self, is_client = True):
+        self.first_stream_id = 1 if is_client else 2
+        self.reset()
+
+    # should be called for each new connection
+    def reset(self):
+        self.next_stream_id = self.first_stream_id
+        self.max_concurrent_streams = None  # no limit until the peer sets it
+        self.active = set()
+        self.last_opened = None
+
+    # returns True if n more streams can be used
+    def available(self, n = 1):
+        if self.next_stream_id + 2 * (n - 1) > StreamIdAllocator.max_stream_id:
+            return False
+        return (self.max_concurrent_streams is None
+                or len(self.active) + n <= self.max_concurrent_streams)
+
+    # returns True if a new connection is needed to use n more streams,
+    # a fresh connection is never exhausted, so that a low limit of the peer
+    # doesn't cause endless re-connects
+    def exhausted(self, n = 1):
+        return self.next_stream_id != self.first_stream_id and not self.available(n)
+
+    def allocate(self, opens_stream = True):
+        if self.next_stream_id > StreamIdAllocator.max_stream_id:
+            raise Exception('No more stream ids')
+        stream_id = self.next_stream_id
+        self.next_stream_id += 2
+        if opens_stream:
+            self.active.add(stream_id)
+            self.last_opened = stream_id
+        return stream_id
+
+    # returns the most recent stream which is still active, or the most recent
+    # stream which was opened if all of them are closed, or None
+    # if no stream has been opened on the connection yet
+    def last_active(self):
+        if self.active:
+            return max(self.active)
+        return self.last_opened
+
+    # updates the limit and active streams with frames received from the peer
+    def process(self, frames):
+        if frames is None:
+            return
+        for frame in frames:
+            if isinstance(frame, SettingsFrameView) and not frame.is_ack():
+                for identifier, value in frame.settings():
+                    if identifier == StreamIdAllocator.max_concurrent_streams_parameter:
+                        self.max_concurrent_streams = value
+            elif isinstance(frame, RstStreamFrameView):
+                self.active.discard(frame.stream_id)
+            elif isinstance(frame, (DataFrameView, HeadersFrameView)) \
+                    and frame.has_flag(end_stream_flag):
+                self.active.discard(frame.stream_id)
+
+    def __repr__(self):
+        return 'next stream id = {0:d}, active streams = {1:d}, limit = {2}'.format(
+            self.next_stream_id, len(self.active), self.max_concurrent_streams)
+
+
+# FlowControl keeps flow-control windows of a peer for one connection,
+# the windows tell how many octets of DATA can be sent on the connection
+# and on each stream which has been opened
+#
+# A window of a new stream starts from the last SETTINGS_INITIAL_WINDOW_SIZE
+# of the peer, a change of the setting changes windows of all open streams,
+# and WINDOW_UPDATE frames increase the windows (RFC 7540, section 6.9)
+class FlowControl:
+
+    default_window_size = 65535
+    initial_window_size_parameter = 0x4
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.connection_window = FlowControl.default_window_size
+        self.initial_window_size = FlowControl.default_window_size
+        self.stream_windows = {}
+
+    def open(self, stream_id):
+        self.stream_windows[stream_id] = self.initial_window_size
+
+    def close(self, stream_id):
+        self.stream_windows.pop(stream_id, None)
+
+    # returns a number of octets which can be sent on a stream now
+    def available(self, stream_id):
+        return min(self.connection_window, self.stream_windows.get(stream_id, 0))
+
+    def consume(self, stream_id, length):
+        self.connection_window -= length
+        self.stream_windows[stream_id] -= length
+
+    # updates windows with received frames
+    def process(self, frames):
+        if not frames:
+            return
+        for frame in frames:
+            if isinstance(frame, SettingsFrameView) and not frame.is_ack():
+                for identifier, value in frame.settings():
+                    if identifier == FlowControl.initial_window_size_parameter:
+                        delta = value - self.initial_window_size
+                        self.initial_window_size = value
+                        for stream_id in self.stream_windows:
+                            self.stream_windows[stream_id] += delta
+            elif isinstance(frame, WindowUpdateFrameView):
+                increment = frame.window_size_increment()
+                if increment is None:
+                    continue
+                if frame.stream_id == 0:
+                    self.connection_window += increment
+                elif frame.stream_id in self.stream_windows:
+                    self.stream_windows[frame.stream_id] += increment
+
+    def __repr__(self):
+        return 'connection window = {0:d}, initial window size = {1:d}'.format(
+            self.connection_window, self.initial_window_size)
+
+
+# DataStream sends a body from a file as a sequence of DATA frames
+#
+# The file is memory-mapped, and frames refer to slices of the mapping,
+# so the body is never loaded to memory as a whole. Each frame is sent
+# as a header and a slice of the mapping with one scatter-gather call.
+#
+# If flow control is specified, then frames don't exceed the windows of the peer.
+# When the windows are exhausted, frames() yields (None, None), and a caller
+# should receive frames which update the windows before asking for a next frame
+class DataStream:
+
+    def __init__(self, path, stream_id, max_frame_size = 16384, end_stream = True):
+        if stream_id <= 0:
+            raise Exception('invalid stream id {0:d}'.format(stream_id))
+        self.path = path
+        self.stream_id = stream_id
+        self.max_frame_size = max_frame_size
+        self.end_stream = end_stream
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    # yields a header and a payload for each DATA frame,
+    # a payload is valid only until the next frame is requested
+    def frames(self, flow = None):
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                yield self.header(0, True), b''
+                return
+
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapping:
+                if hasattr(mapping, 'madvise'):
+                    mapping.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapping) as view:
+                    offset = 0
+                    while offset < size:
+                        length = min(self.max_frame_size, size - offset)
+                        if flow is not None:
+                            available = flow.available(self.stream_id)
+                            if available <= 0:
+                                yield None, None
+                                continue
+                            length = min(length, available)
+                            flow.consume(self.stream_id, length)
+                        chunk = view[offset:offset + length]
+                        offset += length
+                        try:
+                            yield self.header(length, offset == size), chunk
+                        finally:
+                            chunk.release()
+
+    def header(self, length, last):
+        flags = end_stream_flag if last and self.end_stream else 0x0
+        return Frame(DataFrame.frame_type, flags, self.stream_id).header(length)
+
+    # sends frames with a client which provides send_parts(),
+    # if the windows are exhausted, then wait() is called to receive updates,
+    # and sending stops if it returns False, returns a number of sent octets
+    def send(self, client, flow = None, wait = None):
+        sent = 0
+        for header, payload in self.frames(flow):
+            if header is None:
+                if not wait():
+                    break
+                continue
+            client.send_parts((header, payload))
+            sent += len(payload)
+        return sent
+
+
+# the same values are used in many requests, for example, a default host
+# or a large fuzzed path, so they're encoded once
+@functools.lru_cache(maxsize = 1024)
+def encode_request_field(value):
+    return value.encode()
+
+# a default SETTINGS frame in HTTP2-Settings header never changes
+@functools.lru_cache(maxsize = 1)
+def encoded_default_settings():
+    return base64.b64encode(SettingsFrame().encode())
+
+
+# Http1Upgrade is an HTTP/1.1 request which asks to upgrade to HTTP/2
+#
 # Example:
 #
 #    GET / HTTP/1.1
@@ -646,6 +1662,9 @@ class WindowUpdateFrame(Frame):
 #    Connection: Upgrade, HTTP2-Settings
 #    Upgrade: h2c
 #    HTTP2-Settings: <base64url encoding of HTTP/2 SETTINGS payload>
+#
+# The template is split to segments which don't change, they're encoded once,
+# and a request is built by joining the segments with encoded fields
 class Http1Upgrade:
 
     template = '''{} {} {}
@@ -656,6 +1675,8 @@ HTTP2-Settings: {}
 
 '''
 
+    segments = tuple(segment.encode() for segment in template.split('{}'))
+
     def __init__(self):
         self.method = 'GET'
         self.path = '/'
@@ -663,10 +1684,19 @@ HTTP2-Settings: {}
         self.host = config.current.host
         self.connection = 'Upgrade, HTTP2-Settings'
         self.upgrade = 'h2' if config.current.tls else 'h2c'
-        self.http2settings = SettingsFrame()
+        self.http2settings = None   # default settings
 
     def encode(self):
-        return self.get_http_request().encode()
+        parts = [None] * (2 * len(Http1Upgrade.segments) - 1)
+        parts[0::2] = Http1Upgrade.segments
+        parts[1::2] = (encode_request_field(self.method),
+                       encode_request_field(self.path),
+                       encode_request_field(self.version),
+                       encode_request_field(self.host),
+                       encode_request_field(self.connection),
+                       encode_request_field(self.upgrade),
+                       self.get_settings_frame_bytes())
+        return b''.join(parts)
 
     def get_http_request(self):
         return self.template.format(self.method, self.path, self.version,
@@ -675,8 +1705,13 @@ HTTP2-Settings: {}
                                     self.upgrade,
                                     self.get_settings_frame_string())
 
+    def get_settings_frame_bytes(self):
+        if self.http2settings is None:
+            return encoded_default_settings()
+        return base64.b64encode(self.http2settings.encode())
+
     def get_settings_frame_string(self):
-        return base64.b64encode(self.http2settings.encode()).decode('ascii')
+        return self.get_settings_frame_bytes().decode('ascii')
 
     def set_method(self, method):
         self.method = method
@@ -693,3 +1728,222 @@ HTTP2-Settings: {}
     def __repr__(self):
         return helper.truncate(self.get_http_request())
 
+
+# Http1Response is a response to an HTTP/1.x request, header names are lower-case
+class Http1Response:
+
+    def __init__(self, method, version, status, reason, headers):
+        self.method = method
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = bytearray()
+
+    # returns a value of the last header with specified name, or None
+    def header(self, name):
+        for header_name, value in reversed(self.headers):
+            if header_name == name:
+                return value
+        return None
+
+    def connection_tokens(self):
+        value = self.header('connection')
+        if value is None:
+            return []
+        return [token.strip().lower() for token in value.split(',')]
+
+    # returns False if no more responses can be read from the connection
+    def keeps_alive(self):
+        if self.status == 101:
+            return False    # switched protocols
+        if self.method == 'CONNECT' and 200 <= self.status < 300:
+            return False    # the connection became a tunnel
+        tokens = self.connection_tokens()
+        if 'close' in tokens:
+            return False
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return True
+
+    def __repr__(self):
+        return helper.truncate('{0} {1:d} {2}, body: {3:d} bytes'.format(
+            self.version, self.status, self.reason, len(self.body)))
+
+
+# Http1ResponseParser splits a stream of data from a server into responses.
+#
+# A request method should be passed to expect() for each sent request,
+# so that a response to HEAD is not expected to have a body.
+# Interim 1xx responses are skipped. A body is delimited by Content-Length,
+# chunked transfer coding, or by closing the connection.
+# Once a response closes the connection, or the server sends something
+# which is not a valid response, the parser is closed, and the rest is ignored.
+# In the last case, the parser is also marked as invalid.
+class Http1ResponseParser:
+
+    max_line_length = 64 * 1024
+
+    def __init__(self):
+        self.reset()
+
+    # should be called for each new connection
+    def reset(self):
+        self.buffer = bytearray()
+        self.methods = collections.deque()
+        self.response = None
+        self.state = 'status'
+        self.remaining = 0
+        self.closed = False
+        self.invalid = False
+        self.reason = None  # why the parser was closed
+
+    def expect(self, method):
+        self.methods.append(method)
+
+    # parses a chunk of data, and returns a list of complete responses
+    def feed(self, data):
+        self.buffer.extend(data)
+        responses = []
+        while not self.closed and self.step(responses):
+            pass
+        return responses
+
+    # should be called when the connection is closed by the server,
+    # returns a response whose body was delimited by closing the connection
+    def finish(self):
+        responses = []
+        if not self.closed and self.state == 'body_until_close':
+            self.response.body.extend(self.buffer)
+            responses.append(self.complete())
+        self.stop('connection closed')
+        return responses
+
+    def stop(self, reason, invalid = False):
+        if not self.closed:
+            self.closed = True
+            self.invalid = invalid
+            self.reason = reason
+
+    # processes a line or a piece of a body, returns False if more data is needed
+    def step(self, responses):
+        if self.state == 'body_until_close':
+            self.response.body.extend(self.buffer)
+            self.buffer.clear()
+            return False
+
+        if self.state in ('body', 'chunk_data'):
+            length = min(self.remaining, len(self.buffer))
+            self.response.body.extend(self.buffer[:length])
+            del self.buffer[:length]
+            self.remaining -= length
+            if self.remaining > 0:
+                return False
+            if self.state == 'body':
+                responses.append(self.complete())
+            else:
+                self.state = 'chunk_end'
+            return True
+
+        line = self.read_line()
+        if line is None:
+            return False
+
+        if self.state == 'status':
+            self.parse_status_line(line)
+        elif self.state == 'headers':
+            if line:
+                self.parse_header(line)
+            else:
+                self.end_of_head(responses)
+        elif self.state == 'chunk_size':
+            self.parse_chunk_size(line)
+        elif self.state == 'chunk_end':
+            if line:
+                self.stop('no CRLF after a chunk', True)
+            self.state = 'chunk_size'
+        elif self.state == 'trailers':
+            if not line:
+                responses.append(self.complete())
+        else:
+            raise Exception('What the hell? Unknown state: {}'.format(self.state))
+
+        return True
+
+    # returns a line without a line terminator, or None if there is no complete line
+    def read_line(self):
+        end = self.buffer.find(b'\n')
+        if end < 0:
+            if len(self.buffer) > Http1ResponseParser.max_line_length:
+                self.stop('too long line', True)
+            return None
+        line = bytes(self.buffer[:end]).rstrip(b'\r')
+        del self.buffer[:end + 1]
+        return line
+
+    def parse_status_line(self, line):
+        parts = line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') \
+                or len(parts[1]) != 3 or not parts[1].isdigit():
+            self.stop('invalid status line: {}'.format(helper.truncate(repr(line))), True)
+            return
+        reason = parts[2] if len(parts) > 2 else ''
+        self.response = Http1Response(None, parts[0], int(parts[1]), reason, [])
+        self.state = 'headers'
+
+    def parse_header(self, line):
+        name, colon, value = line.decode('latin-1').partition(':')
+        if not colon:
+            self.stop('invalid header: {}'.format(helper.truncate(repr(line))), True)
+            return
+        self.response.headers.append((name.strip().lower(), value.strip()))
+
+    def parse_chunk_size(self, line):
+        size = line.split(b';', 1)[0].strip()
+        try:
+            self.remaining = int(size, 16)
+        except ValueError:
+            self.stop('invalid chunk size: {}'.format(helper.truncate(repr(line))), True)
+            return
+        self.state = 'chunk_data' if self.remaining > 0 else 'trailers'
+
+    # decides how a body is delimited when all headers have been received
+    def end_of_head(self, responses):
+        response = self.response
+        if 100 <= response.status < 200 and response.status != 101:
+            # an interim response, a final one follows
+            self.response = None
+            self.state = 'status'
+            return
+
+        response.method = self.methods.popleft() if self.methods else None
+        transfer_encoding = response.header('transfer-encoding')
+        content_length = response.header('content-length')
+        if response.method == 'HEAD' or response.status in (101, 204, 304) \
+                or response.method == 'CONNECT' and 200 <= response.status < 300:
+            # no body
+            responses.append(self.complete())
+        elif transfer_encoding is not None:
+            if transfer_encoding.split(',')[-1].strip().lower() == 'chunked':
+                self.state = 'chunk_size'
+            else:
+                self.state = 'body_until_close'
+        elif content_length is not None:
+            if not content_length.isdigit():
+                self.stop('invalid content length: {}'.format(helper.truncate(content_length)), True)
+                return
+            self.remaining = int(content_length)
+            if self.remaining > 0:
+                self.state = 'body'
+            else:
+                responses.append(self.complete())
+        else:
+            self.state = 'body_until_close'
+
+    def complete(self):
+        response = self.response
+        self.response = None
+        self.state = 'status'
+        if not response.keeps_alive():
+            self.stop('connection closed by response: {}'.format(response))
+        return response
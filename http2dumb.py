@@ -1,131 +1,433 @@
 #!/usr/bin/python
 
+import array
+import asyncio
+import collections
 import random
 import helper
 import socket
+import ssl
+import struct
+import threading
+import time
+import tracer
 import connection
 import http2core
 
 from http2core  import Frame, SettingsFrame, HeadersFrame, DataFrame
 from http2core  import ContinuationFrame, WindowUpdateFrame, RstStreamFrame
 from http2core  import PushPromiseFrame, PingFrame, PriorityFrame, GoAwayFrame
-from helper     import DumbByteArrayFuzzer, DumbDictionaryFuzzer
+from helper     import DumbDictionaryFuzzer, create_byte_array_fuzzer
 
 from helper import AbstractTest
 
 # This is from https://en.wikipedia.org/wiki/List_of_HTTP_header_fields#Request_fields
-default_request_headers = {
-        ':scheme'                : 'http',
-        ':method'                : 'GET',
-        ':path'                  : '/index.html',
-        'accept'                 : '*/*',
-        'Accept-Charset'         : 'utf-8',
-        'Accept-Encoding'        : 'gzip, deflate',
-        'Accept-Language'        : 'en-US',
-        'Accept-Datetime'        : 'Thu, 31 May 2007 20:35:00 GMT',
-        'Authorization'          : 'Basic QWxhZGRpbjpvcGVuIHNlc2FtZQ==',
-        'Cache-Control'          : 'no-cache',
-        'Connection'             : 'keep-alive',
-        'Cookie'                 : '$Version=1; Skin=new;',
-        'Content-Length'         : '0',
-        'Content-MD5'            : 'Q2hlY2sgSW50ZWdyaXR5IQ==',
-        'Content-Type'           : 'application/x-www-form-urlencoded',
-        'Date'                   : 'Tue, 15 Nov 1994 08:12:31 GMT',
-        'Forwarded'              : ('for=192.0.2.60;proto=http;' +
-                                    'by=203.0.113.43 ' +
-                                    'Forwarded: for=192.0.2.43, for=198.51.100.17'),
-        'From'                   : 'user@example.com',
-        'If-Match'               : '"737060cd8c284d8af7ad3082f209582d"',
-        'If-Modified-Since'      : 'Sat, 29 Oct 1994 19:43:31 GMT',
-        'If-None-Match'          : '"737060cd8c284d8af7ad3082f209582d"',
-        'If-Range'               : '"737060cd8c284d8af7ad3082f209582d"',
-        'If-Unmodified-Since'    : 'Sat, 29 Oct 1994 19:43:31 GMT',
-        'Max-Forwards'           : '10',
-        'Origin'                 : 'http://www.example-social-network.com',
-        'Pragma'                 : 'no-cache',
-        'Proxy-Authorization'    : 'Basic QWxhZGRpbjpvcGVuIHNlc2FtZQ==',
-        'Range'                  : 'bytes=500-999',
-        'Referer'                : 'http://en.wikipedia.org/wiki/Main_Page',
-        'TE'                     : 'trailers, deflate',
-        'User-Agent'             : ('Mozilla/5.0 (X11; Linux x86_64; rv:12.0)' +
-                                    ' Gecko/20100101 Firefox/21.0'),
-        'Via'                    : '1.0 fred, 1.1 example.com (Apache/1.1)',
-        'Warning'                : '199 Miscellaneous warning',
-        'X-Requested-With'       : 'XMLHttpRequest',
-        'DNT'                    : '1 (Do Not Track Enabled)',
-        'X-Forwarded-For'        : 'client1, proxy1, proxy2',
-        'X-Forwarded-Host'       : 'en.wikipedia.org:8080',
-        'X-Forwarded-Proto'      : 'http',
-        'Front-End-Https'        : 'off',
-        'X-HTTP-Method-Override' : 'DELETE',
-        'X-Att-Deviceid'         : 'GT-P7320/P7320XXLPG',
-        'x-wap-profile'          : 'http://wap.samsungmobile.com/uaprof/SGH-I777.xml',
-        'Proxy-Connection'       : 'keep-alive',
-        'X-Csrf-Token'           : 'i8XNjC4b8KVok4uw5RftR38Wgp2BFwql'
-    }
+default_request_headers = [
+        (':scheme',                'http'),
+        (':method',                'GET'),
+        (':path',                  '/index.html'),
+        ('accept',                 '*/*'),
+        ('Accept-Charset',         'utf-8'),
+        ('Accept-Encoding',        'gzip, deflate'),
+        ('Accept-Language',        'en-US'),
+        ('Accept-Datetime',        'Thu, 31 May 2007 20:35:00 GMT'),
+        ('Authorization',          'Basic QWxhZGRpbjpvcGVuIHNlc2FtZQ=='),
+        ('Cache-Control',          'no-cache'),
+        ('Connection',             'keep-alive'),
+        ('Cookie',                 '$Version=1; Skin=new;'),
+        ('Content-Length',         '0'),
+        ('Content-MD5',            'Q2hlY2sgSW50ZWdyaXR5IQ=='),
+        ('Content-Type',           'application/x-www-form-urlencoded'),
+        ('Date',                   'Tue, 15 Nov 1994 08:12:31 GMT'),
+        ('Forwarded',              ('for=192.0.2.60;proto=http;' +
+                                     'by=203.0.113.43 ' +
+                                     'Forwarded: for=192.0.2.43, for=198.51.100.17')),
+        ('From',                   'user@example.com'),
+        ('If-Match',               '"737060cd8c284d8af7ad3082f209582d"'),
+        ('If-Modified-Since',      'Sat, 29 Oct 1994 19:43:31 GMT'),
+        ('If-None-Match',          '"737060cd8c284d8af7ad3082f209582d"'),
+        ('If-Range',               '"737060cd8c284d8af7ad3082f209582d"'),
+        ('If-Unmodified-Since',    'Sat, 29 Oct 1994 19:43:31 GMT'),
+        ('Max-Forwards',           '10'),
+        ('Origin',                 'http://www.example-social-network.com'),
+        ('Pragma',                 'no-cache'),
+        ('Proxy-Authorization',    'Basic QWxhZGRpbjpvcGVuIHNlc2FtZQ=='),
+        ('Range',                  'bytes=500-999'),
+        ('Referer',                'http://en.wikipedia.org/wiki/Main_Page'),
+        ('TE',                     'trailers, deflate'),
+        ('User-Agent',             ('Mozilla/5.0 (X11; Linux x86_64; rv:12.0)' +
+                                     ' Gecko/20100101 Firefox/21.0')),
+        ('Via',                    '1.0 fred, 1.1 example.com (Apache/1.1)'),
+        ('Warning',                '199 Miscellaneous warning'),
+        ('X-Requested-With',       'XMLHttpRequest'),
+        ('DNT',                    '1 (Do Not Track Enabled)'),
+        ('X-Forwarded-For',        'client1, proxy1, proxy2'),
+        ('X-Forwarded-Host',       'en.wikipedia.org:8080'),
+        ('X-Forwarded-Proto',      'http'),
+        ('Front-End-Https',        'off'),
+        ('X-HTTP-Method-Override', 'DELETE'),
+        ('X-Att-Deviceid',         'GT-P7320/P7320XXLPG'),
+        ('x-wap-profile',          'http://wap.samsungmobile.com/uaprof/SGH-I777.xml'),
+        ('Proxy-Connection',       'keep-alive'),
+        ('X-Csrf-Token',           'i8XNjC4b8KVok4uw5RftR38Wgp2BFwql'),
+    ]
 
 # This is from https://en.wikipedia.org/wiki/List_of_HTTP_header_fields#Response_fields
-default_response_headers = {
-        ':status'                       : '200',
-        'Access-Control-Allow-Origin'   : '*',
-        'Accept-Patch'                  : 'text/example;charset=utf-8',
-        'Accept-Ranges'                 : 'bytes',
-        'Age'                           : '12',
-        'Allow'                         : 'GET, HEAD, POST',
-        'Alt-Svc'                       : 'h2="http2.example.com:443"; ma=720',
-        'Cache-Control'                 : 'max-age=3600',
-        'Connection'                    : 'close',
-        'Content-Disposition'           : 'attachment; filename="fname.ext"',
-        'Content-Encoding'              : 'gzip',
-        'Content-Language'              : 'da',
-        'Content-Length'                : '348',
-        'Content-Location'              : '/index.htm',
-        'Content-MD5'                   : 'Q2hlY2sgSW50ZWdyaXR5IQ==',
-        'Content-Range'                 : 'bytes 21010-47021/47022',
-        'Content-Type'                  : 'text/html; charset=utf-8',
-        'Date'                          : 'Tue, 15 Nov 1994 08:12:31 GMT',
-        'ETag'                          : '"737060cd8c284d8af7ad3082f209582d"',
-        'Expires'                       : 'Thu, 01 Dec 1994 16:00:00 GMT',
-        'Last-Modified'                 : 'Tue, 15 Nov 1994 12:45:26 GMT',
-        'Link'                          : '</feed>; rel="alternate"',
-        'Location'                      : 'http://www.w3.org/pub/WWW/People.html',
-        'P3P'                           : ('CP="This is not a P3P policy!'),
-        'Pragma'                        : 'no-cache',
-        'Proxy-Authenticate'            : 'Basic',
-        'Public-Key-Pins'               : 'max-age=2592000; pin-sha256="E9CZ9INDbd+2eRQozYqqbQ2yXLVKB9+xcprMF+44U1g=";',
-        'Refresh'                       : '5; url=http://www.w3.org/pub/WWW/People.html',
-        'Retry-After'                   : 'Fri, 07 Nov 2014 23:59:59 GMT',
-        'Server'                        : 'Apache/2.4.1 (Unix)',
-        'Set-Cookie'                    : 'UserID=JohnDoe; Max-Age=3600; Version=1',
-        'Strict-Transport-Security'     : 'max-age=16070400; includeSubDomains',
-        'Trailer'                       : 'Max-Forwards',
-        'Transfer-Encoding'             : 'chunked',
-        'TSV'                           : '?',
-        'Upgrade'                       : 'HTTP/2.0, HTTPS/1.3, IRC/6.9, RTA/x11, websocket',
-        'Vary'                          : '*',
-        'Via'                           : '1.0 fred, 1.1 example.com (Apache/1.1)',
-        'Warning'                       : '199 Miscellaneous warning',
-        'WWW-Authenticate'              : 'Basic',
-        'X-Frame-Options'               : 'allowall',
-        'X-XSS-Protection'              : '1; mode=block',
-        'X-WebKit-CSP'                  : 'default-src \'self\'',
-        'X-Content-Type-Options'        : 'nosniff',
-        'X-Powered-By'                  : 'PHP/5.4.0',
-        'X-UA-Compatible'               : 'IE=EmulateIE7',
-        'X-UA-Compatible'               : 'IE=edge',
-        'X-UA-Compatible'               : 'Chrome=1',
-        'X-Content-Duration'            : '42.666',
-        'Upgrade-Insecure-Requests'     : '1',
-        'X-Request-ID'                  : 'f058ebd6-02f7-4d3f-942e-904344e8cde5',
-    }
-
-
-# TODO: it might be better to use different stream ids
-#       because some of them can't be re-used in some cases (see the spec),
-#       for example if RST_STREAM frame was received
+# (it's a list because some names repeat)
+default_response_headers = [
+        (':status',                       '200'),
+        ('Access-Control-Allow-Origin',   '*'),
+        ('Accept-Patch',                  'text/example;charset=utf-8'),
+        ('Accept-Ranges',                 'bytes'),
+        ('Age',                           '12'),
+        ('Allow',                         'GET, HEAD, POST'),
+        ('Alt-Svc',                       'h2="http2.example.com:443"; ma=720'),
+        ('Cache-Control',                 'max-age=3600'),
+        ('Connection',                    'close'),
+        ('Content-Disposition',           'attachment; filename="fname.ext"'),
+        ('Content-Encoding',              'gzip'),
+        ('Content-Language',              'da'),
+        ('Content-Length',                '348'),
+        ('Content-Location',              '/index.htm'),
+        ('Content-MD5',                   'Q2hlY2sgSW50ZWdyaXR5IQ=='),
+        ('Content-Range',                 'bytes 21010-47021/47022'),
+        ('Content-Type',                  'text/html; charset=utf-8'),
+        ('Date',                          'Tue, 15 Nov 1994 08:12:31 GMT'),
+        ('ETag',                          '"737060cd8c284d8af7ad3082f209582d"'),
+        ('Expires',                       'Thu, 01 Dec 1994 16:00:00 GMT'),
+        ('Last-Modified',                 'Tue, 15 Nov 1994 12:45:26 GMT'),
+        ('Link',                          '</feed>; rel="alternate"'),
+        ('Location',                      'http://www.w3.org/pub/WWW/People.html'),
+        ('P3P',                           ('CP="This is not a P3P policy!')),
+        ('Pragma',                        'no-cache'),
+        ('Proxy-Authenticate',            'Basic'),
+        ('Public-Key-Pins',               'max-age=2592000; pin-sha256="E9CZ9INDbd+2eRQozYqqbQ2yXLVKB9+xcprMF+44U1g=";'),
+        ('Refresh',                       '5; url=http://www.w3.org/pub/WWW/People.html'),
+        ('Retry-After',                   'Fri, 07 Nov 2014 23:59:59 GMT'),
+        ('Server',                        'Apache/2.4.1 (Unix)'),
+        ('Set-Cookie',                    'UserID=JohnDoe; Max-Age=3600; Version=1'),
+        ('Strict-Transport-Security',     'max-age=16070400; includeSubDomains'),
+        ('Trailer',                       'Max-Forwards'),
+        ('Transfer-Encoding',             'chunked'),
+        ('TSV',                           '?'),
+        ('Upgrade',                       'HTTP/2.0, HTTPS/1.3, IRC/6.9, RTA/x11, websocket'),
+        ('Vary',                          '*'),
+        ('Via',                           '1.0 fred, 1.1 example.com (Apache/1.1)'),
+        ('Warning',                       '199 Miscellaneous warning'),
+        ('WWW-Authenticate',              'Basic'),
+        ('X-Frame-Options',               'allowall'),
+        ('X-XSS-Protection',              '1; mode=block'),
+        ('X-WebKit-CSP',                  'default-src \'self\''),
+        ('X-Content-Type-Options',        'nosniff'),
+        ('X-Powered-By',                  'PHP/5.4.0'),
+        ('X-UA-Compatible',               'IE=EmulateIE7'),
+        ('X-UA-Compatible',               'IE=edge'),
+        ('X-UA-Compatible',               'Chrome=1'),
+        ('X-Content-Duration',            '42.666'),
+        ('Upgrade-Insecure-Requests',     '1'),
+        ('X-Request-ID',                  'f058ebd6-02f7-4d3f-942e-904344e8cde5'),
+    ]
+
+# headers of a request with a body from a file, the request should be
+# well-formed (RFC 7540, section 8.1.2), so that a server actually reads the body:
+# names are lower-case, and there are no connection-specific headers,
+# pseudo-header fields and a content length are added for each request
+upload_request_headers = [
+        ('accept',                 '*/*'),
+        ('accept-encoding',        'gzip, deflate'),
+        ('accept-language',        'en-US'),
+        ('cache-control',          'no-cache'),
+        ('content-type',           'application/octet-stream'),
+        ('user-agent',             ('Mozilla/5.0 (X11; Linux x86_64; rv:12.0)' +
+                                     ' Gecko/20100101 Firefox/21.0')),
+    ]
+
+
+settings_ack = Frame(SettingsFrame.frame_type, http2core.ack_flag).encode(bytearray())
+
+# logs received frames and reacts to the ones which affect the connection,
+# returns False if the connection should be closed
+def process_frames(test, frames, send, info):
+    if frames is None:
+        info('test {0:d}: connection closed by remote side'.format(test))
+        return False
+
+    for frame in frames:
+        if tracer.enabled(tracer.VERBOSE):
+            info('test {0:d}: received frame:'.format(test), frame, helper.hexdump(frame.payload))
+        else:
+            info('test {0:d}: received frame:'.format(test), frame)
+        if isinstance(frame, http2core.SettingsFrameView) and not frame.is_ack():
+            send(settings_ack)
+        elif isinstance(frame, http2core.GoAwayFrameView):
+            info('test {0:d}: received GOAWAY, re-connect'.format(test))
+            return False
+
+    return True
+
+
+# sets stream ids which a fuzzer uses in a next test, new ids are taken
+# from allocators if they're specified, otherwise default ids are used,
+# promised stream ids can be allocated only by a server
+#
+# Frames like DATA are not allowed on idle streams (RFC 7540, section 5.1),
+# so fuzzers which send them get a stream which was opened by a previous test
+# on the same connection, if there is no such stream yet, a default id is used
+def set_stream_ids(fuzzer, streams = None, promised_streams = None):
+    if streams is not None and fuzzer.targets_open_stream:
+        stream_id = streams.last_active()
+        fuzzer.set_stream_id(stream_id if stream_id is not None else fuzzer.default_stream_id)
+    elif streams is not None and fuzzer.uses_stream:
+        fuzzer.set_stream_id(streams.allocate(fuzzer.opens_stream))
+    else:
+        fuzzer.set_stream_id(fuzzer.default_stream_id)
+    if promised_streams is not None and fuzzer.promises_stream:
+        # a reserved stream doesn't count against concurrent streams
+        fuzzer.set_promised_stream_id(promised_streams.allocate(False))
+    else:
+        fuzzer.set_promised_stream_id(fuzzer.default_promised_stream_id)
+
+
+# TestDispatcher gives out numbers of tests to several connections,
+# tests which could not be sent are given out again by the same dispatcher.
+# If a counter (multiprocessing.Value) is specified, then new tests are taken
+# from it, so that dispatchers in several processes share one range of tests.
+class TestDispatcher:
+
+    def __init__(self, start_test, end_test, counter = None):
+        self.next_test = start_test
+        self.end_test = end_test
+        self.counter = counter
+        self.retries = collections.deque()
+
+    def done(self):
+        return not self.retries and self.upcoming() > self.end_test
+
+    # returns a number of a next new test
+    def upcoming(self):
+        if self.counter is None:
+            return self.next_test
+        return self.counter.value
+
+    # returns up to n tests
+    def take(self, n):
+        tests = []
+        while self.retries and len(tests) < n:
+            tests.append(self.retries.popleft())
+        tests.extend(self.take_new(n - len(tests)))
+        return tests
+
+    # atomically takes up to n tests which have not been given out yet
+    def take_new(self, n):
+        if self.counter is None:
+            first = self.next_test
+            self.next_test = max(first, min(first + n, self.end_test + 1))
+            return range(first, self.next_test)
+
+        with self.counter.get_lock():
+            first = self.counter.value
+            self.counter.value = max(first, min(first + n, self.end_test + 1))
+            return range(first, self.counter.value)
+
+    def retry(self, tests):
+        self.retries.extend(tests)
+
+
+# reads data from an asyncio stream, and returns a list of complete frames,
+# or None if the connection was closed
+#
+# If a timer (connection.ResponseTimer) is specified, then the read takes
+# no longer than its adaptive timeout, and an empty list is returned
+# if nothing came in time
+async def read_frames(reader, decoder, timer = None):
+    if timer is None:
+        data = await reader.read(65536)
+    else:
+        try:
+            data = await asyncio.wait_for(reader.read(65536), timer.timeout())
+        except asyncio.TimeoutError:
+            timer.give_up()
+            return []
+        if data:
+            timer.received()
+    if not data:
+        return None
+    return decoder.feed(data)
+
+
+# ReactionTracker remembers how a peer reacted to tests, a reaction is
+# a sequence of types, flags and error codes of received frames,
+# or a closed connection. A test is interesting if it caused a new reaction.
+class ReactionTracker:
+
+    def __init__(self):
+        self.reactions = set()
+
+    @staticmethod
+    def reaction(frames):
+        if frames is None:
+            return None
+        reaction = []
+        for frame in frames:
+            if isinstance(frame, (http2core.RstStreamFrameView, http2core.GoAwayFrameView)):
+                reaction.append((frame.frame_type, frame.flags, frame.error_code()))
+            else:
+                reaction.append((frame.frame_type, frame.flags))
+        return tuple(reaction)
+
+    # returns True if the frames make up a new reaction
+    def update(self, frames):
+        return self.add(ReactionTracker.reaction(frames))
+
+    def add(self, reaction):
+        if reaction in self.reactions:
+            return False
+        self.reactions.add(reaction)
+        return True
+
+    def __len__(self):
+        return len(self.reactions)
+
+
+# SendWindow keeps tests which have been sent but not answered yet,
+# it's shared by a sender and a reader thread
+#
+# Each batch of tests is followed by a PING frame which carries a sequence number
+# of the batch. When an ACK for the PING is received, the batch and all batches
+# before it are answered. Other frames are matched to the oldest batch in flight
+# which sent a frame with the same stream id, or just to the oldest batch.
+# If no ACK comes in time, then most likely a fuzzed frame broke framing,
+# and the peer is waiting for the rest of that frame, so all batches are
+# given up, and the window is closed to re-connect.
+# Since an ACK tells exactly which batch was answered, a latency of the batch
+# is measured from the time when it was sent.
+class SendWindow:
+
+    ping_marker = b'hpoh'
+    sequence_ping = struct.Struct('>4sI')
+
+    def __init__(self, size, timeout = 1.0, latency = None):
+        self.size = size
+        self.timeout = timeout
+        self.latency = latency
+        self.sequence = 0
+        self.last_test = -1
+        self.in_flight = collections.OrderedDict()  # sequence -> [tests, stream ids, reaction]
+        self.sent_at = {}                           # sequence -> time when the batch was sent
+        self.control = []                           # frames which the reader asks to send
+        self.closed = False
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def stream_id(test_data):
+        if len(test_data) < http2core.frame_header_length:
+            return None
+        return http2core.unpack_uint32(test_data, 5) & 0x7FFFFFFF
+
+    # returns a PING frame which should be sent after the tests
+    def add(self, tests, stream_ids):
+        with self.condition:
+            self.sequence += 1
+            self.in_flight[self.sequence] = [tests, set(stream_ids), []]
+            self.sent_at[self.sequence] = time.monotonic()
+            self.last_test = tests[-1]
+            return (http2core.encode_frame_header(PingFrame.opaque_data_length,
+                                                  PingFrame.frame_type, 0x0, 0x0)
+                    + SendWindow.sequence_ping.pack(SendWindow.ping_marker, self.sequence))
+
+    # removes a batch which could not be sent
+    def cancel(self):
+        with self.condition:
+            self.in_flight.pop(self.sequence, None)
+            self.sent_at.pop(self.sequence, None)
+
+    # waits until there are less than specified number of batches in flight,
+    # returns batches which were given up, the window is closed in this case
+    def wait(self, max_in_flight):
+        with self.condition:
+            while not self.closed and len(self.in_flight) > max_in_flight:
+                if not self.condition.wait(self.timeout):
+                    self.closed = True
+                    expired = list(self.in_flight.values())
+                    self.in_flight.clear()
+                    self.sent_at.clear()
+                    return expired
+            return []
+
+    # waits until there is room for one more batch
+    def wait_for_room(self):
+        return self.wait(self.size - 1)
+
+    # waits until all batches are answered
+    def drain(self):
+        return self.wait(0)
+
+    # returns the oldest batch in flight which a frame belongs to
+    def find(self, frame):
+        with self.condition:
+            if not self.in_flight:
+                return None
+            if frame.stream_id != 0:
+                for batch in self.in_flight.values():
+                    if frame.stream_id in batch[1]:
+                        return batch
+            return next(iter(self.in_flight.values()))
+
+    # removes and returns batches which were answered by a PING ACK,
+    # or None if the frame is not an ACK for a sequence PING
+    def acknowledge(self, frame):
+        if not (isinstance(frame, http2core.PingFrameView) and frame.has_flag(http2core.ack_flag)
+                and len(frame.payload) == SendWindow.sequence_ping.size):
+            return None
+        marker, sequence = SendWindow.sequence_ping.unpack(frame.payload)
+        if marker != SendWindow.ping_marker:
+            return None
+
+        answered = []
+        with self.condition:
+            while self.in_flight and next(iter(self.in_flight)) <= sequence:
+                answered.append(self.in_flight.popitem(last = False)[1])
+            sent_at = self.sent_at.pop(sequence, None)
+            if sent_at is not None and self.latency is not None:
+                self.latency.add(time.monotonic() - sent_at)
+            for answered_sequence in [s for s in self.sent_at if s < sequence]:
+                del self.sent_at[answered_sequence]
+            self.condition.notify_all()
+        return answered
+
+    # returns all batches in flight, nothing can be sent after that
+    def close(self):
+        with self.condition:
+            self.closed = True
+            batches = list(self.in_flight.values())
+            self.in_flight.clear()
+            self.sent_at.clear()
+            self.condition.notify_all()
+            return batches
+
+    def is_closed(self):
+        with self.condition:
+            return self.closed
+
+    # frames like SETTINGS ACK are sent by the sender with next tests,
+    # so that the reader never blocks on sending
+    def send_later(self, data):
+        with self.condition:
+            self.control.append(bytes(data))
+
+    def take_control(self):
+        with self.condition:
+            control = self.control
+            self.control = []
+            return control
+
+
+# DumbHttp2ServerTest sends each test which uses a stream on a new stream,
+# stream ids are allocated for each connection, and a new connection is opened
+# only when stream ids or concurrent streams allowed by the server run out
 class DumbHttp2ServerTest(AbstractTest):
 
-    __max_stream_id = 2**31     # 31-bit stream id
+    max_receive_timeout = 5.0   # in seconds, with several connections
 
     def __init__(self, host = "localhost", port = 8080, is_tls = False,
                  seed = 1, min_ratio = 0.01, max_ratio = 0.05,
@@ -135,7 +437,10 @@ class DumbHttp2ServerTest(AbstractTest):
                  priority_fuzzer = True, rst_stream_fuzzer = True,
                  data_fuzzer = True, push_promise_fuzzer = True,
                  ping_fuzzer = True, goaway_fuzzer = True,
-                 window_update_fuzzer = True, continuation_fuzzer = True):
+                 window_update_fuzzer = True, continuation_fuzzer = True,
+                 hpack_structure_fuzzer = False,
+                 frames_per_send = 1, data_file = None, connections = 1,
+                 window = 1):
 
         if (seed == 0):
             raise Exception('Seed cannot be zero')
@@ -149,8 +454,23 @@ class DumbHttp2ServerTest(AbstractTest):
         self.max_ratio = max_ratio
         self.start_test = start_test
         self.end_test = end_test
+        self.frames_per_send = frames_per_send
+        self.data_file = data_file
+        self.connections = connections
+        self.window = window
         self.fuzzers = list()
-        self.next_fuzzer = 0
+        self.decoder = http2core.FrameDecoder()
+        self.batch = http2core.FrameBatch()
+        self.streams = http2core.StreamIdAllocator()
+        self.flow = http2core.FlowControl()
+        self.reactions = ReactionTracker()
+
+        # a client connection preface and a valid settings frame are sent together
+        self.preface = bytes(http2core.FrameBatch()
+                                .add_bytes(http2core.getclientpreface())
+                                .add(SettingsFrame())
+                                .view())
+
         if common_fuzzer:
             self.fuzzers.append(
                 DumbCommonFrameFuzzer(None, seed, min_ratio, max_ratio, start_test))
@@ -161,7 +481,6 @@ class DumbHttp2ServerTest(AbstractTest):
             self.fuzzers.append(DumbHeadersFuzzer(
                 default_request_headers, seed, min_ratio, max_ratio, start_test))
         if hpack_fuzzer:
-            # TODO: should it use different stream ids?
             headers_frame = HeadersFrame(0x1, default_request_headers)
             self.fuzzers.append(
                 DumbHPackFuzzer(headers_frame, seed, min_ratio, max_ratio, start_test))
@@ -188,58 +507,444 @@ class DumbHttp2ServerTest(AbstractTest):
         if continuation_fuzzer:
             self.fuzzers.append(DumbContinuationFuzzer(
                 default_request_headers, seed, min_ratio, max_ratio, start_test))
+        # it's off by default, since one more fuzzer would change
+        # which fuzzer runs a test with a given number
+        if hpack_structure_fuzzer:
+            self.fuzzers.append(DumbHPackStructureFuzzer(
+                default_request_headers, seed, min_ratio, max_ratio, start_test))
 
-    def next(self):
-        fuzzed_data = self.fuzzers[self.next_fuzzer].next()
-        self.next_fuzzer = (self.next_fuzzer + 1) % len(self.fuzzers)
-        return fuzzed_data
+    # returns data for a test, it depends only on a test number
+    # and a stream id from an allocator, so tests can be generated in any order,
+    # without an allocator, default stream ids are used
+    def generate(self, test, streams = None):
+        return self.fuzzer_for(test, streams).next()
+
+    # adds data for a test to a batch, it's the same data which generate() returns
+    def generate_into(self, batch, test, streams = None):
+        self.fuzzer_for(test, streams).next_into(batch)
+
+    # generates tests with specified numbers into a batch, and returns a view
+    # of the batch and offsets of the tests in it (the last offset is the end
+    # of the last test), frames which are already in the batch stay in front,
+    # by default, self.batch is cleared and used,
+    # numbers are global, so the tests are the same as if they were generated
+    # one by one, and a batch can be sent as is or stored
+    def next_batch(self, tests, streams = None, batch = None):
+        if batch is None:
+            batch = self.batch
+            batch.clear()
+        offsets = array.array('Q', [len(batch)])
+        for test in tests:
+            self.info('test {0:d}: start'.format(test))
+            self.generate_into(batch, test, streams)
+            offsets.append(len(batch))
+        return batch.view(), offsets
+
+    # returns a fuzzer which is ready to generate a test
+    def fuzzer_for(self, test, streams = None):
+        fuzzer = self.fuzzers[test % len(self.fuzzers)]
+        fuzzer.set_test(test)
+        set_stream_ids(fuzzer, streams)
+        return fuzzer
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbHttp2ServerTest.__name__, messages[0], messages[1:])
+        tracer.info(DumbHttp2ServerTest.__name__, *messages)
 
     def run(self):
+        # a body from a file is sent once per run, not after each re-connect
+        self.uploaded = False
+        if self.connections > 1:
+            return asyncio.run(self.run_connections())
+        if self.window > 1:
+            return self.run_pipelined()
+
         self.client = connection.Client(self.host, self.port, self.is_tls)
 
         self.info('started, test range {0}:{1}'
                     .format(self.start_test, self.end_test))
+        self.stats = collections.Counter()
         test = self.start_test
         successfully_sent = True
         while test <= self.end_test:
             if self.client.isconnected() is False:
                 self.client.connect()
-                self.info('send a client connection preface')
-                self.client.send(http2core.getclientpreface())
-                self.info('send a valid settings frame')
+                self.stats['connections'] += 1
+                self.decoder.reset()
+                self.streams.reset()
+                self.flow.reset()
+                self.info('send a client connection preface and a valid settings frame')
+                self.client.send(self.preface)
+                self.receive(test)
+                if self.upload_pending() and self.client.isconnected():
+                    self.upload(test)
+
+                # tests are generated again since stream ids start over
+                successfully_sent = True
 
-                # TODO: it can be created once
-                settings = SettingsFrame()
-                self.client.send(settings.encode())
-                data = self.client.receive()
+            if successfully_sent and self.streams.exhausted(self.frames_per_send):
+                self.info('test {0:d}: no more streams, re-connect'.format(test))
+                self.stats['stream_reconnects'] += 1
+                self.client.close()
+                continue
 
             try:
-                self.info('test {0:d}: start'.format(test))
                 if successfully_sent:
-                    fuzzed_data = self.next()
+                    # several tests may be sent with one call
+                    last_test = min(test + self.frames_per_send - 1, self.end_test)
+                    data, offsets = self.next_batch(range(test, last_test + 1), self.streams)
                     successfully_sent = False
-                self.client.send(fuzzed_data)
+                self.client.send(data)
                 successfully_sent = True
+                self.stats['tests'] += last_test - test + 1
             except socket.error as msg:
                 # move on to next test only if current one was successfully sent out
                 # TODO: delay?
+                self.stats['send_errors'] += 1
                 self.info('test {0:d}: a error occured while sending data: {1}'
                             .format(test, msg))
                 self.info('test {0:d}: re-connect'.format(test))
                 continue
 
             try:
-                data = self.client.receive()
-                self.info('test {0:d}: received data:'.format(test), helper.bytes2hex(data))
+                self.receive(last_test, range(test, last_test + 1))
             except socket.error as msg:
+                self.stats['receive_errors'] += 1
                 self.info('test {0:d}: a error occured while receiving data, ignore it: {1}'
+                            .format(last_test, msg))
+
+            test = last_test + 1
+
+        self.info('finished, header block cache: {0}'.format(http2core.header_block_cache),
+                  'reactions: {0:d}'.format(len(self.reactions)),
+                  'latency: {0}'.format(self.client.latency))
+        return self.get_stats()
+
+    # returns counters and reactions which can be merged with stats of other runs
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['reactions'] = set(self.reactions.reactions)
+        return stats
+
+    # sends up to self.window batches of tests without waiting for responses,
+    # a reader thread receives frames and matches them to batches
+    def run_pipelined(self):
+        # latencies are measured by the window from PING ACKs
+        self.client = connection.Client(self.host, self.port, self.is_tls, timed = False)
+        self.info('started, test range {0}:{1}, window: {2:d}'
+                    .format(self.start_test, self.end_test, self.window))
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()    # guards fuzzers and logs
+        test = self.start_test
+        while test <= self.end_test:
+            self.client.connect()
+            self.stats['connections'] += 1
+            self.decoder.reset()
+            self.streams.reset()
+            self.flow.reset()
+            self.info('send a client connection preface and a valid settings frame')
+            self.client.send(self.preface)
+            self.receive(test)
+            if not self.client.isconnected():
+                continue
+            if self.upload_pending():
+                self.upload(test)
+            if not self.client.isconnected():
+                continue
+
+            window = SendWindow(self.window, latency = self.client.latency)
+            reader = threading.Thread(target = self.read_responses, args = (window, ))
+            reader.start()
+            try:
+                test = self.send_pipelined(window, test)
+                self.complete(window.drain())
+            finally:
+                self.complete(window.close(), True)
+
+                # the reader stops when it sees the end of the stream,
+                # the client is closed after that, so the reader never re-connects
+                self.client.shutdown()
+                reader.join()
+                self.client.close()
+
+        self.info('finished, header block cache: {0}'.format(http2core.header_block_cache),
+                  'reactions: {0:d}'.format(len(self.reactions)),
+                  'latency: {0}'.format(self.client.latency))
+        return self.get_stats()
+
+    # sends tests until all of them are sent or the window is closed,
+    # returns a next test to send
+    def send_pipelined(self, window, test):
+        while test <= self.end_test:
+            expired = window.wait_for_room()
+            if expired:
+                self.info('test {0:d}: no response in time, re-connect'.format(test))
+            self.complete(expired)
+            if window.is_closed():
+                return test
+
+            last_test = min(test + self.frames_per_send - 1, self.end_test)
+            with self.lock:
+                exhausted = self.streams.exhausted(last_test - test + 1)
+            if exhausted:
+                # batches in flight are still answered before re-connecting
+                self.info('test {0:d}: no more streams, re-connect'.format(test))
+                self.stats['stream_reconnects'] += 1
+                return test
+
+            self.batch.clear()
+            for control in window.take_control():
+                self.batch.add_bytes(control)
+            tests = range(test, last_test + 1)
+            with self.lock:
+                data, offsets = self.next_batch(tests, self.streams, self.batch)
+            stream_ids = [SendWindow.stream_id(data[offsets[i]:offsets[i + 1]])
+                          for i in range(len(tests))]
+            self.batch.add_bytes(window.add(tests, stream_ids))
+
+            try:
+                self.client.send(self.batch.view())
+                self.stats['tests'] += len(tests)
+            except socket.error as msg:
+                # the tests are sent again after re-connecting
+                self.stats['send_errors'] += 1
+                self.info('test {0:d}: a error occured while sending data: {1}'
                             .format(test, msg))
+                window.cancel()
+                self.complete(window.close(), True)
+                return test
+
+            test = last_test + 1
 
-            test += 1
+        return test
+
+    def read_responses(self, window):
+        while not window.is_closed():
+            try:
+                frames = self.decoder.receive(self.client.receive_into)
+            except socket.error as msg:
+                self.info('a error occured while receiving data: {0}'.format(msg))
+                frames = None
+
+            if frames is None:
+                self.complete(window.close(), True)
+                return
+
+            for frame in frames:
+                answered = window.acknowledge(frame)
+                if answered is not None:
+                    self.complete(answered)
+                    continue
+                batch = window.find(frame)
+                test = batch[0][-1] if batch is not None else window.last_test
+                with self.lock:
+                    self.streams.process([frame])
+                    if not process_frames(test, [frame], window.send_later, self.info):
+                        self.complete(window.close(), True)
+                        return
+                if batch is not None:
+                    batch[2].extend(ReactionTracker.reaction([frame]))
+
+    # tells fuzzers how the peer reacted to tests in batches which are done,
+    # the reaction is None if the connection was closed
+    def complete(self, batches, closed = False):
+        with self.lock:
+            for tests, stream_ids, reaction in batches:
+                interesting = self.reactions.add(None if closed else tuple(reaction))
+                for test in tests:
+                    self.fuzzers[test % len(self.fuzzers)].feedback(test, interesting)
+
+    # runs tests with several connections at once, each connection takes
+    # next tests from a dispatcher, since a test depends only on its number,
+    # the same tests are sent as in the serial mode
+    async def run_connections(self):
+        self.info('started, test range {0}:{1}, connections: {2:d}'
+                    .format(self.start_test, self.end_test, self.connections))
+        self.stats = collections.Counter()
+        self.latency = connection.LatencyTracker(max_timeout = self.max_receive_timeout)
+        dispatcher = TestDispatcher(self.start_test, self.end_test)
+        await asyncio.gather(*[self.run_connection(dispatcher, number)
+                               for number in range(self.connections)])
+        self.info('finished, header block cache: {0}'.format(http2core.header_block_cache),
+                  'reactions: {0:d}'.format(len(self.reactions)),
+                  'latency: {0}'.format(self.latency))
+        return self.get_stats()
+
+    # all connections share one latency tracker, a response is treated
+    # as no response if it doesn't come in time
+    async def run_connection(self, dispatcher, number):
+        decoder = http2core.FrameDecoder()
+        streams = http2core.StreamIdAllocator()
+        flow = http2core.FlowControl()
+        timer = connection.ResponseTimer(self.latency)
+        context = None
+        if self.is_tls:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+            context.set_alpn_protocols(['h2'])
+
+        while not dispatcher.done():
+            self.info('connection {0:d}: connect to {1}:{2:d}'
+                        .format(number, self.host, self.port))
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl = context)
+            self.stats['connections'] += 1
+            try:
+                decoder.reset()
+                streams.reset()
+                flow.reset()
+                timer.reset()
+                writer.write(self.preface)
+                await writer.drain()
+                timer.sent()
+                frames = await read_frames(reader, decoder, timer)
+                streams.process(frames)
+                flow.process(frames)
+                if not process_frames(dispatcher.upcoming(), frames, writer.write, self.info):
+                    continue
+                if self.upload_pending():
+                    usable = await self.upload_async(dispatcher.upcoming(), reader, writer,
+                                                     decoder, streams, flow, timer)
+                    if not usable:
+                        continue
+                await self.run_tests(dispatcher, reader, writer, decoder, streams, timer)
+            except OSError as msg:
+                self.info('connection {0:d}: a error occured: {1}'.format(number, msg))
+            finally:
+                writer.close()
+
+    # sends tests until the connection is closed, there are no more tests,
+    # or no more streams can be opened
+    async def run_tests(self, dispatcher, reader, writer, decoder, streams, timer = None):
+        while True:
+            if streams.exhausted(self.frames_per_send):
+                self.info('no more streams, re-connect')
+                self.stats['stream_reconnects'] += 1
+                return
+
+            tests = dispatcher.take(self.frames_per_send)
+            if not tests:
+                return
+
+            try:
+                # a transport may keep a reference to data which has not been sent yet,
+                # so a batch is not re-used
+                data, offsets = self.next_batch(tests, streams, http2core.FrameBatch())
+                writer.write(data)
+                await writer.drain()
+                if timer is not None:
+                    timer.sent()
+                self.stats['tests'] += len(tests)
+            except OSError as msg:
+                self.stats['send_errors'] += 1
+                self.info('test {0:d}: a error occured while sending data: {1}'
+                            .format(tests[0], msg))
+                dispatcher.retry(tests)
+                raise
+
+            try:
+                frames = await read_frames(reader, decoder, timer)
+            except OSError as msg:
+                self.stats['receive_errors'] += 1
+                self.info('test {0:d}: a error occured while receiving data, ignore it: {1}'
+                            .format(tests[-1], msg))
+                continue
+
+            self.feedback(tests, frames)
+            streams.process(frames)
+            if not process_frames(tests[-1], frames, writer.write, self.info):
+                return
+
+    def upload_pending(self):
+        return self.data_file is not None and not self.uploaded
+
+    # returns a HEADERS frame which starts a request with a body of specified size
+    def upload_headers(self, stream_id, size):
+        headers = [(':method',    'POST'),
+                   (':scheme',    'https' if self.is_tls else 'http'),
+                   (':authority', '{0}:{1:d}'.format(self.host, self.port)),
+                   (':path',      '/')]
+        headers.extend(upload_request_headers)
+        headers.append(('content-length', str(size)))
+        frame = HeadersFrame(stream_id, headers)
+        frame.flags &= ~http2core.end_stream_flag
+        return frame.encode()
+
+    def upload_stream(self, stream_id):
+        stream = http2core.DataStream(self.data_file, stream_id,
+                                      SettingsFrame().settings_max_frame_size)
+        self.info('send {0:d} bytes from {1}'.format(stream.size(), self.data_file))
+        return stream
+
+    # sends a request with a body from a file, the body is sent in DATA frames
+    # which are read from the file while sending, as long as flow-control
+    # windows of the server allow it, the rest of the body is not sent
+    # if the windows are not updated in time
+    def upload(self, test):
+        self.uploaded = True
+        stream_id = self.streams.allocate()
+        self.flow.open(stream_id)
+        stream = self.upload_stream(stream_id)
+        self.client.send(self.upload_headers(stream_id, stream.size()))
+        stream.send(self.client, self.flow, lambda: self.wait_for_window(test))
+        self.flow.close(stream_id)
+
+    # receives frames which may update flow-control windows,
+    # returns False if the upload should stop
+    def wait_for_window(self, test):
+        pending = self.decoder.pending()
+        frames = self.decoder.receive(self.client.receive_into)
+        if frames == [] and self.decoder.pending() == pending:
+            self.info('test {0:d}: no window update in time, stop sending data'.format(test))
+            return False
+        self.streams.process(frames)
+        self.flow.process(frames)
+        if not process_frames(test, frames, self.client.send, self.info):
+            self.client.close()
+            return False
+        return True
+
+    # a transport may keep data which has not been sent yet,
+    # so payloads are copied since they refer to the memory-mapped file,
+    # returns False if the connection can't be used any more
+    async def upload_async(self, test, reader, writer, decoder, streams, flow, timer = None):
+        self.uploaded = True
+        stream_id = streams.allocate()
+        flow.open(stream_id)
+        stream = self.upload_stream(stream_id)
+        writer.write(self.upload_headers(stream_id, stream.size()))
+        for header, payload in stream.frames(flow):
+            if header is None:
+                pending = decoder.pending()
+                frames = await read_frames(reader, decoder, timer)
+                if frames == [] and decoder.pending() == pending:
+                    self.info('test {0:d}: no window update in time, stop sending data'
+                                .format(test))
+                    break
+                streams.process(frames)
+                flow.process(frames)
+                if not process_frames(test, frames, writer.write, self.info):
+                    return False
+                continue
+            writer.write(header)
+            writer.write(bytes(payload))
+            await writer.drain()
+        flow.close(stream_id)
+        return True
+
+    # receives frames after specified tests were sent,
+    # and tells the fuzzers if the tests caused a new reaction
+    def receive(self, test, tests = ()):
+        frames = self.decoder.receive(self.client.receive_into)
+        self.feedback(tests, frames)
+        self.streams.process(frames)
+        self.flow.process(frames)
+        if not process_frames(test, frames, self.client.send, self.info):
+            self.client.close()
+
+    def feedback(self, tests, frames):
+        if len(tests) == 0:
+            return
+        interesting = self.reactions.update(frames)
+        for test in tests:
+            self.fuzzers[test % len(self.fuzzers)].feedback(test, interesting)
 
     def close(self):
         self.client.close()
@@ -247,7 +952,7 @@ class DumbHttp2ServerTest(AbstractTest):
 
 class DumbHttp2ClientTest(AbstractTest):
 
-    __max_stream_id = 2**31     # 31-bit stream id
+    receive_timeout = 5.0   # in seconds, a client which doesn't answer is disconnected
 
     def __init__(self,
                  port           = 8080,
@@ -268,7 +973,10 @@ class DumbHttp2ClientTest(AbstractTest):
                  ping_fuzzer            = True,
                  goaway_fuzzer          = True,
                  window_update_fuzzer   = True,
-                 continuation_fuzzer    = True):
+                 continuation_fuzzer    = True,
+                 hpack_structure_fuzzer = False,
+                 reuse_port             = False,
+                 counter                = None):
 
         if (seed == 0):
             raise Exception('Seed cannot be zero')
@@ -281,9 +989,19 @@ class DumbHttp2ClientTest(AbstractTest):
         self.max_ratio = max_ratio
         self.start_test = start_test
         self.end_test = end_test
-        self.test = start_test
+        self.reuse_port = reuse_port
+        self.dispatcher = TestDispatcher(start_test, end_test, counter)
+        self.stats = collections.Counter()
         self.fuzzers = list()
-        self.next_fuzzer = 0
+        self.reactions = ReactionTracker()
+
+        # TODO: hack for hghtt2, the spec recommends to enable push,
+        #       but nghttp2 client doesn't work with it
+        #       can it be configured in command line?
+        settings = SettingsFrame()
+        settings.disable_push()
+        self.settings = settings.encode()
+
         if common_fuzzer:
             self.fuzzers.append(
                 DumbCommonFrameFuzzer(None, seed, min_ratio, max_ratio, start_test))
@@ -321,59 +1039,110 @@ class DumbHttp2ClientTest(AbstractTest):
         if continuation_fuzzer:
             self.fuzzers.append(DumbContinuationFuzzer(
                 default_response_headers, seed, min_ratio, max_ratio, start_test))
+        # it's off by default, since one more fuzzer would change
+        # which fuzzer runs a test with a given number
+        if hpack_structure_fuzzer:
+            self.fuzzers.append(DumbHPackStructureFuzzer(
+                default_response_headers, seed, min_ratio, max_ratio, start_test))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbHttp2ClientTest.__name__, messages[0], messages[1:])
+        tracer.info(DumbHttp2ClientTest.__name__, *messages)
 
+    # serves several clients at once, each connection takes next tests
+    # from a dispatcher, and tests which could not be sent are given to next connections
     def run(self):
         self.info('started, test range {0}:{1}'
                   .format(self.start_test, self.end_test))
-        self.server = connection.Server(self.port, self, self.is_tls)
+        self.server = connection.AsyncServer(self.port, self, self.is_tls, self.reuse_port)
         self.server.start()
+        return self.get_stats()
 
-    # TODO: create a wrapper for socket read/write/connected operations
-    #       (use it here instead of socket)
-    def handle(self, socket):
-        self.info('send a valid settings frame')
-
-        # TODO: it can be created once
-        settings = SettingsFrame()
+    # the server stops accepting connections when all tests are done
+    def done(self):
+        return self.dispatcher.done()
 
-        # TODO: hack for hghtt2, the spec recommends to enable push,
-        #       but nghttp2 client doesn't work with it
-        #       can it be configured in command line?
-        settings.disable_push()
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['reactions'] = set(self.reactions.reactions)
+        return stats
 
-        socket.send(settings.encode())
-        data = socket.recv(1024)
+    # streams are opened and promised by the server, so each connection
+    # has a server-side allocator, and the client is disconnected
+    # when stream ids or concurrent streams allowed by the client run out
+    async def handle(self, reader, writer):
+        self.info('send a valid settings frame')
+        writer.write(self.settings)
+        decoder = http2core.FrameDecoder()
+        streams = http2core.StreamIdAllocator(is_client = False)
+        try:
+            frames = await self.receive(reader, decoder)
+        except asyncio.TimeoutError:
+            self.info('no settings from the client, disconnect')
+            return
+        streams.process(frames)
+        if not process_frames(self.dispatcher.upcoming(), frames, writer.write, self.info):
+            return
 
         # TODO: HTTP/2 server must include ":status" pseudo-header field in all
         #       responses; otherwise, the response is malformed
 
-        while (self.test <= self.end_test):
+        while True:
+            if streams.exhausted():
+                self.info('no more streams, disconnect')
+                self.stats['stream_reconnects'] += 1
+                break
+
+            tests = self.dispatcher.take(1)
+            if not tests:
+                break
+            test = tests[0]
+
             try:
-                self.info('test {0:d}: start'.format(self.test))
-                fuzzer = self.fuzzers[self.next_fuzzer]
-                fuzzer.set_test(self.test)
-                fuzzed_data = fuzzer.next()
-                self.next_fuzzer = (self.next_fuzzer + 1) % len(self.fuzzers)
-                socket.sendall(fuzzed_data)
+                self.info('test {0:d}: start'.format(test))
+                writer.write(self.generate(test, streams))
+                await writer.drain()
+                self.stats['tests'] += 1
             except OSError as msg:
+                self.stats['send_errors'] += 1
                 self.info('test {0:d}: a error occured while sending data: {1}'
-                            .format(self.test, msg))
-                self.info('test {0:d}: will be run again '.format(self.test))
+                            .format(test, msg))
+                self.info('test {0:d}: will be run again '.format(test))
+                self.dispatcher.retry(tests)
                 break
 
             try:
-                data = socket.recv(1024)
-                self.info('test {0:d}: received data:'
-                            .format(self.test), helper.bytes2hex(data))
+                frames = await self.receive(reader, decoder)
+                self.feedback(test, frames)
+                streams.process(frames)
+                if not process_frames(test, frames, writer.write, self.info):
+                    break
+            except asyncio.TimeoutError:
+                self.stats['timeouts'] += 1
+                self.info('test {0:d}: no response in time, disconnect'.format(test))
+                break
             except OSError as msg:
+                self.stats['receive_errors'] += 1
                 self.info('test {0:d}: a error occured while receiving data, ignore it: {1}'
-                            .format(self.test, msg))
+                            .format(test, msg))
+
+        self.info('header block cache: {0}'.format(http2core.header_block_cache))
 
-            self.test += 1
+    async def receive(self, reader, decoder):
+        return await asyncio.wait_for(read_frames(reader, decoder),
+                                      DumbHttp2ClientTest.receive_timeout)
+
+    # returns data for a test, it depends only on a test number
+    # and stream ids from an allocator
+    def generate(self, test, streams = None):
+        fuzzer = self.fuzzers[test % len(self.fuzzers)]
+        fuzzer.set_test(test)
+        set_stream_ids(fuzzer, streams, streams)
+        return fuzzer.next()
+
+    # tells a fuzzer if a test caused a new reaction
+    def feedback(self, test, frames):
+        interesting = self.reactions.update(frames)
+        self.fuzzers[test % len(self.fuzzers)].feedback(test, interesting)
 
     def close(self):
         self.server.close()
@@ -381,6 +1150,17 @@ class DumbHttp2ClientTest(AbstractTest):
 
 class AbstractDumbFuzzer:
 
+    # fuzzers which send frames on a stream can get a new stream id for each test,
+    # fuzzers which open a stream make it active, fuzzers which target an open stream
+    # re-use a stream of a previous test, and fuzzers which promise a stream
+    # can get a new promised stream id for each test
+    uses_stream = False
+    opens_stream = False
+    targets_open_stream = False
+    promises_stream = False
+    default_stream_id = 0x1
+    default_promised_stream_id = 0x2
+
     def __init__(self, seed = 1, min_ratio = 0.01, max_ratio = 0.05, start_test = 0, fuzzer = None):
         self.seed = seed
         self.min_ratio = min_ratio
@@ -388,6 +1168,11 @@ class AbstractDumbFuzzer:
         self.start_test = start_test
         self.test = start_test
         self.fuzzer = fuzzer
+        self.stream_id = self.default_stream_id
+        self.promised_stream_id = self.default_promised_stream_id
+
+        # random values depend on a fuzzer id, a seed and a test number only
+        self.fuzzer_id = self.__class__.__name__
 
     def set_test(self, test):
         self.test = test
@@ -397,15 +1182,35 @@ class AbstractDumbFuzzer:
     def set_fuzzer(self, fuzzer):
         self.fuzzer = fuzzer
 
-    def next(self):
-        self.info('Called AbstractDumbFuzzer.next(), return nothing')
+    def set_stream_id(self, stream_id):
+        self.stream_id = stream_id
+
+    def set_promised_stream_id(self, promised_stream_id):
+        self.promised_stream_id = promised_stream_id
+
+    # tells an underlying fuzzer if a test caused a new reaction,
+    # a mutation scheduler uses it to choose mutation operators
+    def feedback(self, test, interesting):
+        if self.fuzzer is not None:
+            self.fuzzer.feedback(test, interesting)
+
+    # returns data for a next test
+    def next(self, *args):
+        batch = http2core.FrameBatch(0)
+        self.next_into(batch, *args)
+        return batch.buffer[:len(batch)]
+
+    # adds a next test to a batch (http2core.FrameBatch),
+    # frames are encoded right into the batch
+    def next_into(self, batch):
+        self.info('Called AbstractDumbFuzzer.next_into(), add nothing')
 
     def reset(self):
-        self.fuzzer.reset()
+        if self.fuzzer is not None:
+            self.fuzzer.reset()
 
     def info(self, *messages):
-        helper.print_with_indent(
-            AbstractDumbFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(AbstractDumbFuzzer.__name__, *messages)
 
 
 class DumbCommonFrameFuzzer(AbstractDumbFuzzer):
@@ -423,16 +1228,16 @@ class DumbCommonFrameFuzzer(AbstractDumbFuzzer):
             self.frame_bytes = Frame(DumbCommonFrameFuzzer.__default_frame_type).encode(payload)
         else:
             self.frame_bytes = frame_bytes
-        self.set_fuzzer(DumbByteArrayFuzzer(
-            self.frame_bytes, seed, min_ratio, max_ratio, start_test, ignored_bytes))
+        self.set_fuzzer(create_byte_array_fuzzer(
+            self.frame_bytes, seed, min_ratio, max_ratio, start_test, ignored_bytes,
+            fuzzer_id = self.fuzzer_id))
 
-    def next(self):
+    def next_into(self, batch):
         self.info('generate a frame')
-        return self.fuzzer.next()
+        batch.add_patched(self.fuzzer.next_patch())
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbCommonFrameFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbCommonFrameFuzzer.__name__, *messages)
 
 
 # TODO: fuzz CONTINUATION frame flags
@@ -440,6 +1245,9 @@ class DumbCommonFrameFuzzer(AbstractDumbFuzzer):
 # TODO: send fuzzed CONTINUATION frames
 class DumbContinuationFuzzer(AbstractDumbFuzzer):
 
+    uses_stream = True
+    targets_open_stream = True
+
     def __init__(self, headers = None, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0, ignored_symbols = (),
                  ignored_header_names = ('accept', ':scheme', ':method', ':path')):
@@ -450,24 +1258,25 @@ class DumbContinuationFuzzer(AbstractDumbFuzzer):
             raise Exception('headers not specified')
         self.headers = headers
 
-        self.verbose('original headers:', str(self.headers))
+        self.verbose('original headers:', self.headers)
         self.set_fuzzer(DumbDictionaryFuzzer(self.headers, seed,
                                              min_ratio, max_ratio, start_test,
-                                             ignored_symbols, ignored_header_names))
+                                             ignored_symbols, ignored_header_names,
+                                             fuzzer_id = self.fuzzer_id))
 
-    def next(self, stream_id = 1, promised_stream_id = 2):
+    def next_into(self, batch, stream_id = None):
+        if stream_id is None:
+            stream_id = self.stream_id
         self.info('generate a continuation frame, stream id = {0:d}'.format(stream_id))
         fuzzed_headers = self.fuzzer.next()
-        self.verbose('fuzzed headers:', str(fuzzed_headers))
-        return ContinuationFrame(stream_id, fuzzed_headers).encode()
+        self.verbose('fuzzed headers:', fuzzed_headers)
+        batch.add(ContinuationFrame(stream_id, fuzzed_headers))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbContinuationFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbContinuationFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbContinuationFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbContinuationFuzzer.__name__, *messages)
 
 
 # TODO: fuzz DATA frame flags
@@ -475,6 +1284,9 @@ class DumbContinuationFuzzer(AbstractDumbFuzzer):
 #       (data may depend on client/server mode)
 class DumbDataFuzzer(AbstractDumbFuzzer):
 
+    uses_stream = True
+    targets_open_stream = True
+
     def __init__(self, data = None, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0, ignored_symbols = ()):
 
@@ -489,23 +1301,24 @@ class DumbDataFuzzer(AbstractDumbFuzzer):
         else:
             self.data = data
 
-        self.verbose('original data:', helper.bytes2hex(self.data))
-        self.set_fuzzer(DumbByteArrayFuzzer(
-            self.data, seed, min_ratio, max_ratio, start_test, ignored_symbols))
+        self.verbose('original data:', helper.hexdump(self.data))
+        self.set_fuzzer(create_byte_array_fuzzer(
+            self.data, seed, min_ratio, max_ratio, start_test, ignored_symbols,
+            fuzzer_id = self.fuzzer_id))
 
-    def next(self, stream_id = 1):
+    def next_into(self, batch, stream_id = None):
+        if stream_id is None:
+            stream_id = self.stream_id
         self.info('generate a data frame, stream id = {0:d}'.format(stream_id))
         fuzzed_data = self.fuzzer.next()
-        self.verbose('fuzzed data:', helper.bytes2hex(fuzzed_data))
-        return DataFrame(stream_id, fuzzed_data).encode()
+        self.verbose('fuzzed data:', helper.hexdump(fuzzed_data))
+        batch.add(DataFrame(stream_id, fuzzed_data))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbDataFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbDataFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbDataFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbDataFuzzer.__name__, *messages)
 
 
 # TODO: fuzz GOAWAY frame flags even if the spec doesn't define any
@@ -518,37 +1331,31 @@ class DumbGoAwayFuzzer(AbstractDumbFuzzer):
 
     def __init__(self, seed = 1, min_ratio = 0.01, max_ratio = 0.05, start_test = 0):
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
-        self.random_last_stream_id = random.Random()
-        self.random_error_code = random.Random()
-        self.random_debug_data = random.Random()
+        self.template = GoAwayFrame.template()
 
-    def next(self, stream_id = 0x0):
+    def next_into(self, batch, stream_id = 0x0):
         self.info('generate a goaway frame, stream id = {0:d}'.format(stream_id))
 
-        self.random_last_stream_id.seed(self.seed * self.test)
-        self.random_error_code.seed(self.seed * self.test)
-        self.random_debug_data.seed(self.seed * self.test)
+        random_generator = helper.test_random(self.seed, self.fuzzer_id, self.test)
+        self.test += 1
 
-        last_stream_id = self.random_last_stream_id.randint(
+        last_stream_id = random_generator.randint(
             0, DumbGoAwayFuzzer.__max_last_stream_id)
-        error_code = self.random_error_code.randint(
+        error_code = random_generator.randint(
             0, DumbGoAwayFuzzer.__max_error_code)
 
-        debug_data = bytearray()
-        debug_data_length = self.random_debug_data.randint(
+        debug_data_length = random_generator.randint(
             0, DumbGoAwayFuzzer.__max_debug_data_length)
-        for i in range(debug_data_length):
-            debug_data.append(self.random_debug_data.randint(0, 255))
+        debug_data = random_generator.randbytes(debug_data_length)
 
-        return GoAwayFrame(last_stream_id, error_code, debug_data).encode()
+        batch.add_template(self.template, debug_data, stream_id = stream_id,
+                           last_stream_id = last_stream_id, error_code = error_code)
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbGoAwayFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbGoAwayFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbGoAwayFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbGoAwayFuzzer.__name__, *messages)
 
 
 # TODO: fuzz HEADER frame flags
@@ -556,6 +1363,9 @@ class DumbGoAwayFuzzer(AbstractDumbFuzzer):
 # TODO: send fuzzed CONTINUATION frames
 class DumbHeadersFuzzer(AbstractDumbFuzzer):
 
+    uses_stream = True
+    opens_stream = True
+
     def __init__(self, headers = None, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0, ignored_symbols = (),
                  ignored_header_names = ('accept', ':scheme', ':method', ':path')):
@@ -566,55 +1376,92 @@ class DumbHeadersFuzzer(AbstractDumbFuzzer):
             raise Exception('headers not specified')
         self.headers = headers
 
-        self.verbose('original headers:', str(self.headers))
+        self.verbose('original headers:', self.headers)
         self.set_fuzzer(DumbDictionaryFuzzer(self.headers, seed,
                                              min_ratio, max_ratio,
                                              start_test,
-                                             ignored_symbols, ignored_header_names))
+                                             ignored_symbols, ignored_header_names,
+                                             fuzzer_id = self.fuzzer_id))
 
-    def next(self, stream_id = 1):
+    def next_into(self, batch, stream_id = None):
+        if stream_id is None:
+            stream_id = self.stream_id
         self.info('generate a headers frame, stream id = {0:d}'.format(stream_id))
         fuzzed_headers = self.fuzzer.next()
-        self.verbose('fuzzed headers:', str(fuzzed_headers))
-        return HeadersFrame(stream_id, fuzzed_headers).encode()
+        self.verbose('fuzzed headers:', fuzzed_headers)
+        batch.add(HeadersFrame(stream_id, fuzzed_headers))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbHeadersFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbHeadersFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbHeadersFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbHeadersFuzzer.__name__, *messages)
 
 
 class DumbHPackFuzzer(AbstractDumbFuzzer):
 
+    uses_stream = True
+    opens_stream = True
+
     def __init__(self, headers_frame = None, seed = 1,
                  min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0):
 
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
-        self.stream_id = 0x1
 
         if headers_frame is None:
             raise Exception('headers frame not specified')
         self.headers_frame = headers_frame
 
-        self.set_fuzzer(DumbByteArrayFuzzer(
-            self.headers_frame.payload(), seed, min_ratio, max_ratio, start_test))
+        self.set_fuzzer(create_byte_array_fuzzer(
+            self.headers_frame.payload(), seed, min_ratio, max_ratio, start_test,
+            fuzzer_id = self.fuzzer_id))
 
-    def next(self):
-        fuzzed_payload = self.fuzzer.next()
-        return Frame(HeadersFrame.frame_type,
-                     self.headers_frame.flags, self.stream_id).encode(fuzzed_payload)
+    def next_into(self, batch):
+        fuzzed_payload = self.fuzzer.next_patch()
+        batch.add_patched(fuzzed_payload, Frame(HeadersFrame.frame_type,
+                                                self.headers_frame.flags, self.stream_id))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbHPackFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbHPackFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbHPackFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbHPackFuzzer.__name__, *messages)
+
+
+# DumbHPackStructureFuzzer generates header blocks with HPackGenerator
+# instead of changing random bytes in an encoded header block,
+# so that representations, integers and string lengths are fuzzed
+class DumbHPackStructureFuzzer(AbstractDumbFuzzer):
+
+    uses_stream = True
+    opens_stream = True
+
+    def __init__(self, headers = None, seed = 1,
+                 min_ratio = 0.01, max_ratio = 0.05, start_test = 0):
+
+        AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
+
+        if headers is None:
+            raise Exception('headers not specified')
+        self.generator = http2core.HPackGenerator(headers, max_ratio)
+        self.flags = http2core.end_headers_flag | http2core.end_stream_flag
+
+    def reset(self):
+        self.set_test(self.start_test)
+
+    def next_into(self, batch):
+        random_generator = helper.test_random(self.seed, self.fuzzer_id, self.test)
+        self.test += 1
+        header_block = self.generator.generate(random_generator)
+        self.verbose('header block:', helper.hexdump(header_block))
+        batch.add(Frame(HeadersFrame.frame_type, self.flags, self.stream_id), header_block)
+
+    def info(self, *messages):
+        tracer.info(DumbHPackStructureFuzzer.__name__, *messages)
+
+    def verbose(self, *messages):
+        tracer.verbose(DumbHPackStructureFuzzer.__name__, *messages)
 
 
 # TODO: fuzz PING frame flags
@@ -624,59 +1471,56 @@ class DumbPingFuzzer(AbstractDumbFuzzer):
 
     def __init__(self, seed = 1, min_ratio = 0.01, max_ratio = 0.05, start_test = 0):
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
-        self.random = random.Random()
+        self.template = PingFrame.template()
 
-    def next(self, stream_id = 0x0):
+    def next_into(self, batch, stream_id = 0x0):
         self.info('generate a ping frame, stream id = {0:d}'.format(stream_id))
-        self.random.seed(self.seed * self.test)
-        data = bytearray()
-        for i in range(PingFrame.opaque_data_length):
-            data.append(self.random.randint(0, 255))
-        self.verbose('fuzzed data:', helper.bytes2hex(data))
-        return PingFrame(data).encode()
+        random_generator = helper.test_random(self.seed, self.fuzzer_id, self.test)
+        self.test += 1
+        data = random_generator.randbytes(PingFrame.opaque_data_length)
+        self.verbose('fuzzed data:', helper.hexdump(data))
+        batch.add_template(self.template, stream_id = stream_id, opaque_data = data)
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbPingFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbPingFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbPingFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbPingFuzzer.__name__, *messages)
 
 
 # TODO: fuzz PRIORITY frame flags (even if PRIORITY frame doesn't define any)
 class DumbPriorityFuzzer(AbstractDumbFuzzer):
 
-    __default_stream_id = 0x1
+    uses_stream = True
 
     def __init__(self, priority_frame = None, seed = 1,
                  min_ratio = 0.01, max_ratio = 0.05, start_test = 0, ignored_bytes = ()):
 
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
-        self.stream_id = DumbPriorityFuzzer.__default_stream_id
 
         if priority_frame is None:
             self.priority_frame = PriorityFrame(self.stream_id)
         else:
             self.priority_frame = priority_frame
 
-        self.set_fuzzer(DumbByteArrayFuzzer(self.priority_frame.payload(),
+        self.set_fuzzer(create_byte_array_fuzzer(self.priority_frame.payload(),
                                             seed, min_ratio, max_ratio,
-                                            start_test, ignored_bytes))
+                                            start_test, ignored_bytes,
+                                            fuzzer_id = self.fuzzer_id))
 
-    def next(self, stream_id = __default_stream_id):
+    def next_into(self, batch, stream_id = None):
+        if stream_id is None:
+            stream_id = self.stream_id
         self.info('generate a priority frame, stream id = {0:d}'.format(stream_id))
-        fuzzed_payload = self.fuzzer.next()
-        self.verbose('fuzzed payload:', str(fuzzed_payload))
-        return Frame(PriorityFrame.frame_type).encode(fuzzed_payload)
+        fuzzed_payload = self.fuzzer.next_patch()
+        self.verbose('fuzzed payload:', helper.hexdump(fuzzed_payload))
+        batch.add_patched(fuzzed_payload, Frame(PriorityFrame.frame_type, 0x0, stream_id))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbPriorityFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbPriorityFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbPriorityFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbPriorityFuzzer.__name__, *messages)
 
 
 # TODO: fuzz PUSH_PROMISE frame flags
@@ -686,6 +1530,8 @@ class DumbPriorityFuzzer(AbstractDumbFuzzer):
 # TODO: send fuzzed CONTINUATION frames
 class DumbPushPromiseFuzzer(AbstractDumbFuzzer):
 
+    promises_stream = True
+
     def __init__(self, headers = None, seed = 1, min_ratio = 0.01, max_ratio = 0.05,
                  start_test = 0, ignored_symbols = (),
                  ignored_header_names = ('accept', ':scheme', ':method', ':path')):
@@ -696,54 +1542,57 @@ class DumbPushPromiseFuzzer(AbstractDumbFuzzer):
             raise Exception('headers not specified')
         self.headers = headers
 
-        self.verbose('original headers:', str(self.headers))
+        self.verbose('original headers:', self.headers)
         self.set_fuzzer(DumbDictionaryFuzzer(self.headers, seed,
                                              min_ratio, max_ratio,
                                              start_test,
-                                             ignored_symbols, ignored_header_names))
+                                             ignored_symbols, ignored_header_names,
+                                             fuzzer_id = self.fuzzer_id))
 
-    def next(self, stream_id = 1, promised_stream_id = 2):
-        self.info('generate a headers frame, stream id = {0:d}'.format(stream_id))
+    def next_into(self, batch):
+        self.info('generate a headers frame, stream id = {0:d}'.format(self.stream_id),
+                  'promised stream id = {0:d}'.format(self.promised_stream_id))
         fuzzed_headers = self.fuzzer.next()
-        self.verbose('fuzzed headers:', str(fuzzed_headers))
-        return PushPromiseFrame(stream_id, promised_stream_id, fuzzed_headers).encode()
+        self.verbose('fuzzed headers:', fuzzed_headers)
+        batch.add(PushPromiseFrame(self.stream_id, self.promised_stream_id, fuzzed_headers))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbPushPromiseFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbPushPromiseFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbPushPromiseFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbPushPromiseFuzzer.__name__, *messages)
 
 
 # TODO: fuzz frame flags even if RST_STREAM frame doesn't define any flags
 class DumbRstStreamFuzzer(AbstractDumbFuzzer):
 
+    uses_stream = True
+    targets_open_stream = True
+
     def __init__(self, seed = 1, min_ratio = 0.01, max_ratio = 0.05, start_test = 0):
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
+        self.template = RstStreamFrame.template()
         self.reset()
 
     def reset(self):
         self.set_test(self.start_test)
-        self.random_byte_error_code = random.Random()
 
-    def next(self, stream_id = 1):
-        self.random_byte_error_code.seed(self.seed * self.test)
-        error_code = self.random_byte_error_code.randint(0, RstStreamFrame.max_error_code)
+    def next_into(self, batch, stream_id = None):
+        if stream_id is None:
+            stream_id = self.stream_id
+        random_generator = helper.test_random(self.seed, self.fuzzer_id, self.test)
+        error_code = random_generator.randint(0, RstStreamFrame.max_error_code)
         self.info('generate an RST_STREAM frame:',
                     'stream id = {0:d}'.format(stream_id),
                     'error code = {0:d}'.format(error_code))
         self.test += 1
-        return RstStreamFrame(stream_id, error_code).encode()
+        batch.add_template(self.template, stream_id = stream_id, error_code = error_code)
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbRstStreamFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbRstStreamFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbRstStreamFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbRstStreamFuzzer.__name__, *messages)
 
 
 class DumbSettingsFuzzer(AbstractDumbFuzzer):
@@ -757,17 +1606,17 @@ class DumbSettingsFuzzer(AbstractDumbFuzzer):
             self.payload = SettingsFrame().payload()  # default settings
         else:
             self.payload = payload
-        self.set_fuzzer(DumbByteArrayFuzzer(
-            self.payload, seed, min_ratio, max_ratio, start_test, ignored_bytes))
+        self.set_fuzzer(create_byte_array_fuzzer(
+            self.payload, seed, min_ratio, max_ratio, start_test, ignored_bytes,
+            fuzzer_id = self.fuzzer_id))
 
-    def next(self):
+    def next_into(self, batch):
         self.info('generate a settings frame')
-        fuzzed_payload = self.fuzzer.next()
-        return Frame(SettingsFrame.frame_type).encode(fuzzed_payload)
+        fuzzed_payload = self.fuzzer.next_patch()
+        batch.add_patched(fuzzed_payload, Frame(SettingsFrame.frame_type))
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbSettingsFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbSettingsFuzzer.__name__, *messages)
 
 
 # TODO: fuzz WINDOW_UPDATE frame flags even if the spec doesn't define any
@@ -777,22 +1626,22 @@ class DumbWindowUpdateFuzzer(AbstractDumbFuzzer):
 
     def __init__(self, seed = 1, min_ratio = 0.01, max_ratio = 0.05, start_test = 0):
         AbstractDumbFuzzer.__init__(self, seed, min_ratio, max_ratio, start_test)
-        self.random_window_size_increment = random.Random()
-        self.random_window_size_increment.seed(seed * start_test)
+        self.template = WindowUpdateFrame.template()
 
-    def next(self, stream_id = 0x0):
+    def next_into(self, batch, stream_id = 0x0):
         self.info('generate a window update frame, stream id = {0:d}'
                     .format(stream_id))
 
-        window_size_increment = self.random_window_size_increment.randint(
+        random_generator = helper.test_random(self.seed, self.fuzzer_id, self.test)
+        self.test += 1
+        window_size_increment = random_generator.randint(
             0, DumbWindowUpdateFuzzer.__max_window_size_increment)
 
-        return WindowUpdateFrame(stream_id, window_size_increment).encode()
+        batch.add_template(self.template, stream_id = stream_id,
+                           window_size_increment = window_size_increment)
 
     def info(self, *messages):
-        helper.print_with_indent(
-            DumbWindowUpdateFuzzer.__name__, messages[0], messages[1:])
+        tracer.info(DumbWindowUpdateFuzzer.__name__, *messages)
 
     def verbose(self, *messages):
-        helper.verbose_with_indent(
-            DumbWindowUpdateFuzzer.__name__, messages[0], messages[1:])
+        tracer.verbose(DumbWindowUpdateFuzzer.__name__, *messages)
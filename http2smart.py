@@ -1,41 +1,210 @@
 #!/usr/bin/python
 
+import collections
 import connection
 import helper
 import socket
-from fuzzbase import LinearFuzzer, RequestMethodFuzzer, RequestPathFuzzer, RequestVersionFuzzer, HostnameFuzzer
+from fuzzbase import LinearFuzzer, ProductFuzzer, RequestMethodFuzzer, RequestPathFuzzer, RequestVersionFuzzer, HostnameFuzzer, WordList
 from helper import AbstractTest
-from http2core import Http1Upgrade
+from http2core import Http1Upgrade, Http1ResponseParser
+
+
+# a fuzzed request which is waiting for a response
+class PendingRequest:
+
+    def __init__(self, state, request):
+        self.state = state
+        self.request = request
+        self.alone = False  # set if the request might have closed a connection
 
 
 class Http1UpgradeTest(AbstractTest):
 
-    def __init__(self, config):
+    response_timeout = 1.0  # in seconds
+    receive_size = 65536
+
+    # if strength is not zero, the fuzzers are used together,
+    # and every combination of values of that many fuzzers is tested,
+    # if pipeline is not zero, connections are kept alive, and up to that many
+    # requests are sent at once, otherwise each request is sent over a new connection.
+    # If size_sweep is set, the fields also get values of sizes around powers of two,
+    # and word_list is a path to a file with request paths, one per line
+    def __init__(self, config, strength = 0, pipeline = 0, size_sweep = False, word_list = None):
         self.config = config
-        self.fuzzer = LinearFuzzer()
-        self.fuzzer.add(RequestMethodFuzzer())
-        self.fuzzer.add(RequestPathFuzzer())
-        self.fuzzer.add(RequestVersionFuzzer())
-        self.fuzzer.add(HostnameFuzzer())
+        self.pipeline = pipeline
+        self.word_list = WordList(word_list) if word_list else None
+        self.fuzzer = ProductFuzzer(strength) if strength > 0 else LinearFuzzer()
+        self.fuzzer.add(RequestMethodFuzzer(size_sweep))
+        self.fuzzer.add(RequestPathFuzzer(size_sweep, self.word_list))
+        self.fuzzer.add(RequestVersionFuzzer(size_sweep))
+        self.fuzzer.add(HostnameFuzzer(size_sweep))
+        self.end = self.fuzzer.total()
 
+    # runs only tests from specified range, for example, one of ranges
+    # returned by self.fuzzer.split()
+    def set_range(self, start, end):
+        self.fuzzer.seek(start)
+        self.end = end
+
+    # the word list is closed when tests are done,
+    # it's opened again if the tests are run again
     def run(self):
+        try:
+            if self.pipeline > 0:
+                return self.run_keep_alive()
+            return self.run_new_connections()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.word_list is not None:
+            self.word_list.close()
+
+    # sends each request over a new connection
+    def run_new_connections(self):
         self.info('start, state: {}'.format(self.fuzzer.get_state()))
+        stats = collections.Counter()
         client = connection.Client(self.config.host, self.config.port, self.config.tls)
-        while self.fuzzer.ready():
+        while self.fuzzer.ready() and self.fuzzer.position() < self.end:
             self.info('state: {}'.format(self.fuzzer.get_state()))
             client.connect()
             try:
                 fuzzed = self.fuzzer.fuzz(Http1Upgrade())
                 self.info('send fuzzed request:', str(fuzzed))
                 client.send(fuzzed.encode())
+                stats['tests'] += 1
                 data = client.receive()
-                self.info('received from server:', helper.truncate(data.decode('ascii')))
+                if data is None:
+                    self.info('no response in time')
+                else:
+                    self.info('received from server:', helper.truncate(data.decode('ascii')))
             except socket.error as msg:
+                stats['errors'] += 1
                 self.achtung('the following error occurred while sending data: {}'.format(msg))
             finally:
                 self.fuzzer.next()
                 client.close()
         self.info('finished')
+        return dict(stats)
+
+    # sends requests over a connection while the server keeps it open.
+    # If the connection is closed, then requests which were not answered are sent again.
+    # The first of them is sent alone since it might have caused closing the connection,
+    # and it's given up if it closes a connection again.
+    def run_keep_alive(self):
+        self.info('start, state: {}, pipeline: {:d}'.format(self.fuzzer.get_state(), self.pipeline))
+        self.stats = collections.Counter()
+        client = connection.Client(self.config.host, self.config.port, self.config.tls,
+                                   Http1UpgradeTest.response_timeout)
+        parser = Http1ResponseParser()
+        retries = collections.deque()
+        while retries or self.has_next():
+            try:
+                client.connect()
+            except socket.error as msg:
+                self.stats['errors'] += 1
+                self.achtung('could not connect: {}'.format(msg))
+                break
+            self.stats['connections'] += 1
+            parser.reset()
+            try:
+                while self.send_requests(client, parser, retries):
+                    pass
+            finally:
+                client.close()
+        self.info('finished')
+        return dict(self.stats)
+
+    def has_next(self):
+        return self.fuzzer.ready() and self.fuzzer.position() < self.end
+
+    def next_request(self):
+        state = self.fuzzer.get_state()
+        request = self.fuzzer.fuzz(Http1Upgrade())
+        self.fuzzer.next()
+        self.stats['tests'] += 1
+        return PendingRequest(state, request)
+
+    # returns next requests to send, requests which were not answered go first
+    def take(self, retries):
+        if retries and retries[0].alone:
+            return [retries.popleft()]
+        requests = []
+        while len(requests) < self.pipeline:
+            if retries and not retries[0].alone:
+                requests.append(retries.popleft())
+            elif not retries and self.has_next():
+                requests.append(self.next_request())
+            else:
+                break
+        return requests
+
+    # sends a batch of requests, and reads responses to them,
+    # returns False if the connection can't be used any more
+    def send_requests(self, client, parser, retries):
+        pending = collections.deque(self.take(retries))
+        if not pending:
+            return False
+
+        for request in pending:
+            self.info('{}: send fuzzed request:'.format(request.state), str(request.request))
+            parser.expect(request.request.method)
+        try:
+            client.send(b''.join(request.request.encode() for request in pending))
+        except socket.error as msg:
+            self.stats['errors'] += 1
+            self.info('could not send data: {}'.format(msg))
+            self.give_back(pending, retries, False)
+            return False
+
+        closed_by_response = False
+        while pending and not parser.closed:
+            try:
+                data = client.receive(Http1UpgradeTest.receive_size)
+            except socket.error as msg:
+                self.info('could not receive data: {}'.format(msg))
+                parser.stop(str(msg))
+                break
+            if data is None:
+                parser.stop('no response in time')
+                break
+            responses = parser.feed(data) if data else parser.finish()
+            for response in responses:
+                if not pending:
+                    self.info('unexpected response:', str(response))
+                    continue
+                request = pending.popleft()
+                self.stats['responses'] += 1
+                self.info('{}: received from server:'.format(request.state), str(response))
+                # a body may be delimited by closing the connection
+                closed_by_response = not data or not response.keeps_alive()
+
+        # a request which was answered with something invalid closed the connection
+        if pending and parser.invalid:
+            request = pending.popleft()
+            self.stats['invalid_responses'] += 1
+            self.info('{}: received invalid response: {}'.format(request.state, parser.reason))
+            closed_by_response = True
+
+        if pending:
+            self.info('connection closed: {}'.format(parser.reason))
+            self.give_back(pending, retries, closed_by_response)
+        return not parser.closed
+
+    # puts requests which were not answered back to the queue,
+    # if a response didn't close the connection, then the first request did it
+    def give_back(self, pending, retries, closed_by_response):
+        unanswered = list(pending)
+        if not closed_by_response:
+            suspect = unanswered.pop(0)
+            if suspect.alone:
+                self.stats['no_response'] += 1
+                self.info('{}: no response, the connection was closed'.format(suspect.state))
+            else:
+                suspect.alone = True
+                unanswered.insert(0, suspect)
+        self.stats['resent'] += len(unanswered)
+        retries.extendleft(reversed(unanswered))
 
     def set_state(self, s):
         self.fuzzer.set_state(s)
@@ -1,9 +1,8 @@
 #!/usr/bin/python
 
 import argparse
+import campaign
 import config
-from http2dumb import DumbHttp2ServerTest, DumbHttp2ClientTest
-from http2smart import Http1UpgradeTest
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--verbose', help='more logs', action='store_true', default=False)
@@ -12,15 +11,37 @@ parser.add_argument('--host',    help='host name', default='localhost')
 parser.add_argument('--tls',     help='enable TLS', action='store_true')
 parser.add_argument('--list',    help='list of available tests', action='store_true')
 parser.add_argument('--test',    help='test to run')
+parser.add_argument('--numpy',   help='use NumPy for mutating byte arrays', action='store_true')
+parser.add_argument('--scheduler', help='use AFL-style mutation operators chosen by a scheduler',
+                    action='store_true')
+parser.add_argument('--hpack-structure', help='also run HTTP/2 tests with header blocks '
+                                                'which are built by a structure-aware HPACK generator',
+                    action='store_true')
+parser.add_argument('--strength', help='number of HTTP/1.1 request fields which are fuzzed together '
+                                         '(0 means one field at a time)', type=int, default=0)
+parser.add_argument('--connections', help='number of concurrent HTTP/2 connections',
+                    type=int, default=1)
+parser.add_argument('--window', help='number of batches of HTTP/2 tests which are sent '
+                                       'without waiting for responses', type=int, default=1)
+parser.add_argument('--frames-per-send', help='number of HTTP/2 tests which are sent '
+                                                'with one call', type=int, default=1)
+parser.add_argument('--pipeline', help='number of HTTP/1.1 requests which are sent at once '
+                                         'over a kept-alive connection (0 means a new connection '
+                                         'for each request)', type=int, default=0)
+parser.add_argument('--size-sweep', help='also use HTTP/1.1 request fields of sizes '
+                                           'around powers of two', action='store_true')
+parser.add_argument('--word-list', help='file with HTTP/1.1 request paths, one per line')
+parser.add_argument('--data-file', help='file with a request body which is sent in DATA frames')
+parser.add_argument('--seed',       help='seed for random values', type=int, default=1)
+parser.add_argument('--start-test', help='first test to run', type=int, default=0)
+parser.add_argument('--end-test',   help='last test to run', type=int)
+parser.add_argument('--workers',    help='number of processes which run tests', type=int, default=1)
 
 # init config
 config.current = config.Config(parser)
+campaign.configure(config.current)
 
-available_tests = [
-    DumbHttp2ServerTest(config.current.host, config.current.port, config.current.tls),
-    DumbHttp2ClientTest(config.current.port, config.current.tls),
-    Http1UpgradeTest(config.current)
-]
+available_tests = campaign.create_tests(config.current)
 
 if config.current.list:
     # print out all available tests with a short description
@@ -30,7 +51,10 @@ elif config.current.test:
     # run specified tests
     for test in available_tests:
         if config.current.test in test.name():
-            test.run()
+            if config.current.workers > 1:
+                campaign.run(config.current, test, config.current.workers)
+            else:
+                test.run()
 
 else:
     raise Exception('What the hell? Run --help and tell me what to do!')
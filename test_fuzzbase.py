@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+import itertools
+import os
+import tempfile
+import unittest
+
+from fuzzbase import BoringFuzzer, ProductFuzzer, SizeSweep, WordList, next_prime
+
+
+def create_fuzzer(name, n):
+    fuzzer = BoringFuzzer()
+    fuzzer.add_values(['{0}{1:d}'.format(name, i) for i in range(n)])
+    fuzzer.set_action(lambda subject, value: subject.append(value))
+    return fuzzer
+
+
+# returns values of the fuzzers for all tests of a product fuzzer
+def all_tests(product):
+    tests = []
+    product.reset()
+    while product.ready():
+        tests.append(tuple(product.fuzz([])))
+        product.next()
+    return tests
+
+
+class ProductFuzzerTest(unittest.TestCase):
+
+    sizes = (3, 5, 7, 2, 4, 6)
+
+    @staticmethod
+    def name(i):
+        return chr(ord('a') + i)
+
+    def create_product(self, strength = None, sizes = sizes):
+        product = ProductFuzzer(strength)
+        for i, n in enumerate(sizes):
+            product.add(create_fuzzer(ProductFuzzerTest.name(i), n))
+        return product
+
+    def assert_covered(self, product, strength, sizes = sizes):
+        tests = all_tests(product)
+        self.assertEqual(len(tests), product.total())
+        for fuzzers in itertools.combinations(range(len(sizes)), strength):
+            covered = set(tuple(test[i] for i in fuzzers) for test in tests)
+            expected = set(itertools.product(
+                *[['{0}{1:d}'.format(ProductFuzzerTest.name(i), k)
+                   for k in range(sizes[i])] for i in fuzzers]))
+            self.assertEqual(covered, expected, 'fuzzers {0}'.format(fuzzers))
+
+    def test_every_pair_is_covered(self):
+        product = self.create_product(2)
+        self.assertEqual(product.total(), next_prime(max(ProductFuzzerTest.sizes)) ** 2)
+        self.assert_covered(product, 2)
+
+    def test_every_triple_is_covered(self):
+        product = self.create_product(3)
+        self.assertEqual(product.total(), 7 ** 3)
+        self.assert_covered(product, 3)
+
+    # there are more fuzzers than values,
+    # so the order of the field depends on the number of fuzzers
+    def test_more_fuzzers_than_values(self):
+        for sizes, strength, order in (((2, 2, 2, 2, 2), 2, 5),
+                                       ((3, 3, 3, 3, 3, 3), 2, 7),
+                                       ((2, 2, 2, 2, 2), 3, 5)):
+            product = self.create_product(strength, sizes)
+            self.assertEqual(product.total(), order ** strength)
+            self.assert_covered(product, strength, sizes)
+
+    # without a strength, each combination is used exactly once
+    def test_full_product(self):
+        product = self.create_product()
+        tests = all_tests(product)
+        self.assertEqual(len(tests), 3 * 5 * 7 * 2 * 4 * 6)
+        self.assertEqual(len(set(tests)), len(tests))
+
+    # a test depends only on its position
+    def test_seek(self):
+        product = self.create_product(2)
+        tests = all_tests(product)
+        for position in (0, 1, 17, len(tests) - 1):
+            product.seek(position)
+            self.assertEqual(tuple(product.fuzz([])), tests[position])
+
+
+class SizeSweepTest(unittest.TestCase):
+
+    def test_sizes_around_powers_of_two(self):
+        sweep = SizeSweep('x', 16, '<', '>')
+        self.assertEqual([len(value) - 2 for value in sweep],
+                         [0, 1, 2, 3, 4, 5, 7, 8, 9, 15, 16])
+        self.assertEqual(sweep[3], '<xxx>')
+
+
+class WordListTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'/index.html\r\n\n/\xff\n/last')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_lines(self):
+        with WordList(self.path) as words:
+            self.assertEqual(list(words), ['/index.html', '', '/\ufffd', '/last'])
+            with self.assertRaises(IndexError):
+                words[4]
+
+    # the file is closed, and it's opened again if the list is used after closing
+    def test_close(self):
+        words = WordList(self.path)
+        self.assertEqual(len(words), 4)
+        file = words.file
+        words.close()
+        self.assertTrue(file.closed)
+        self.assertIsNone(words.data)
+        self.assertEqual(words[0], '/index.html')
+        words.close()
+
+    def test_empty_file(self):
+        with open(self.path, 'wb'):
+            pass
+        with WordList(self.path) as words:
+            self.assertEqual(len(words), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+import hpack
+import os
+import random
+import tempfile
+import unittest
+
+import http2core
+import http2dumb
+
+from http2core import RstStreamFrame, SettingsFrame, WindowUpdateFrame
+
+
+def decode(frame):
+    return http2core.FrameDecoder().feed(bytes(frame.encode()))
+
+
+# returns encoded frames with random types, flags, stream ids and payloads,
+# and a list of (type, flags, stream id, payload) for each frame
+def random_frames(random_generator, n, max_length):
+    data = bytearray()
+    frames = []
+    for i in range(n):
+        length = random_generator.choice((0, random_generator.randint(1, max_length)))
+        frame = (random_generator.randint(0, 9), random_generator.randint(0, 255),
+                 random_generator.randint(0, 2**31 - 1), random_generator.randbytes(length))
+        data.extend(http2core.encode_frame_header(length, *frame[:3]))
+        data.extend(frame[3])
+        frames.append(frame)
+    return data, frames
+
+
+# payloads are copied right away since they refer to the receive buffer
+def copy_frames(frames):
+    return [(frame.frame_type, frame.flags, frame.stream_id, bytes(frame.payload))
+            for frame in frames]
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    # frames are cut across chunks of random sizes, some frames are larger
+    # than the receive buffer, so that it has to grow
+    def test_feed_random_chunks(self):
+        for seed in range(20):
+            random_generator = random.Random(seed)
+            data, expected = random_frames(random_generator, 200, 3000)
+            large_data, large_frames = random_frames(random_generator, 3, 100000)
+            data.extend(large_data)
+            expected.extend(large_frames)
+
+            decoder = http2core.FrameDecoder(1024)
+            decoded = []
+            position = 0
+            while position < len(data):
+                size = random_generator.choice((1, 9, 10, random_generator.randint(1, 5000)))
+                decoded.extend(copy_frames(decoder.feed(data[position:position + size])))
+                position += size
+
+            self.assertEqual(decoded, expected)
+            self.assertEqual(decoder.pending(), 0)
+
+    # receive() gets chunks of random sizes, or nothing if a receive timed out
+    def test_receive_random_chunks(self):
+        random_generator = random.Random(1)
+        data, expected = random_frames(random_generator, 300, 20000)
+        position = 0
+
+        def recv_into(buffer):
+            nonlocal position
+            if position == len(data):
+                return 0
+            if random_generator.random() < 0.1:
+                return None
+            size = min(len(buffer), random_generator.randint(1, 30000), len(data) - position)
+            buffer[:size] = data[position:position + size]
+            position += size
+            return size
+
+        decoder = http2core.FrameDecoder()
+        decoded = []
+        while position < len(data):
+            decoded.extend(copy_frames(decoder.receive(recv_into)))
+
+        self.assertEqual(decoded, expected)
+        self.assertIsNone(decoder.receive(recv_into))
+
+
+class HPackGeneratorTest(unittest.TestCase):
+
+    # without mutations, a header block is valid, and it's decoded
+    # to the original headers whatever representations were chosen,
+    # repeated headers may refer to entries of the dynamic table
+    def test_round_trip(self):
+        for headers in (http2dumb.default_request_headers,
+                        http2dumb.default_response_headers,
+                        http2dumb.default_request_headers * 2):
+            generator = http2core.HPackGenerator(headers, mutation_ratio = 0)
+            expected = [(http2core.hpack_bytes(name), http2core.hpack_bytes(value))
+                         for name, value in headers]
+            for seed in range(200):
+                block = generator.generate(random.Random(seed))
+                decoded = hpack.Decoder().decode(bytes(block), raw = True)
+                self.assertEqual(decoded, expected, 'seed {0:d}'.format(seed))
+
+    def test_huffman_encode(self):
+        random_generator = random.Random(1)
+        for length in range(0, 300, 7):
+            data = random_generator.randbytes(length)
+            block = bytearray()
+            http2core.hpack_string(block, http2core.huffman_encode(data), huffman = True)
+            decoded = hpack.Decoder().decode(b'\x00\x01a' + bytes(block), raw = True)
+            self.assertEqual(decoded, [(b'a', data)])
+
+    # a mutated block may be invalid, but then a decoder reports an HPACK error
+    def test_mutations(self):
+        generator = http2core.HPackGenerator(http2dumb.default_request_headers,
+                                             mutation_ratio = 0.3)
+        errors = 0
+        for seed in range(500):
+            block = generator.generate(random.Random(seed))
+            try:
+                hpack.Decoder().decode(bytes(block), raw = True)
+            except hpack.HPACKError:
+                errors += 1
+        self.assertGreater(errors, 0)
+
+
+class StreamIdAllocatorTest(unittest.TestCase):
+
+    def test_last_active(self):
+        streams = http2core.StreamIdAllocator()
+        self.assertIsNone(streams.last_active())
+        streams.allocate(False)
+        self.assertIsNone(streams.last_active())
+        streams.allocate()
+        streams.allocate()
+        self.assertEqual(streams.last_active(), 5)
+        streams.process(decode(RstStreamFrame(5, 0)))
+        self.assertEqual(streams.last_active(), 3)
+        streams.process(decode(RstStreamFrame(3, 0)))
+        self.assertEqual(streams.last_active(), 5)
+
+
+class FlowControlTest(unittest.TestCase):
+
+    def test_initial_window_size_changes_open_streams(self):
+        flow = http2core.FlowControl()
+        flow.open(1)
+        settings = SettingsFrame()
+        settings.settings_initial_window_size = 1000
+        flow.process(decode(settings))
+        flow.open(3)
+        self.assertEqual(flow.available(1), 1000)
+        self.assertEqual(flow.available(3), 1000)
+
+    def test_window_updates(self):
+        flow = http2core.FlowControl()
+        flow.open(1)
+        flow.consume(1, 65535)
+        self.assertEqual(flow.available(1), 0)
+        flow.process(decode(WindowUpdateFrame(1, 100)))
+        self.assertEqual(flow.available(1), 0)
+        flow.process(decode(WindowUpdateFrame(0, 50)))
+        self.assertEqual(flow.available(1), 50)
+
+
+class DataStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(bytes(range(256)) * 100)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    # frames never exceed the windows, and the stream waits
+    # until the windows are updated
+    def test_frames_follow_windows(self):
+        flow = http2core.FlowControl()
+        settings = SettingsFrame()
+        settings.settings_initial_window_size = 1000
+        flow.process(decode(settings))
+        flow.open(1)
+
+        body = bytearray()
+        waits = 0
+        for header, payload in http2core.DataStream(self.path, 1, 700).frames(flow):
+            if header is None:
+                waits += 1
+                flow.process(decode(WindowUpdateFrame(1, 3000)))
+                continue
+            self.assertLessEqual(len(payload), 700)
+            self.assertGreaterEqual(flow.available(1), 0)
+            body.extend(payload)
+
+        self.assertEqual(bytes(body), bytes(range(256)) * 100)
+        self.assertEqual(waits, 9)
+
+    def test_send_stops_if_windows_are_not_updated(self):
+        class Client:
+            def __init__(self):
+                self.sent = 0
+            def send_parts(self, parts):
+                self.sent += len(parts[1])
+
+        client = Client()
+        flow = http2core.FlowControl()
+        settings = SettingsFrame()
+        settings.settings_initial_window_size = 1000
+        flow.process(decode(settings))
+        flow.open(1)
+        sent = http2core.DataStream(self.path, 1).send(client, flow, lambda: False)
+        self.assertEqual(sent, 1000)
+        self.assertEqual(client.sent, 1000)
+
+
+class Http1ResponseParserTest(unittest.TestCase):
+
+    # pipelined responses with all kinds of bodies,
+    # the last one closes the connection, and the rest is ignored
+    responses = (b'HTTP/1.1 100 Continue\r\n\r\n'
+                 b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+                 b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n'
+                 b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                 b'3;ext=1\r\nabc\r\n4\r\ndefg\r\n0\r\nTrailer: x\r\n\r\n'
+                 b'HTTP/1.1 204 No Content\r\n\r\n'
+                 b'HTTP/1.1 304 Not Modified\r\nContent-Length: 7\r\n\r\n'
+                 b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'
+                 b'HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 3\r\n\r\nbye'
+                 b'HTTP/1.1 200 OK\r\n\r\n')
+    methods = ('GET', 'HEAD', 'GET', 'GET', 'GET', 'GET', 'GET', 'GET')
+    expected = [('GET', 200, b'hello'), ('HEAD', 200, b''), ('GET', 200, b'abcdefg'),
+                ('GET', 204, b''), ('GET', 304, b''), ('GET', 404, b''), ('GET', 200, b'bye')]
+
+    def parse(self, chunks):
+        parser = http2core.Http1ResponseParser()
+        for method in Http1ResponseParserTest.methods:
+            parser.expect(method)
+        responses = []
+        for chunk in chunks:
+            responses.extend(parser.feed(chunk))
+        responses.extend(parser.finish())
+        self.assertFalse(parser.invalid)
+        return [(response.method, response.status, bytes(response.body))
+                for response in responses]
+
+    # the data is split into two reads at each possible point
+    def test_split_into_two_reads(self):
+        data = Http1ResponseParserTest.responses
+        for position in range(len(data) + 1):
+            self.assertEqual(self.parse((data[:position], data[position:])),
+                             Http1ResponseParserTest.expected, 'split at {0:d}'.format(position))
+
+    def test_random_reads(self):
+        data = Http1ResponseParserTest.responses
+        random_generator = random.Random(1)
+        for i in range(100):
+            chunks = []
+            position = 0
+            while position < len(data):
+                size = random_generator.randint(1, 40)
+                chunks.append(data[position:position + size])
+                position += size
+            self.assertEqual(self.parse(chunks), Http1ResponseParserTest.expected)
+
+    # a body which is delimited by closing the connection
+    # is returned only when the connection is closed
+    def test_body_until_close(self):
+        parser = http2core.Http1ResponseParser()
+        parser.expect('GET')
+        self.assertEqual(parser.feed(b'HTTP/1.0 200 OK\r\n\r\nsome'), [])
+        self.assertEqual(parser.feed(b' data'), [])
+        responses = parser.finish()
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(bytes(responses[0].body), b'some data')
+
+    def test_invalid_response(self):
+        parser = http2core.Http1ResponseParser()
+        parser.expect('GET')
+        parser.expect('GET')
+        responses = parser.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\nx'
+                                b'HTTP/1.1 2OO OK\r\n\r\n')
+        self.assertEqual(len(responses), 1)
+        self.assertTrue(parser.closed)
+        self.assertTrue(parser.invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+
+import hpack
+import socket
+import threading
+import time
+import unittest
+
+import http2core
+
+from http2dumb import DumbHttp2ServerTest
+
+
+# SilentServer accepts connections, reads everything and never replies
+class SilentServer:
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(('localhost', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.connections = []
+        self.thread = threading.Thread(target = self.accept, daemon = True)
+        self.thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                client, address = self.socket.accept()
+            except OSError:
+                return
+            self.connections.append(client)
+            threading.Thread(target = self.read, args = (client, ), daemon = True).start()
+
+    def read(self, client):
+        try:
+            while client.recv(65536):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.socket.close()
+        for client in self.connections:
+            client.close()
+
+
+class DumbHttp2ServerTestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SilentServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    # a server which never replies doesn't hang several connections,
+    # each read gives up after the receive timeout, and tests go on
+    # on the same connections as if there was no response
+    def test_silent_server_with_several_connections(self):
+        test = DumbHttp2ServerTest(port = self.server.port, start_test = 0, end_test = 9,
+                                   connections = 2)
+        test.max_receive_timeout = 0.05
+        started = time.monotonic()
+        stats = test.run()
+        self.assertLess(time.monotonic() - started, 5.0)
+        self.assertEqual(stats['tests'], 10)
+        self.assertEqual(stats['connections'], 2)
+        self.assertEqual(stats['reactions'], set([()]))
+
+
+class DumbHttp2ServerTestBatches(unittest.TestCase):
+
+    # a batch contains the same tests as if they were generated one by one,
+    # even if numbers are not contiguous, and frames which were already
+    # in the batch stay in front of them
+    def test_batch_matches_single_tests(self):
+        test = DumbHttp2ServerTest(end_test = 100)
+        tests = list(range(10, 40)) + [3, 77]
+        batch = http2core.FrameBatch(16)
+        batch.add_bytes(b'prefix')
+        data, offsets = test.next_batch(tests, http2core.StreamIdAllocator(), batch)
+
+        self.assertEqual(bytes(data[:offsets[0]]), b'prefix')
+        self.assertEqual(len(offsets), len(tests) + 1)
+        self.assertEqual(offsets[-1], len(data))
+        streams = http2core.StreamIdAllocator()
+        for i, number in enumerate(tests):
+            self.assertEqual(bytes(data[offsets[i]:offsets[i + 1]]),
+                             bytes(test.generate(number, streams)), 'test {0:d}'.format(number))
+
+    # DATA, RST_STREAM and CONTINUATION frames go to streams which were opened
+    # by previous tests instead of idle streams
+    def test_frames_target_open_streams(self):
+        test = DumbHttp2ServerTest(end_test = 200)
+        streams = http2core.StreamIdAllocator()
+        data, offsets = test.next_batch(range(200), streams)
+        opened = set()
+        targeted = 0
+        for i in range(200):
+            fuzzer = test.fuzzers[i % len(test.fuzzers)]
+            stream_id = http2core.unpack_uint32(data, offsets[i] + 5) & 0x7FFFFFFF
+            if fuzzer.opens_stream:
+                opened.add(stream_id)
+            elif fuzzer.targets_open_stream:
+                self.assertEqual(stream_id, max(opened), 'test {0:d}'.format(i))
+                targeted += 1
+        self.assertGreater(targeted, 0)
+
+
+class DumbHttp2ServerTestUpload(unittest.TestCase):
+
+    # a request which carries a body is well-formed, so that a server reads the body
+    def test_upload_headers(self):
+        test = DumbHttp2ServerTest(data_file = 'body.bin')
+        frames = http2core.FrameDecoder().feed(bytes(test.upload_headers(3, 300000)))
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0].stream_id, 3)
+        self.assertFalse(frames[0].has_flag(http2core.end_stream_flag))
+
+        # skip a padding length, a stream dependency and a weight, and then padding
+        payload = bytes(frames[0].payload)
+        headers = hpack.Decoder().decode(payload[6:len(payload) - payload[0]])
+        names = [name for name, value in headers]
+        self.assertEqual(names[0], ':method')
+        self.assertEqual([name for name in names if name != name.lower()], [])
+        for name in ('connection', 'proxy-connection', 'keep-alive',
+                     'transfer-encoding', 'upgrade'):
+            self.assertNotIn(name, names)
+        self.assertIn(('content-length', '300000'), headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+
+import atexit
+import os
+import signal
+import sys
+import textwrap
+import threading
+import time
+
+# trace levels, a message is written out only if its level
+# is not greater than the current level
+ACHTUNG = 0
+INFO = 1
+VERBOSE = 2
+
+current_level = INFO
+
+
+def set_level(level):
+    global current_level
+    current_level = level
+
+
+def enabled(level):
+    return level <= current_level
+
+
+# Lazy wraps a function and its arguments, the function is called
+# only when the message is actually written out,
+# so that expensive formatting doesn't happen if a level is disabled
+class Lazy:
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+# Message is a format string with arguments which are formatted lazily
+class Message(Lazy):
+
+    def __init__(self, message, *args):
+        Lazy.__init__(self, message.format, *args)
+
+
+# Writer collects messages in a buffer, and writes them out
+# to stdout when the buffer is big enough, when the oldest message
+# has waited for flush_interval seconds, or on exit
+#
+# Messages may come from several threads, for example, from a sender
+# and a reader of responses, so the buffer is guarded by a lock.
+# A daemon thread flushes old messages even if nothing else is written,
+# it's started with the first message, and again in a forked child.
+# The lock is re-entrant since flush() may be called from a signal handler
+# while the main thread holds the lock.
+class Writer:
+
+    def __init__(self, max_buffered = 64 * 1024, flush_interval = 1.0):
+        self.max_buffered = max_buffered
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered = 0
+        self.oldest = None      # when the oldest buffered message was written
+        self.condition = threading.Condition(threading.RLock())
+        self.thread = None
+        os.register_at_fork(after_in_child = self.after_fork)
+
+    def write(self, line):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.flush_old_messages,
+                                               daemon = True)
+                self.thread.start()
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+                self.condition.notify()
+            self.buffer.append(line)
+            self.buffer.append('\n')
+            self.buffered += len(line) + 1
+            if self.buffered >= self.max_buffered:
+                self.flush()
+
+    def flush(self):
+        with self.condition:
+            if self.buffer:
+                sys.stdout.write(''.join(self.buffer))
+                self.buffer = []
+                self.buffered = 0
+            sys.stdout.flush()
+            self.oldest = None
+
+    # runs in the daemon thread
+    def flush_old_messages(self):
+        with self.condition:
+            while True:
+                if self.oldest is None:
+                    self.condition.wait()
+                    continue
+                delay = self.oldest + self.flush_interval - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                else:
+                    self.flush()
+
+    # only the forking thread survives in a child,
+    # so the lock and the flushing thread are created again
+    def after_fork(self):
+        self.condition = threading.Condition(threading.RLock())
+        self.thread = None
+
+
+writer = Writer()
+atexit.register(writer.flush)
+
+
+# writes out buffered messages, and then lets the signal terminate the process,
+# so that the last messages before a hang or a kill are not lost
+def flush_and_terminate(signum, frame):
+    writer.flush()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+# should be called from the main thread, SIGINT is not handled here
+# since KeyboardInterrupt lets atexit handlers run
+def flush_on_signals():
+    for name in ('SIGTERM', 'SIGHUP'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), flush_and_terminate)
+
+# text wrappers are created once for each indent
+wrappers = {}
+
+
+def get_wrapper(indent):
+    wrapper = wrappers.get(indent)
+    if wrapper is None:
+        wrapper = textwrap.TextWrapper(
+            initial_indent=indent, subsequent_indent=indent, width=70)
+        wrappers[indent] = wrapper
+    return wrapper
+
+
+# writes a message with a prefix, other messages are written with indent
+def trace(level, prefix, first_message, *other_messages):
+    if level > current_level:
+        return
+
+    formatted_prefix = '[{0:s}] '.format(prefix)
+    writer.write('{0:s}{1}'.format(formatted_prefix, first_message))
+    if len(other_messages) > 0:
+        wrapper = get_wrapper(' ' * len(formatted_prefix))
+        for message in other_messages:
+            writer.write(wrapper.fill(str(message)))
+
+    # achtung messages should not wait in the buffer
+    if level == ACHTUNG:
+        writer.flush()
+
+
+def achtung(prefix, first_message, *other_messages):
+    trace(ACHTUNG, prefix, first_message, *other_messages)
+
+
+def info(prefix, first_message, *other_messages):
+    if INFO > current_level:
+        return
+    trace(INFO, prefix, first_message, *other_messages)
+
+
+def verbose(prefix, first_message, *other_messages):
+    if VERBOSE > current_level:
+        return
+    trace(VERBOSE, prefix, first_message, *other_messages)
+
+
+def flush():
+    writer.flush()